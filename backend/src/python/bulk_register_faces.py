@@ -0,0 +1,343 @@
+# BULK_REGISTER_FACES.PY - register many employees' faces in one run
+#
+#   python bulk_register_faces.py manifest.csv [--report report.jsonl]
+#       [--workers 4] [--chunk-size 200] [--retry-failed] [--duplicate-check reject]
+#   python bulk_register_faces.py photos/ ...
+#
+# The manifest is either a CSV of user_id,image_path rows (a header row is
+# optional, relative paths are resolved against the CSV's directory) or a
+# directory of images named after the employee ID (12.jpg), or holding one
+# sub-directory per employee ID.
+#
+# All employee IDs are validated with one query up front. Images go through
+# the same stages as register_face.py in a pool of worker processes while
+# the parent writes finished embeddings in chunked transactions: new
+# employees with one multi-row INSERT, employees that already have face data
+# by updating their oldest row and deleting the rest (one UPDATE joined
+# against the new blobs), exactly as register_face.py would for each row.
+#
+# Every row gets a line in the report with the JSON register_face.py prints
+# plus "user_id" and "image". Successful rows are only reported after their
+# chunk commits, so re-running with the same report skips everything already
+# done and picks up after an interruption.
+#
+# With FACE_CROP_DIR set, the aligned crop of every registered face is kept
+# in the crop store under its face_data row, as register_face.py does.
+#
+# --duplicate-check (default FACE_DUPLICATE_CHECK) searches each new face
+# against the identification index and the rows registered earlier in the
+# same run; 'reject' fails rows whose face belongs to another employee ID.
+# A resumed run rebuilds the index first so it covers the rows the
+# interrupted run registered.
+from dotenv import load_dotenv
+import argparse
+import csv
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import face_crops
+import face_db
+import face_index
+from face_config import (
+    EMBEDDING_DIM, MODEL_NAME, DUPLICATE_CHECK, DUPLICATE_CHECK_MODES, DUPLICATE_IDENTITY_THRESHOLD
+)
+from face_encoding_format import encode_embedding
+from face_matcher import normalize
+from face_pipeline import log_with_time
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+DEFAULT_CHUNK_SIZE = 200
+ID_QUERY_CHUNK = 5000  # IDs per IN (...) list
+
+def read_manifest(path):
+    """Return [(user_id string, image path)] from a CSV file or a directory"""
+    if os.path.isdir(path):
+        rows = []
+        for name in sorted(os.listdir(path)):
+            full = os.path.join(path, name)
+            if os.path.isdir(full):
+                images = sorted(f for f in os.listdir(full) if f.lower().endswith(IMAGE_EXTENSIONS))
+                if images:
+                    rows.append((name, os.path.join(full, images[0])))
+            elif name.lower().endswith(IMAGE_EXTENSIONS):
+                rows.append((os.path.splitext(name)[0], full))
+        return rows
+
+    base = os.path.dirname(os.path.abspath(path))
+    rows = []
+    with open(path, newline="") as f:
+        for i, record in enumerate(csv.reader(f)):
+            if len(record) < 2 or not record[0].strip():
+                continue
+            user_id, image = record[0].strip(), record[1].strip()
+            if i == 0 and not user_id.isdigit() and not image.lower().endswith(IMAGE_EXTENSIONS):
+                continue  # Header row
+            rows.append((user_id, image if os.path.isabs(image) else os.path.join(base, image)))
+    return rows
+
+def read_report(path):
+    """(user_id, image) pairs already reported, split into done and failed"""
+    done, failed = set(), set()
+    if not os.path.exists(path):
+        return done, failed
+    with open(path) as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue  # A line cut short by the interruption
+            key = (str(row.get("user_id")), row.get("image"))
+            (done if row.get("success") else failed).add(key)
+    return done, failed
+
+def chunked(values, size):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+def existing_ids(cursor, sql, ids):
+    """Run an 'IN (...)' query over ids in chunks and return the first column as a set"""
+    found = set()
+    for chunk in chunked(ids, ID_QUERY_CHUNK):
+        placeholders = ", ".join(["%s"] * len(chunk))
+        cursor.execute(sql.format(placeholders=placeholders), chunk)
+        found.update(row[0] for row in cursor.fetchall())
+    return found
+
+def extract(image_path):
+    """Worker process: (encoding as a list, crop or None, None) or (None, None, error message)"""
+    import register_face
+    try:
+        if face_crops.enabled():
+            encoding, crop = register_face.extract_face_encoding(image_path, keep_crop=True)
+        else:
+            encoding, crop = register_face.extract_face_encoding(image_path), None
+        return [float(v) for v in encoding], crop, None
+    except Exception as e:
+        return None, None, str(e)
+
+def write_chunk(conn, cursor, rows, with_face_data):
+    """Insert or update one chunk of (user_id, blob) rows in one transaction.
+
+    An employee that already has face data keeps exactly one row, as with
+    register_face.py: the oldest is updated and the others are deleted.
+    Returns the deleted face_data ids.
+    """
+    kept, deleted = {}, []
+    try:
+        existing = [user_id for user_id, _ in rows if user_id in with_face_data]
+        if existing:
+            placeholders = ", ".join(["%s"] * len(existing))
+            cursor.execute(
+                f"SELECT employeeID, id FROM face_data WHERE employeeID IN ({placeholders}) ORDER BY id FOR UPDATE",
+                existing
+            )
+            for employee_id, row_id in cursor.fetchall():
+                if employee_id in kept:
+                    deleted.append(row_id)
+                else:
+                    kept[employee_id] = row_id
+        inserts = [(user_id, blob) for user_id, blob in rows if user_id not in kept]
+        updates = [(blob, kept[user_id]) for user_id, blob in rows if user_id in kept]
+        if inserts:
+            # One multi-row INSERT, spelled out: executemany only rewrites an
+            # INSERT into one statement when VALUES holds nothing but
+            # placeholders, and NOW() would make it run row by row
+            values = ", ".join(["(%s, %s, NOW())"] * len(inserts))
+            cursor.execute(
+                f"INSERT INTO face_data (employeeID, face_encoding, createdAt) VALUES {values}",
+                [value for row in inserts for value in row]
+            )
+        if deleted:
+            placeholders = ", ".join(["%s"] * len(deleted))
+            cursor.execute(f"DELETE FROM face_data WHERE id IN ({placeholders})", deleted)
+        if updates:
+            # One UPDATE for every re-registered employee: join the kept rows
+            # against the new blobs listed as a derived table
+            values = " UNION ALL ".join(["SELECT %s AS id, %s AS face_encoding"] * len(updates))
+            cursor.execute(
+                f"UPDATE face_data JOIN ({values}) AS new_templates ON face_data.id = new_templates.id "
+                f"SET face_data.face_encoding = new_templates.face_encoding, face_data.createdAt = NOW()",
+                [value for blob, row_id in updates for value in (row_id, blob)]
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    with_face_data.update(user_id for user_id, _ in inserts)
+    return deleted
+
+def save_crops(cursor, chunk, deleted):
+    """Store the chunk's crops under the face_data rows they were written to"""
+    crops = {user_id: crop for user_id, _, _, _, crop in chunk if crop is not None}
+    try:
+        face_crops.delete_crops(deleted)  # Templates the re-registrations replaced
+        if not crops:
+            return
+        row_ids = {}
+        for ids in chunked(list(crops), ID_QUERY_CHUNK):
+            placeholders = ", ".join(["%s"] * len(ids))
+            cursor.execute(
+                f"SELECT employeeID, MAX(id) FROM face_data WHERE employeeID IN ({placeholders}) GROUP BY employeeID",
+                ids
+            )
+            row_ids.update(cursor.fetchall())
+        face_crops.save_crops([(row_ids[user_id], crop) for user_id, crop in crops.items() if user_id in row_ids])
+    except Exception as e:
+        log_with_time(f"Face crop store failed: {str(e)}")
+
+def flush_chunk(conn, cursor, chunk, with_face_data, emit):
+    try:
+        deleted = write_chunk(conn, cursor, [(user_id, blob) for user_id, _, blob, _, _ in chunk], with_face_data)
+    except Exception as e:
+        for user_id, image, _, _, _ in chunk:
+            emit(user_id, image, {"success": False, "error": f"Database error: {str(e)}"})
+        return
+    if face_crops.enabled():
+        save_crops(cursor, chunk, deleted)
+    for user_id, image, _, conflicts, _ in chunk:
+        response = {"success": True, "message": "Face registered successfully"}
+        if conflicts:
+            response["conflicts"] = conflicts
+        emit(user_id, image, response)
+
+def bulk_register(conn, rows, report_path, workers, chunk_size, retry_failed, duplicate_check=DUPLICATE_CHECK):
+    done, failed = read_report(report_path)
+    skip = done | (set() if retry_failed else failed)
+    counts = {"total": len(rows), "registered": 0, "failed": 0, "skipped": 0}
+    report = open(report_path, "a")
+
+    # The report keeps user_id exactly as the manifest spells it ("012"), so
+    # read_report recognizes the row when the run is resumed
+    labels = {}
+
+    def emit(user_id, image, response):
+        report.write(json.dumps(dict(response, user_id=labels.get(user_id, user_id), image=image)) + "\n")
+        counts["registered" if response.get("success") else "failed"] += 1
+
+    pending = []
+    seen = set()  # Employee IDs as numbers, so "012" and "12" are the same employee
+    for user_id, image in rows:
+        key = int(user_id) if user_id.isdigit() else user_id
+        if (user_id, image) in skip:
+            seen.add(key)
+            counts["skipped"] += 1
+        elif not user_id.isdigit():
+            emit(user_id, image, {"success": False, "error": "user_id must be a valid integer"})
+        elif key in seen:
+            emit(user_id, image, {"success": False, "error": "Duplicate user_id in manifest"})
+        else:
+            seen.add(key)
+            labels[key] = user_id
+            pending.append((key, image))
+
+    cursor = conn.cursor()
+    try:
+        ids = [user_id for user_id, _ in pending]
+        employees = existing_ids(cursor, "SELECT id FROM employee WHERE id IN ({placeholders})", ids)
+        with_face_data = existing_ids(
+            cursor, "SELECT DISTINCT employeeID FROM face_data WHERE employeeID IN ({placeholders})", ids
+        )
+
+        work = []
+        for user_id, image in pending:
+            if user_id in employees:
+                work.append((user_id, image))
+            else:
+                emit(user_id, image, {
+                    "success": False,
+                    "error": f"Employee with ID {user_id} not found in employee table"
+                })
+        report.flush()
+        log_with_time(f"Registering {len(work)} faces ({counts['skipped']} already done, {counts['failed']} rejected up front)")
+
+        index = None
+        if duplicate_check != "off":
+            if done and os.path.exists(face_index.index_path()):
+                # An interrupted run never reached the rebuild at its end, so
+                # the faces it registered are missing from the index
+                face_index.build_from_db(cursor, EMBEDDING_DIM, MODEL_NAME)
+            index = face_index.load_or_build(cursor, EMBEDDING_DIM, MODEL_NAME)
+        # Faces accepted earlier in this run, checked alongside the index
+        run_vectors = np.empty((len(work), EMBEDDING_DIM), dtype=np.float32)
+        run_ids = np.empty(len(work), dtype=np.int64)
+        run_count = 0
+
+        chunk = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(extract, [image for _, image in work], chunksize=4)
+            for (user_id, image), (encoding, crop, error) in zip(work, results):
+                if error is not None:
+                    emit(user_id, image, {"success": False, "error": error})
+                    continue
+                if len(encoding) != EMBEDDING_DIM:
+                    emit(user_id, image, {"success": False, "error": f"Unexpected encoding dimension: {len(encoding)}"})
+                    continue
+
+                conflicts = []
+                vector = normalize(encoding)
+                if index is not None and vector is not None:
+                    conflicts = face_index.find_conflicts(index, encoding, user_id, DUPLICATE_IDENTITY_THRESHOLD)
+                    distances = 1.0 - run_vectors[:run_count] @ vector
+                    for i in np.flatnonzero(distances < DUPLICATE_IDENTITY_THRESHOLD):
+                        conflicts.append({
+                            "user_id": int(run_ids[i]),
+                            "distance": float(distances[i]),
+                            "similarity": float(1.0 - distances[i])
+                        })
+                    conflicts.sort(key=lambda c: c["distance"])
+                    if conflicts and duplicate_check == "reject":
+                        emit(user_id, image, {
+                            "success": False,
+                            "error": f"Face already registered to employee {conflicts[0]['user_id']}",
+                            "conflicts": conflicts
+                        })
+                        continue
+                    run_vectors[run_count] = vector
+                    run_ids[run_count] = user_id
+                    run_count += 1
+
+                chunk.append((user_id, image, encode_embedding(encoding, MODEL_NAME), conflicts, crop))
+                if len(chunk) >= chunk_size:
+                    flush_chunk(conn, cursor, chunk, with_face_data, emit)
+                    report.flush()
+                    log_with_time(f"Registered {counts['registered']} / {len(work)}")
+                    chunk = []
+            if chunk:
+                flush_chunk(conn, cursor, chunk, with_face_data, emit)
+
+        if counts["registered"] and os.path.exists(face_index.index_path()):
+            face_index.build_from_db(cursor, EMBEDDING_DIM, MODEL_NAME)
+    finally:
+        cursor.close()
+        report.close()
+
+    return counts
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Register faces for many employees from a manifest")
+    parser.add_argument("manifest", help="CSV of user_id,image_path rows, or a directory of <user_id> images")
+    parser.add_argument("--report", default="bulk_register_report.jsonl", help="per-row JSON lines; reused to resume")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 1) // 2))
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="rows per transaction")
+    parser.add_argument("--retry-failed", action="store_true", help="retry rows the report lists as failed")
+    parser.add_argument("--duplicate-check", choices=DUPLICATE_CHECK_MODES, default=DUPLICATE_CHECK,
+                        help="search other employees (and earlier manifest rows) for the same face")
+    args = parser.parse_args()
+
+    load_dotenv()
+    # Split cores between the worker processes before any of them loads TensorFlow
+    from face_pool import configure_threads
+    configure_threads(args.workers)
+
+    rows = read_manifest(args.manifest)
+    conn = face_db.connect()
+    try:
+        result = bulk_register(
+            conn, rows, args.report, args.workers, args.chunk_size, args.retry_failed, args.duplicate_check
+        )
+        print(json.dumps(dict(result, report=args.report)))
+    finally:
+        conn.close()
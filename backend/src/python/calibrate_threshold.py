@@ -0,0 +1,199 @@
+# CALIBRATE_THRESHOLD.PY - pick MATCH_THRESHOLD from genuine/impostor distances
+#
+#   python calibrate_threshold.py [--target-far 0.0001] [--curve curve.csv]
+#   python calibrate_threshold.py --dataset embeddings.npz
+#   python calibrate_threshold.py --dataset photos/
+#   python calibrate_threshold.py --snapshot
+#
+# Without --dataset every embedding in face_data is used, labelled by
+# employeeID: pairs of templates from the same employee are genuine, every
+# other pair is an impostor. A local dataset is either an .npz holding
+# "embeddings" (N, dim) and "labels" (N,) arrays, or a directory with one
+# sub-directory of images per person, embedded with the registration
+# pipeline. --snapshot reads the face_data embeddings from the local
+# memory-mapped copy (embedding_snapshot.py) instead of querying MySQL.
+#
+# All pairwise cosine distances are evaluated as (block x block) matrix
+# products over the normalized embeddings and binned straight into fixed
+# histograms, so memory stays at one tile no matter how many vectors there
+# are; 100k embeddings are ~5 billion pairs but never more than
+# --block^2 distances at once.
+#
+# Prints FAR/FRR at the current threshold, the equal error rate, and the
+# recommended threshold: the largest one whose FAR stays at or below
+# --target-far. Set it with FACE_MATCH_THRESHOLD.
+from dotenv import load_dotenv
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+from face_config import EMBEDDING_DIM, MODEL_NAME, MATCH_THRESHOLD
+from face_matcher import build_encoding_matrix
+from face_pipeline import log_with_time
+
+BIN_WIDTH = 0.001  # Cosine distance lies in [0, 2]
+NUM_BINS = int(round(2.0 / BIN_WIDTH))
+DEFAULT_BLOCK = 2048
+DEFAULT_TARGET_FAR = 1e-4
+CURVE_STEP = 0.01  # Thresholds listed in the JSON curve
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+def load_from_db():
+    """(normalized matrix, labels) for every face_data row"""
+    import face_db
+    conn = face_db.connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT employeeID, face_encoding, id FROM face_data")
+        rows = cursor.fetchall()
+        cursor.close()
+    finally:
+        conn.close()
+    matrix, records, skipped = build_encoding_matrix(rows, EMBEDDING_DIM, MODEL_NAME)
+    if any(skipped.values()):
+        log_with_time(f"Skipped rows: {skipped}")
+    return matrix, np.array([int(r[0]) for r in records], dtype=np.int64)
+
+def load_from_snapshot():
+    from embedding_snapshot import get_snapshot
+    vectors, employee_ids, _ = get_snapshot().live_rows()
+    return np.asarray(vectors), np.asarray(employee_ids)
+
+def normalize_rows(vectors, labels):
+    if len(labels) == 0:
+        return np.empty((0, EMBEDDING_DIM), dtype=np.float32), np.array([])
+    vectors = np.asarray(vectors, dtype=np.float32).reshape(len(labels), -1)
+    norms = np.linalg.norm(vectors, axis=1)
+    keep = norms > 0
+    return vectors[keep] / norms[keep, None], np.asarray(labels)[keep]
+
+def load_npz(path):
+    data = np.load(path, allow_pickle=False)
+    return normalize_rows(data["embeddings"], data["labels"])
+
+def load_image_dir(path):
+    """Embed <path>/<person>/<image> files with the registration pipeline"""
+    from register_face import extract_face_encoding
+    vectors, labels = [], []
+    for person in sorted(os.listdir(path)):
+        folder = os.path.join(path, person)
+        if not os.path.isdir(folder):
+            continue
+        for name in sorted(os.listdir(folder)):
+            if not name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            try:
+                vectors.append(extract_face_encoding(os.path.join(folder, name)))
+                labels.append(person)
+            except Exception as e:
+                log_with_time(f"Skipping {person}/{name}: {str(e)}")
+    return normalize_rows(vectors, labels)
+
+def pair_histograms(matrix, labels, block=DEFAULT_BLOCK):
+    """Histogram the distances of every unordered pair into genuine/impostor bins"""
+    # Integer labels so the per-tile comparison is a cheap broadcast
+    _, label_ids = np.unique(labels, return_inverse=True)
+    genuine = np.zeros(NUM_BINS, dtype=np.int64)
+    impostor = np.zeros(NUM_BINS, dtype=np.int64)
+    n = len(matrix)
+
+    for i in range(0, n, block):
+        rows = matrix[i:i + block]
+        row_labels = label_ids[i:i + block]
+        for j in range(i, n, block):
+            distances = 1.0 - rows @ matrix[j:j + block].T
+            bins = np.clip((distances / BIN_WIDTH).astype(np.int32), 0, NUM_BINS - 1)
+            same = row_labels[:, None] == label_ids[None, j:j + block]
+            if i == j:
+                # Diagonal tile: each pair once, no self-pairs
+                upper = np.triu(np.ones(same.shape, dtype=bool), k=1)
+                genuine += np.bincount(bins[same & upper], minlength=NUM_BINS)
+                impostor += np.bincount(bins[~same & upper], minlength=NUM_BINS)
+            else:
+                genuine += np.bincount(bins[same], minlength=NUM_BINS)
+                impostor += np.bincount(bins[~same], minlength=NUM_BINS)
+        log_with_time(f"Compared rows {min(i + block, n)} / {n}")
+    return genuine, impostor
+
+def error_rates(genuine, impostor):
+    """FAR and FRR for a threshold at each bin edge (a match is distance < threshold)"""
+    thresholds = np.arange(NUM_BINS + 1) * BIN_WIDTH
+    accepted_impostors = np.concatenate(([0], np.cumsum(impostor)))
+    accepted_genuine = np.concatenate(([0], np.cumsum(genuine)))
+    far = accepted_impostors / max(impostor.sum(), 1)
+    frr = 1.0 - accepted_genuine / max(genuine.sum(), 1)
+    return thresholds, far, frr
+
+def rates_at(thresholds, far, frr, threshold):
+    k = min(int(round(threshold / BIN_WIDTH)), len(thresholds) - 1)
+    return {"threshold": round(float(thresholds[k]), 4), "far": float(far[k]), "frr": float(frr[k])}
+
+def calibrate(matrix, labels, target_far=DEFAULT_TARGET_FAR, block=DEFAULT_BLOCK):
+    genuine, impostor = pair_histograms(matrix, labels, block)
+    thresholds, far, frr = error_rates(genuine, impostor)
+
+    eer_index = int(np.argmin(np.abs(far - frr)))
+    # FAR only grows with the threshold, so take the last edge within the target
+    within = np.flatnonzero(far <= target_far)
+    recommended = rates_at(thresholds, far, frr, thresholds[within[-1]] if len(within) else 0.0)
+    recommended["target_far"] = target_far
+
+    step = int(round(CURVE_STEP / BIN_WIDTH))
+    return {
+        "vectors": int(len(matrix)),
+        "identities": int(len(np.unique(labels))),
+        "genuine_pairs": int(genuine.sum()),
+        "impostor_pairs": int(impostor.sum()),
+        "current": rates_at(thresholds, far, frr, MATCH_THRESHOLD),
+        "eer": {
+            "threshold": round(float(thresholds[eer_index]), 4),
+            "rate": float((far[eer_index] + frr[eer_index]) / 2)
+        },
+        "recommended": recommended,
+        "curve": [
+            {"threshold": round(float(thresholds[k]), 4), "far": float(far[k]), "frr": float(frr[k])}
+            for k in range(0, len(thresholds), step)
+        ]
+    }, (thresholds, far, frr)
+
+def write_curve(path, thresholds, far, frr):
+    with open(path, "w") as f:
+        f.write("threshold,far,frr\n")
+        for t, a, r in zip(thresholds, far, frr):
+            f.write(f"{t:.4f},{a:.8g},{r:.8g}\n")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate the face match threshold from pairwise distances")
+    parser.add_argument("--dataset", help=".npz with embeddings/labels or a directory of <person>/<image> files "
+                                          "(default: every face_data row)")
+    parser.add_argument("--snapshot", action="store_true", help="read face_data embeddings from the local snapshot")
+    parser.add_argument("--target-far", type=float, default=DEFAULT_TARGET_FAR,
+                        help="highest acceptable false accept rate for the recommended threshold")
+    parser.add_argument("--block", type=int, default=DEFAULT_BLOCK, help="rows per distance tile")
+    parser.add_argument("--curve", help="write the full FAR/FRR curve to this CSV file")
+    args = parser.parse_args()
+
+    load_dotenv()
+    if args.snapshot:
+        matrix, labels = load_from_snapshot()
+    elif args.dataset is None:
+        matrix, labels = load_from_db()
+    elif os.path.isdir(args.dataset):
+        matrix, labels = load_image_dir(args.dataset)
+    else:
+        matrix, labels = load_npz(args.dataset)
+
+    if len(matrix) < 2:
+        print(json.dumps({"success": False, "error": "Need at least two embeddings to calibrate"}))
+        sys.exit(1)
+
+    result, (thresholds, far, frr) = calibrate(matrix, labels, args.target_far, args.block)
+    if result["genuine_pairs"] == 0:
+        log_with_time("No identity has more than one embedding; FRR is undefined")
+    if args.curve:
+        write_curve(args.curve, thresholds, far, frr)
+        result["curve_file"] = args.curve
+    print(json.dumps(dict(result, success=True)))
@@ -0,0 +1,133 @@
+# COMPACT_FACE_DATA.PY - shrink existing face_data rows to bounded template sets
+#
+#   python compact_face_data.py [--employee 12] [--max-templates 20] [--dry-run]
+#       [--notify /tmp/face.sock]
+#
+# For each employee all rows are decoded and the template rule from
+# face_templates.py is replayed oldest to newest; rows that don't survive
+# are deleted in one transaction per employee. Rows that can't be decoded
+# are left untouched. The identification index is rebuilt afterwards if one
+# has been built, and so is the embedding snapshot.
+#
+# Running workers cache templates per employee. With --notify (the socket
+# of face_pool.py or face_worker.py --socket) every employee that lost rows
+# is sent an "invalidate", so the workers stop scoring against deleted
+# templates and planning evictions of rows that are gone. Workers that
+# weren't notified keep them until FACE_CACHE_TTL runs out; restart them.
+from dotenv import load_dotenv
+import argparse
+import json
+import os
+
+import mysql.connector
+import numpy as np
+
+import embedding_snapshot
+import face_crops
+import face_db
+import face_index
+from face_config import EMBEDDING_DIM, MODEL_NAME
+from face_encoding_format import decode_stored_encoding
+from face_matcher import normalize
+from face_pipeline import log_with_time
+from face_templates import select_templates, MAX_TEMPLATES_PER_EMPLOYEE, DUPLICATE_DISTANCE
+
+def compact_employee(cursor, employee_id, max_templates, duplicate_distance):
+    """Return the face_data ids to delete for one employee"""
+    cursor.execute("""
+                   SELECT id, face_encoding
+                   FROM face_data
+                   WHERE employeeID = %s
+                   ORDER BY createdAt ASC, id ASC
+                   """, (employee_id,))
+    row_ids = []
+    vectors = []
+    for row_id, blob in cursor.fetchall():
+        try:
+            _, vector = decode_stored_encoding(blob, MODEL_NAME)
+        except Exception:
+            continue
+        vector = normalize(vector) if vector is not None and vector.shape == (EMBEDDING_DIM,) else None
+        if vector is None:
+            continue
+        row_ids.append(row_id)
+        vectors.append(vector)
+
+    if len(vectors) <= 1:
+        return []
+
+    keep = set(select_templates(np.vstack(vectors), max_templates, duplicate_distance))
+    return [row_id for i, row_id in enumerate(row_ids) if i not in keep]
+
+def notify_workers(socket_path, employee_ids):
+    """Have the workers behind a face_pool/face_worker socket drop the employees' cached templates"""
+    import socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        stream = sock.makefile("rwb")
+        for employee_id in employee_ids:
+            stream.write((json.dumps({"action": "invalidate", "employee_id": str(employee_id)}) + "\n").encode("utf-8"))
+        stream.flush()
+        for _ in employee_ids:
+            stream.readline()
+
+def compact(conn, employee_ids, max_templates, duplicate_distance, dry_run, notify=None):
+    """Compact the employees' rows; notify(employee_ids) is called with those that lost any"""
+    cursor = conn.cursor()
+    deleted = 0
+    changed = []
+    try:
+        if not employee_ids:
+            cursor.execute("SELECT DISTINCT employeeID FROM face_data")
+            employee_ids = [row[0] for row in cursor.fetchall()]
+
+        for employee_id in employee_ids:
+            to_delete = compact_employee(cursor, employee_id, max_templates, duplicate_distance)
+            if to_delete and not dry_run:
+                placeholders = ", ".join(["%s"] * len(to_delete))
+                cursor.execute(f"DELETE FROM face_data WHERE id IN ({placeholders})", to_delete)
+                conn.commit()
+                if face_crops.enabled():
+                    face_crops.delete_crops(to_delete)
+                changed.append(employee_id)
+            deleted += len(to_delete)
+            if to_delete:
+                log_with_time(f"Employee {employee_id}: removed {len(to_delete)} rows")
+
+        if changed and os.path.exists(face_index.index_path()):
+            face_index.build_from_db(cursor, EMBEDDING_DIM, MODEL_NAME)
+        snapshot = embedding_snapshot.get_snapshot()
+        if changed and snapshot.load() is not None:
+            # The sweep is what finds deleted rows
+            snapshot.refresh(cursor, sweep=True, wait=True)
+    except mysql.connector.Error:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    if changed and notify is not None:
+        try:
+            notify(changed)
+        except OSError as e:
+            log_with_time(f"Could not notify workers, restart them to drop deleted templates: {str(e)}")
+    return {"employees": len(employee_ids), "deleted": deleted, "dry_run": dry_run}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compact face_data to a bounded template set per employee")
+    parser.add_argument("--employee", type=int, action="append", help="only compact this employee (repeatable)")
+    parser.add_argument("--max-templates", type=int, default=MAX_TEMPLATES_PER_EMPLOYEE)
+    parser.add_argument("--duplicate-distance", type=float, default=DUPLICATE_DISTANCE)
+    parser.add_argument("--dry-run", action="store_true", help="report what would be deleted without deleting")
+    parser.add_argument("--notify", metavar="SOCKET",
+                        help="face_pool.py / face_worker.py socket whose workers should drop cached templates")
+    args = parser.parse_args()
+
+    load_dotenv()
+    conn = face_db.connect()
+    try:
+        notify = (lambda employee_ids: notify_workers(args.notify, employee_ids)) if args.notify else None
+        result = compact(conn, args.employee or [], args.max_templates, args.duplicate_distance, args.dry_run, notify)
+        print(json.dumps(result))
+    finally:
+        conn.close()
@@ -0,0 +1,129 @@
+# EMBEDDING_CACHE.PY - per-employee cache of decoded, normalized encodings
+#
+# Long-lived processes (face_worker.py) keep each employee's recent
+# encodings as a ready-to-score matrix, so verification skips both the
+# face_data SELECT and blob decoding. Writes update or invalidate entries
+# in the same process; FACE_CACHE_TTL bounds staleness from writes made by
+# other processes.
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_MAX_MB = 64
+DEFAULT_TTL_SECONDS = 300
+_RECORD_OVERHEAD_BYTES = 128  # Rough size of one (employeeID, None, createdAt, id) tuple
+
+class EmbeddingCache:
+    """LRU cache of per-employee encoding matrices with a memory cap"""
+
+    def __init__(self, max_bytes, ttl_seconds):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _entry_size(entry):
+        return entry["matrix"].nbytes + len(entry["records"]) * _RECORD_OVERHEAD_BYTES
+
+    def get(self, employee_id):
+        """Return the cached entry for an employee, or None"""
+        key = str(employee_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry["loaded_at"] > self.ttl_seconds:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, employee_id, matrix, records, skipped, records_checked):
+        """Cache an employee's matrix; records drop their blobs to save memory"""
+        key = str(employee_id)
+        entry = {
+            "matrix": matrix,
+            "records": [(r[0], None) + tuple(r[2:]) for r in records],
+            "skipped": skipped,
+            "records_checked": records_checked,
+            "loaded_at": time.monotonic()
+        }
+        size = self._entry_size(entry)
+        if size > self.max_bytes:
+            return entry
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = entry
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+        return entry
+
+    def prepend(self, employee_id, normalized_encoding, record, limit, evicted_row_id=None):
+        """Write-through for a new face_data row: add it as the most recent encoding.
+
+        evicted_row_id drops a template the write replaced.
+        """
+        key = str(employee_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            self.current_bytes -= self._entry_size(entry)
+            matrix = entry["matrix"]
+            records = entry["records"]
+            if evicted_row_id is not None:
+                keep = [i for i, r in enumerate(records) if len(r) < 4 or r[3] != evicted_row_id]
+                matrix = matrix[keep]
+                records = [records[i] for i in keep]
+            # Reuse the employeeID value as the database returned it
+            stored_id = records[0][0] if records else record[0]
+            vector = np.asarray(normalized_encoding, dtype=np.float32)[None, :]
+            entry["matrix"] = np.concatenate([vector, matrix])[:limit]
+            entry["records"] = ([(stored_id, None) + tuple(record[2:])] + records)[:limit]
+            entry["records_checked"] = len(entry["records"])
+            self.current_bytes += self._entry_size(entry)
+
+    def invalidate(self, employee_id):
+        with self.lock:
+            self._remove(str(employee_id))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= self._entry_size(entry)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "employees": len(self.entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+_encoding_cache = None
+
+def get_encoding_cache():
+    """Return the process-wide cache, created from FACE_CACHE_* settings on first use"""
+    global _encoding_cache
+    if _encoding_cache is None:
+        _encoding_cache = EmbeddingCache(
+            max_bytes=int(float(os.getenv("FACE_CACHE_MAX_MB", DEFAULT_MAX_MB)) * 1024 * 1024),
+            ttl_seconds=float(os.getenv("FACE_CACHE_TTL", DEFAULT_TTL_SECONDS))
+        )
+    return _encoding_cache
@@ -0,0 +1,398 @@
+# EMBEDDING_SNAPSHOT.PY - memory-mapped local copy of face_data embeddings
+#
+#   python embedding_snapshot.py refresh [--full] [--watch 5]
+#   python embedding_snapshot.py stats
+#
+# A read path that skips MySQL: the configured model's normalized vectors
+# as one contiguous float32 matrix, with employee ID, createdAt, face_data
+# id and a live flag as side arrays, all memory-mapped read-only. Every
+# worker on the host maps the same files, so they share one page-cached
+# copy instead of each holding its own. With FACE_MATCH_SOURCE=snapshot the
+# match path reads an employee's templates from here; employees missing
+# from it still fall back to a query.
+#
+# Refreshes are incremental. Rows past the (id, createdAt) high-water mark,
+# i.e. new templates and re-registrations, are decoded and appended, and a
+# replaced row's old slot is marked dead in place. The createdAt range
+# reaches REFRESH_OVERLAP_SECONDS back, so a row whose transaction committed
+# after rows with higher ids moved the marks on is still picked up. Deleted rows (evicted
+# templates, compaction) are found by a periodic id-only sweep. When a
+# quarter of the slots are dead the files are rewritten as a new generation.
+# A refresh takes an flock on the snapshot directory, so any number of
+# workers can call it and only one does the work. The incremental query
+# reads face_data by primary key and by createdAt, so face_data needs an
+# index on createdAt (the (employeeID, createdAt) one doesn't serve it).
+#
+# Layout in FACE_SNAPSHOT_DIR/<model>/:
+#   meta.json             count, generation and high-water mark
+#   vectors-<gen>.f32     (count, dim) float32
+#   employee_ids-<gen>.i8, created_at-<gen>.i8 (epoch seconds), row_ids-<gen>.i8
+#   live-<gen>.u1         1 for current rows, 0 for replaced or deleted ones
+from dotenv import load_dotenv
+import fcntl
+import json
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+import numpy as np
+
+from face_config import EMBEDDING_DIM, MODEL_NAME
+from face_matcher import build_encoding_matrix
+
+DEFAULT_SNAPSHOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'face_snapshot')
+DEFAULT_REFRESH_SECONDS = 5
+SWEEP_SECONDS = 60  # How often a refresh also looks for deleted rows
+REFRESH_OVERLAP_SECONDS = 120  # Longest insert transaction a refresh still catches
+REWRITE_DEAD_FRACTION = 0.25
+
+ARRAYS = {
+    "vectors": np.float32,
+    "employee_ids": np.int64,
+    "created_at": np.int64,
+    "row_ids": np.int64,
+    "live": np.uint8,
+}
+
+# What load() maps, published as one object so a reader never sees the
+# arrays of one generation with the ordering or meta of another
+_State = namedtuple("_State", ["meta", "arrays", "order", "sorted_ids", "mtime"])
+# order: row positions sorted by employee, newest first
+# sorted_ids: employee_ids in that order, for searchsorted
+
+def snapshot_dir(model_name=MODEL_NAME):
+    return os.path.join(os.getenv("FACE_SNAPSHOT_DIR", DEFAULT_SNAPSHOT_DIR), model_name)
+
+def _epoch(created_at):
+    return int(created_at.timestamp()) if created_at is not None else 0
+
+class EmbeddingSnapshot:
+    def __init__(self, path, model_name=MODEL_NAME, dim=EMBEDDING_DIM):
+        self.path = path
+        self.model_name = model_name
+        self.dim = dim
+        self._state = None
+
+    # Reading
+
+    def _file(self, name, generation):
+        ext = {"vectors": "f32", "live": "u1"}.get(name, "i8")
+        return os.path.join(self.path, f"{name}-{generation}.{ext}")
+
+    def _meta_path(self):
+        return os.path.join(self.path, "meta.json")
+
+    def _read_meta(self):
+        try:
+            with open(self._meta_path()) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def load(self):
+        """The mapped current files, or None; cheap when nothing changed since the last call"""
+        state = self._state
+        try:
+            mtime = os.stat(self._meta_path()).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        if state and mtime == state.mtime:
+            return state
+        meta = self._read_meta()
+        if meta is None or meta["dim"] != self.dim:
+            return None
+        if state and (meta["count"], meta["generation"]) == (state.meta["count"], state.meta["generation"]):
+            state = self._state = state._replace(meta=meta, mtime=mtime)  # Only the marks moved
+            return state
+
+        count, generation = meta["count"], meta["generation"]
+        arrays = {}
+        for name, dtype in ARRAYS.items():
+            shape = (count, self.dim) if name == "vectors" else (count,)
+            if count == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(self._file(name, generation), dtype=dtype, mode='r', shape=shape)
+        order = np.lexsort((-arrays["created_at"], arrays["employee_ids"]))
+        state = self._state = _State(meta, arrays, order, np.asarray(arrays["employee_ids"][order]), mtime)
+        return state
+
+    def employee_encodings(self, employee_id, limit):
+        """Entry shaped like the encoding cache's for an employee's newest live rows, or None"""
+        state = self.load()
+        if state is None:
+            return None
+        a = state.arrays
+        start, end = np.searchsorted(state.sorted_ids, [int(employee_id), int(employee_id) + 1])
+        rows = state.order[start:end]
+        rows = rows[a["live"][rows] == 1][:limit]
+        if len(rows) == 0:
+            return None
+        records = [
+            (int(a["employee_ids"][i]), None, datetime.fromtimestamp(int(a["created_at"][i])), int(a["row_ids"][i]))
+            for i in rows
+        ]
+        return {
+            "matrix": np.asarray(a["vectors"][rows]),
+            "records": records,
+            "skipped": {},
+            "records_checked": len(rows)
+        }
+
+    def live_rows(self):
+        """(vectors, employee_ids, row_ids) for every live row"""
+        state = self.load()
+        if state is None:
+            return np.empty((0, self.dim), dtype=np.float32), np.empty(0, np.int64), np.empty(0, np.int64)
+        a = state.arrays
+        live = np.flatnonzero(a["live"])
+        return a["vectors"][live], a["employee_ids"][live], a["row_ids"][live]
+
+    def stats(self):
+        state = self.load()
+        if state is None:
+            return {"path": self.path, "model": self.model_name, "built": False}
+        meta = state.meta
+        count = int(meta["count"])
+        live = int(np.count_nonzero(state.arrays["live"])) if count else 0
+        return {
+            "path": self.path,
+            "model": self.model_name,
+            "built": True,
+            "rows": live,
+            "dead_slots": count - live,
+            "generation": meta["generation"],
+            "high_water_id": meta["high_water_id"],
+            "refreshed_at": meta["refreshed_at"],
+            "size_mb": round(count * (self.dim * 4 + 25) / (1024 * 1024), 1)
+        }
+
+    # Writing
+
+    def seconds_since_refresh(self):
+        try:
+            return time.time() - os.stat(self._meta_path()).st_mtime
+        except FileNotFoundError:
+            return float("inf")
+
+    def _write_meta(self, meta):
+        meta = dict(meta, refreshed_at=datetime.now().isoformat(timespec="seconds"))
+        tmp_path = self._meta_path() + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._meta_path())
+        return meta
+
+    def _decode(self, rows):
+        """(id, employeeID, blob, createdAt) rows -> arrays of the ones with this model's vector"""
+        records = [(employee_id, blob, created_at, row_id) for row_id, employee_id, blob, created_at in rows]
+        matrix, kept, _ = build_encoding_matrix(records, self.dim, self.model_name)
+        return {
+            "vectors": matrix,
+            "employee_ids": np.array([r[0] for r in kept], dtype=np.int64),
+            "created_at": np.array([_epoch(r[2]) for r in kept], dtype=np.int64),
+            "row_ids": np.array([r[3] for r in kept], dtype=np.int64),
+            "live": np.ones(len(kept), dtype=np.uint8),
+        }
+
+    def _write_generation(self, arrays, generation, high_water_id, high_water_created):
+        for name, dtype in ARRAYS.items():
+            np.ascontiguousarray(arrays[name], dtype=dtype).tofile(self._file(name, generation))
+        return self._write_meta({
+            "model": self.model_name,
+            "dim": self.dim,
+            "generation": generation,
+            "count": int(len(arrays["row_ids"])),
+            "high_water_id": int(high_water_id),
+            "high_water_created": int(high_water_created),
+            "swept_at": time.time()
+        })
+
+    def _remove_generation(self, generation):
+        # Readers that still map these files keep them until they remap
+        for name in ARRAYS:
+            try:
+                os.remove(self._file(name, generation))
+            except FileNotFoundError:
+                pass
+
+    def _rebuild(self, cursor, old_meta=None, arrays=None):
+        """Write a new generation: all of face_data, or the live rows of `arrays`"""
+        generation = old_meta["generation"] + 1 if old_meta else 0
+        if arrays is None:
+            cursor.execute("SELECT id, employeeID, face_encoding, createdAt FROM face_data")
+            arrays = self._decode(cursor.fetchall())
+            high_water_id = int(arrays["row_ids"].max()) if len(arrays["row_ids"]) else 0
+            high_water_created = int(arrays["created_at"].max()) if len(arrays["created_at"]) else 0
+        else:
+            live = arrays["live"] == 1
+            arrays = {name: np.asarray(values)[live] for name, values in arrays.items()}
+            high_water_id, high_water_created = old_meta["high_water_id"], old_meta["high_water_created"]
+        meta = self._write_generation(arrays, generation, high_water_id, high_water_created)
+        if old_meta:
+            self._remove_generation(old_meta["generation"])
+        return meta
+
+    def _mark_dead(self, meta, positions):
+        if len(positions) == 0:
+            return
+        live = np.memmap(self._file("live", meta["generation"]), dtype=np.uint8, mode='r+', shape=(meta["count"],))
+        live[positions] = 0
+        live.flush()
+
+    def refresh(self, cursor, full=False, sweep=None, wait=False):
+        """Bring the snapshot up to date with face_data.
+
+        Returns a summary dict, or None if another process holds the
+        refresh lock (and wait is False).
+        """
+        os.makedirs(self.path, exist_ok=True)
+        fd = os.open(os.path.join(self.path, "lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            return self._refresh_locked(cursor, full, sweep)
+        finally:
+            os.close(fd)
+
+    def _refresh_locked(self, cursor, full, sweep):
+        meta = self._read_meta()
+        if full or meta is None or meta["dim"] != self.dim:
+            meta = self._rebuild(cursor, meta)
+            return {"rebuilt": True, "rows": meta["count"]}
+
+        count, generation = meta["count"], meta["generation"]
+        row_ids = np.fromfile(self._file("row_ids", generation), dtype=np.int64, count=count)
+        created = np.fromfile(self._file("created_at", generation), dtype=np.int64, count=count)
+        live = np.fromfile(self._file("live", generation), dtype=np.uint8, count=count)
+        live_positions = np.flatnonzero(live)
+        slot_of = dict(zip(row_ids[live_positions].tolist(), live_positions.tolist()))
+
+        # New rows and rows re-stamped by a re-registration. createdAt is
+        # stamped when a row is written, not when it commits, so a row with
+        # a lower id can become visible after higher ids moved the marks on;
+        # the createdAt range reaches back REFRESH_OVERLAP_SECONDS for those.
+        # Rows already held unchanged are skipped. An OR across id and
+        # createdAt can't use either index, so each condition is its own
+        # indexed range and UNION drops rows both of them return.
+        cursor.execute("""
+                       SELECT id, employeeID, face_encoding, createdAt
+                       FROM face_data
+                       WHERE id > %s
+                       UNION
+                       SELECT id, employeeID, face_encoding, createdAt
+                       FROM face_data
+                       WHERE createdAt >= %s
+                       """, (meta["high_water_id"],
+                             datetime.fromtimestamp(meta["high_water_created"] - REFRESH_OVERLAP_SECONDS)))
+        rows = cursor.fetchall()
+        fetched = []
+        dead = []
+        for row in rows:
+            slot = slot_of.get(row[0])
+            if slot is not None:
+                if created[slot] == _epoch(row[3]):
+                    continue
+                dead.append(slot)
+            fetched.append(row)
+
+        sweep = sweep if sweep is not None else time.time() - meta.get("swept_at", 0) >= SWEEP_SECONDS
+        if sweep:
+            cursor.execute("SELECT id FROM face_data")
+            existing = np.array([r[0] for r in cursor.fetchall()], dtype=np.int64)
+            gone = live_positions[~np.isin(row_ids[live_positions], existing)]
+            dead.extend(gone.tolist())
+            meta["swept_at"] = time.time()
+
+        added = self._decode(fetched)
+        self._mark_dead(meta, np.array(dead, dtype=np.int64))
+        if len(added["row_ids"]):
+            # Append to every side array, then publish the new count
+            for name, dtype in ARRAYS.items():
+                with open(self._file(name, generation), 'ab') as f:
+                    f.write(np.ascontiguousarray(added[name], dtype=dtype).tobytes())
+            meta["count"] = count + len(added["row_ids"])
+        if fetched:
+            # Rows without this model's vector move the marks on as well
+            meta["high_water_id"] = max(meta["high_water_id"], max(r[0] for r in rows))
+            meta["high_water_created"] = max(meta["high_water_created"], max(_epoch(r[3]) for r in rows))
+        meta = self._write_meta(meta)  # Its mtime tells other processes when the last refresh ran
+
+        dead_total = meta["count"] - (len(live_positions) - len(set(dead)) + len(added["row_ids"]))
+        if meta["count"] and dead_total / meta["count"] >= REWRITE_DEAD_FRACTION:
+            arrays = {
+                name: np.fromfile(self._file(name, meta["generation"]), dtype=dtype).reshape(
+                    (meta["count"], self.dim) if name == "vectors" else (meta["count"],))
+                for name, dtype in ARRAYS.items()
+            }
+            self._rebuild(cursor, meta, arrays)
+            return {"rebuilt": False, "compacted": True, "added": len(added["row_ids"]), "removed": len(set(dead))}
+        return {"rebuilt": False, "added": len(added["row_ids"]), "removed": len(set(dead))}
+
+_snapshot = None
+
+def get_snapshot():
+    """The process-wide snapshot of the configured model"""
+    global _snapshot
+    if _snapshot is None:
+        _snapshot = EmbeddingSnapshot(snapshot_dir())
+    return _snapshot
+
+def start_refresher(pool, interval=None):
+    """Refresh every interval seconds from a daemon thread, borrowing a pooled connection"""
+    interval = interval or float(os.getenv("FACE_SNAPSHOT_REFRESH_SECONDS", DEFAULT_REFRESH_SECONDS))
+    snapshot = get_snapshot()
+
+    def run():
+        while True:
+            try:
+                # Another worker on the host may have just done it
+                if snapshot.seconds_since_refresh() >= interval:
+                    with pool.connection() as db:
+                        snapshot.refresh(db.cursor())
+            except Exception as e:
+                print(f"Embedding snapshot refresh failed: {str(e)}", file=sys.stderr, flush=True)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name="snapshot-refresh", daemon=True)
+    thread.start()
+    return thread
+
+if __name__ == "__main__":
+    import argparse
+    import face_db
+
+    parser = argparse.ArgumentParser(description="Build or refresh the local embedding snapshot")
+    parser.add_argument("command", choices=["refresh", "stats"])
+    parser.add_argument("--full", action="store_true", help="rebuild from scratch")
+    parser.add_argument("--watch", type=float, default=0, help="keep refreshing every N seconds")
+    args = parser.parse_args()
+
+    load_dotenv()
+    snapshot = get_snapshot()
+    if args.command == "stats":
+        print(json.dumps(snapshot.stats()))
+        sys.exit(0)
+
+    conn = face_db.connect()
+    try:
+        full = args.full
+        while True:
+            cursor = conn.cursor()
+            try:
+                result = snapshot.refresh(cursor, full=full, wait=True)
+            finally:
+                cursor.close()
+            conn.commit()  # End the read transaction so the next refresh sees new rows
+            print(json.dumps(dict(result, **snapshot.stats())), flush=True)
+            if not args.watch:
+                break
+            full = False
+            time.sleep(args.watch)
+    finally:
+        conn.close()
@@ -0,0 +1,93 @@
+# FACE_BATCHER.PY - micro-batching of model calls for concurrent requests
+#
+# Requests submit one item each; the batcher collects whatever arrives
+# within window_ms (up to max_batch_size), runs a single batched call in a
+# dedicated thread and fans the results back out to each caller.
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_WINDOW_MS = 5
+DEFAULT_MAX_BATCH_SIZE = 16
+
+class MicroBatcher:
+    """Collects items for batch_fn, which maps a list of items to a list of results"""
+
+    def __init__(self, batch_fn, window_ms=DEFAULT_WINDOW_MS, max_batch_size=DEFAULT_MAX_BATCH_SIZE):
+        self.batch_fn = batch_fn
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self.queue = None
+        self.task = None
+        # One model thread: batches run back to back, never concurrently
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="batcher")
+        self.batches = 0
+        self.items = 0
+        self.busy_seconds = 0.0
+
+    def start(self):
+        """Start the collector on the running event loop"""
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.executor.shutdown(wait=True)
+
+    async def submit(self, item):
+        """Queue one item and wait for its result"""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def _collect(self):
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            items = [item for item, _ in batch]
+            started = time.monotonic()
+            try:
+                results = await loop.run_in_executor(self.executor, self.batch_fn, items)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finally:
+                self.busy_seconds += time.monotonic() - started
+                self.batches += 1
+                self.items += len(batch)
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+            "fill_rate": self.items / (self.batches * self.max_batch_size) if self.batches else 0.0,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "window_ms": self.window * 1000.0,
+            "max_batch_size": self.max_batch_size,
+            "queue_depth": self.queue.qsize() if self.queue else 0
+        }
@@ -0,0 +1,497 @@
+# FACE_BENCH.PY - end-to-end benchmark of the register/match/identify pipelines
+#
+#   python face_bench.py --images samples/ [--corpus 20,1000,100000]
+#       [--concurrency 1,4] [--requests 40] [--out bench_results.json]
+#       [--baseline previous.json] [--tolerance 0.2] [--traces traces.jsonl]
+#       [--photo-size 4032]
+#
+# The pipelines run exactly as the scripts do, but against a SQLite stand-in
+# for MySQL with the face_data/employee schema, so no database server is
+# needed. For each corpus size the table is filled with that many random
+# stored embeddings, then one probe employee per sample face is registered
+# and matched; identify searches the whole corpus. The requests are
+# synthetic variants of the sample faces (rescaled, relit, flipped and
+# re-encoded at random JPEG qualities).
+#
+# Stage latencies come from each request's face_trace spans (decode, resize,
+# quick_check, detect, antispoof, embed, db_fetch, deserialize, compare,
+# db_write, ...). The report has p50/p95/p99 per stage and the throughput at each concurrency level. It is
+# written as JSON, and with --baseline any stage whose p50 got slower by
+# more than --tolerance is listed as a regression (exit status 1).
+#
+# Before the corpus runs each sample face is also blown up to a phone-sized
+# JPEG (--photo-size on the long side, 0 to skip) and taken through the
+# image stages with and without adaptive decoding (reduced-scale JPEG decode
+# plus face-size-aware detection region, face_pipeline.py). The "decode"
+# section reports the preprocessing time of both and how far each one's
+# encoding lands from the sample's own, so a faster decode that costs match
+# accuracy shows up. FACE_ADAPTIVE_DECODE=0 runs the whole benchmark the old
+# way, for a --baseline comparison. The "liveness" section compares the
+# anti-spoofing scores of faces found through the quick-check region with a
+# full-frame detection of the same photo; a differing decision fails the run.
+# The "embedding_parity" section embeds each sample face through every
+# embedding path and fails the run if one lands below 0.99 cosine
+# similarity to DeepFace.represent(img_path=...) on the same image.
+from dotenv import load_dotenv
+import argparse
+import json
+import os
+import platform
+import queue
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+import face_index
+import face_pipeline
+import face_trace
+import match_face
+import register_face
+from embedding_cache import get_encoding_cache
+from face_config import EMBEDDING_DIM, MODEL_NAME, INFERENCE_BACKEND, MATCH_THRESHOLD, DETECTOR_BACKEND
+from face_db import STATEMENTS
+from face_encoding_format import encode_embedding
+from face_pipeline import log_with_time
+from face_templates import MAX_TEMPLATES_PER_EMPLOYEE
+
+DEFAULT_CORPUS_SIZES = "20,1000,100000"
+DEFAULT_CONCURRENCY = "1,4"
+DEFAULT_REQUESTS = 40
+DEFAULT_TOLERANCE = 0.2
+PERCENTILES = (50, 95, 99)
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+DEFAULT_PHOTO_SIZE = 4032  # Long side of a 12 MP phone photo
+DECODE_REPEATS = 5
+EMBEDDING_PARITY_MIN = 0.99  # Cosine similarity every embedding path must reach
+
+SCHEMA = """
+    CREATE TABLE employee (id INTEGER PRIMARY KEY);
+    CREATE TABLE face_data (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        employeeID INTEGER NOT NULL,
+        face_encoding BLOB NOT NULL,
+        createdAt TIMESTAMP NOT NULL
+    );
+    CREATE INDEX face_data_employee ON face_data (employeeID, createdAt);
+    CREATE INDEX face_data_created ON face_data (createdAt);
+"""
+
+sqlite3.register_converter("TIMESTAMP", lambda value: datetime.fromisoformat(value.decode()))
+
+class SqliteFaceDb:
+    """SQLite stand-in for face_db.FaceDb, running the same named statements"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.statements = {
+            name: sql.replace("%s", "?").replace("NOW()", "CURRENT_TIMESTAMP").replace(" FOR UPDATE", "")
+            for name, sql in STATEMENTS.items()
+        }
+
+    def execute(self, name, params=()):
+        return self.conn.execute(self.statements[name], params)
+
+    def query(self, name, params=()):
+        return self.execute(name, params).fetchall()
+
+    def cursor(self):
+        return self.conn.cursor()
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+class SqlitePool:
+    """Stand-in for face_db.FaceDbPool over one SQLite file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.idle = queue.LifoQueue()
+
+    @contextmanager
+    def connection(self):
+        try:
+            db = self.idle.get_nowait()
+        except queue.Empty:
+            conn = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES
+            )
+            db = SqliteFaceDb(conn)
+        try:
+            yield db
+        finally:
+            db.rollback()
+            self.idle.put(db)
+
+    def stats(self):
+        return {"backend": "sqlite", "idle": self.idle.qsize()}
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().conn.close()
+            except queue.Empty:
+                break
+
+def create_database(path, corpus_size, probe_count, rng):
+    """Fill face_data with corpus_size random templates; returns the probe employee ids"""
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+
+    stored_employees = max(1, -(-corpus_size // MAX_TEMPLATES_PER_EMPLOYEE))
+    probe_ids = list(range(stored_employees + 1, stored_employees + probe_count + 1))
+    conn.executemany("INSERT INTO employee (id) VALUES (?)", [(i,) for i in range(1, probe_ids[-1] + 1)])
+
+    batch_size = 10000
+    for start in range(0, corpus_size, batch_size):
+        count = min(batch_size, corpus_size - start)
+        vectors = rng.standard_normal((count, EMBEDDING_DIM)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        conn.executemany(
+            "INSERT INTO face_data (employeeID, face_encoding, createdAt) VALUES (?, ?, CURRENT_TIMESTAMP)",
+            [(1 + (start + i) % stored_employees, encode_embedding(vector, MODEL_NAME))
+             for i, vector in enumerate(vectors)]
+        )
+    conn.commit()
+    conn.close()
+    return probe_ids
+
+def load_seed_images(path):
+    if os.path.isdir(path):
+        files = sorted(
+            os.path.join(path, name) for name in os.listdir(path)
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+    else:
+        files = [path]
+    seeds = [image for image in (cv2.imread(f) for f in files) if image is not None]
+    if not seeds:
+        raise ValueError(f"No readable images in {path}")
+    return seeds
+
+def synthetic_variant(seed, rng):
+    """Rescale, relight, maybe flip and JPEG re-encode a seed image"""
+    scale = rng.uniform(0.6, 1.6)
+    image = cv2.resize(seed, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+    image = cv2.convertScaleAbs(image, alpha=rng.uniform(0.8, 1.2), beta=rng.uniform(-20, 20))
+    if rng.random() < 0.5:
+        image = cv2.flip(image, 1)
+    ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, int(rng.integers(70, 96))])
+    return encoded.tobytes()
+
+def phone_photo(seed, photo_size):
+    """The seed scaled up to a phone-sized JPEG, the face keeping its share of the frame"""
+    scale = photo_size / max(seed.shape[:2])
+    image = cv2.resize(seed, None, fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
+    ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return encoded.tobytes()
+
+def cosine_distance(a, b):
+    a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    return float(1.0 - a @ b / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+def bench_decode(seeds, photo_size):
+    """Preprocessing time and match distance of phone photos, full vs adaptive decode"""
+    photos = [phone_photo(seed, photo_size) for seed in seeds]
+    references = []
+    for seed in seeds:
+        try:
+            references.append(register_face.extract_face_encoding(seed))
+        except ValueError as e:
+            references.append(None)
+            log_with_time(f"Sample face not usable as a reference: {str(e)}")
+
+    modes = {}
+    encodings = {}
+    configured = face_pipeline.ADAPTIVE_DECODE_ENABLED
+    for mode, adaptive in (("full", False), ("adaptive", True)):
+        face_pipeline.ADAPTIVE_DECODE_ENABLED = adaptive
+        preprocess_ms, capture_ms, distances = [], [], []
+        encodings[mode] = []
+        for photo, reference in zip(photos, references):
+            for _ in range(DECODE_REPEATS):
+                start = time.perf_counter()
+                face_pipeline.preprocess_image(photo)
+                preprocess_ms.append((time.perf_counter() - start) * 1000)
+            start = time.perf_counter()
+            try:
+                encoding = register_face.extract_face_encoding(photo)
+            except ValueError:
+                encoding = None
+            capture_ms.append((time.perf_counter() - start) * 1000)
+            encodings[mode].append(encoding)
+            if encoding is not None and reference is not None:
+                distances.append(cosine_distance(encoding, reference))
+        modes[mode] = {
+            "preprocess_ms": {f"p{p}": round(float(np.percentile(preprocess_ms, p)), 2) for p in PERCENTILES},
+            "capture_ms": {f"p{p}": round(float(np.percentile(capture_ms, p)), 2) for p in PERCENTILES},
+            "faces_found": sum(1 for e in encodings[mode] if e is not None),
+            "matched": sum(1 for d in distances if d < MATCH_THRESHOLD),
+            "mean_distance": round(float(np.mean(distances)), 4) if distances else None
+        }
+    face_pipeline.ADAPTIVE_DECODE_ENABLED = configured
+
+    between = [cosine_distance(a, b) for a, b in zip(encodings["full"], encodings["adaptive"])
+               if a is not None and b is not None]
+    full_p50 = modes["full"]["preprocess_ms"]["p50"]
+    return dict(
+        modes,
+        photo_size=photo_size,
+        photos=len(photos),
+        preprocess_speedup=round(full_p50 / max(modes["adaptive"]["preprocess_ms"]["p50"], 1e-3), 2),
+        max_distance_between_modes=round(max(between), 4) if between else None
+    )
+
+def bench_liveness(seeds, photo_size):
+    """Liveness scores of the quick-check region path against a full-frame detection.
+
+    Both paths score anti-spoofing on the full processed frame, so their
+    scores should agree; a decision that differs is reported as a mismatch.
+    """
+    deltas, mismatches, roi_faces = [], [], 0
+    for i, seed in enumerate(seeds):
+        photo = phone_photo(seed, photo_size) if photo_size else cv2.imencode(".jpg", seed)[1].tobytes()
+        frame = face_pipeline.preprocess_image(photo)
+        try:
+            before = face_pipeline.cascade_stats()["roi_used"]
+            located = face_pipeline.locate_faces(frame, source=photo)
+            used_roi = face_pipeline.cascade_stats()["roi_used"] > before
+            full = face_pipeline.detect_faces(frame)
+        except ValueError:
+            continue
+        if not used_roi or len(located) != 1 or len(full) != 1:
+            continue
+        roi_faces += 1
+        deltas.append(abs(located[0]["antispoof_score"] - full[0]["antispoof_score"]))
+        if located[0]["is_real"] != full[0]["is_real"]:
+            mismatches.append(i)
+    return {
+        "faces": roi_faces,
+        "max_score_delta": round(max(deltas), 4) if deltas else None,
+        "decision_mismatches": mismatches
+    }
+
+def bench_embedding_parity(seeds):
+    """Cosine similarity of each embedding path to DeepFace.represent(img_path=...).
+
+    The legacy call detects and embeds in one go; embed_face_deepface,
+    embed_faces_batch and embed_crops (a stored crop) must agree with it to
+    EMBEDDING_PARITY_MIN, or the paths disagree on channel order or
+    preprocessing and their templates won't match each other.
+    """
+    from deepface import DeepFace
+    from face_crops import to_crop
+
+    similarities = {"embed_face_deepface": [], "embed_faces_batch": [], "embed_crops": []}
+    for seed in seeds:
+        try:
+            legacy = DeepFace.represent(img_path=seed, model_name=MODEL_NAME, detector_backend=DETECTOR_BACKEND)
+            faces = face_pipeline.detect_faces(seed)
+        except ValueError:
+            continue
+        if len(legacy) != 1 or len(faces) != 1:
+            continue
+        reference = legacy[0]["embedding"]
+        candidates = {
+            "embed_face_deepface": face_pipeline.embed_face_deepface(faces[0]),
+            "embed_faces_batch": face_pipeline.embed_faces_batch(faces)[0],
+            "embed_crops": face_pipeline.embed_crops(to_crop(faces[0]["face"])[np.newaxis])[0]
+        }
+        for path, embedding in candidates.items():
+            similarities[path].append(1.0 - cosine_distance(embedding, reference))
+    report = {
+        path: round(min(values), 4) if values else None for path, values in similarities.items()
+    }
+    return {
+        "faces": len(similarities["embed_face_deepface"]),
+        "min_similarity": report,
+        "threshold": EMBEDDING_PARITY_MIN,
+        "passed": all(value is None or value >= EMBEDDING_PARITY_MIN for value in report.values())
+    }
+
+class TraceCollector:
+    """Keeps the last finished request trace of each thread"""
+
+    def __init__(self):
+        self.local = threading.local()
+        face_trace.add_listener(self.collect)
+
+    def collect(self, trace):
+        self.local.last = trace
+
+    def last(self):
+        return self.local.last
+
+def run_request(pipeline, pool, collector, image, employee_id):
+    if pipeline == "register":
+        response, _ = register_face.register_face(image, employee_id)
+        ok = response.get("success", False)
+    else:
+        with pool.connection() as db:
+            if pipeline == "match":
+                response, _ = match_face.match_face(image, str(employee_id), db)
+            else:
+                response, _ = match_face.identify_face(image, db, match_face.IDENTIFY_TOP_K)
+        ok = response.get("matched", False)
+    trace = collector.last()
+    sample = trace.stage_totals()
+    sample["total"] = trace.duration_ms
+    return sample, ok
+
+def summarize(samples):
+    stages = {}
+    for stage in sorted({k for sample in samples for k in sample}):
+        values = [sample[stage] for sample in samples if stage in sample]
+        stages[stage] = {f"p{p}": round(float(np.percentile(values, p)), 2) for p in PERCENTILES}
+    return stages
+
+def run_level(pipeline, pool, collector, workload, concurrency):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(
+            lambda item: run_request(pipeline, pool, collector, *item), workload
+        ))
+    wall = time.perf_counter() - start
+    samples = [sample for sample, _ in results]
+    return {
+        "requests": len(results),
+        "ok": sum(1 for _, ok in results if ok),
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(results) / wall, 2),
+        "stages_ms": summarize(samples)
+    }
+
+def bench_corpus(corpus_size, seeds, concurrency_levels, request_count, rng, collector, workdir):
+    db_path = os.path.join(workdir, f"face_data_{corpus_size}.sqlite3")
+    os.environ["FACE_INDEX_PATH"] = os.path.join(workdir, f"face_index_{corpus_size}.npz")
+    log_with_time(f"Populating SQLite stand-in with {corpus_size} stored embeddings")
+    probe_ids = create_database(db_path, corpus_size, len(seeds), rng)
+    get_encoding_cache().clear()
+
+    import face_db
+    pool = SqlitePool(db_path)
+    face_db._pool = pool  # register_face borrows connections through get_pool()
+
+    results = []
+    try:
+        for pipeline in ("register", "match", "identify"):
+            if pipeline == "identify":
+                # Build the index up front so runs measure searches, not the first build
+                with pool.connection() as db:
+                    face_index.load_or_build(db.cursor(), EMBEDDING_DIM, MODEL_NAME)
+            for concurrency in concurrency_levels:
+                workload = []
+                for i in range(request_count):
+                    seed_index = i % len(seeds)
+                    workload.append((synthetic_variant(seeds[seed_index], rng), probe_ids[seed_index]))
+                log_with_time(f"Corpus {corpus_size}: {pipeline} x{request_count} at concurrency {concurrency}")
+                result = run_level(pipeline, pool, collector, workload, concurrency)
+                results.append(dict(result, pipeline=pipeline, corpus=corpus_size, concurrency=concurrency))
+    finally:
+        pool.close()
+        face_db._pool = None
+    return results
+
+def compare(results, baseline, tolerance):
+    """Stages whose p50 got slower than the baseline run by more than tolerance"""
+    previous = {
+        (r["pipeline"], r["corpus"], r["concurrency"]): r["stages_ms"] for r in baseline["results"]
+    }
+    regressions = []
+    for result in results:
+        before = previous.get((result["pipeline"], result["corpus"], result["concurrency"]))
+        if not before:
+            continue
+        for stage, now in result["stages_ms"].items():
+            if stage in before and before[stage]["p50"] > 0 and now["p50"] > before[stage]["p50"] * (1 + tolerance):
+                regressions.append({
+                    "pipeline": result["pipeline"], "corpus": result["corpus"],
+                    "concurrency": result["concurrency"], "stage": stage,
+                    "baseline_p50_ms": before[stage]["p50"], "p50_ms": now["p50"]
+                })
+    return regressions
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the face pipelines against a SQLite stand-in")
+    parser.add_argument("--images", required=True, help="sample face image, or a directory of them")
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS_SIZES, help="comma separated stored-embedding counts")
+    parser.add_argument("--concurrency", default=DEFAULT_CONCURRENCY, help="comma separated thread counts")
+    parser.add_argument("--requests", type=int, default=DEFAULT_REQUESTS, help="requests per pipeline and level")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--traces", help="also append every request trace to this file")
+    parser.add_argument("--photo-size", type=int, default=DEFAULT_PHOTO_SIZE,
+                        help="long side of the phone photos for the decode comparison, 0 to skip it")
+    args = parser.parse_args()
+
+    load_dotenv()
+    rng = np.random.default_rng(args.seed)
+    seeds = load_seed_images(args.images)
+    corpus_sizes = [int(v) for v in args.corpus.split(",")]
+    concurrency_levels = [int(v) for v in args.concurrency.split(",")]
+
+    # Traces feed the stage timings; only write them out when asked to
+    os.environ["FACE_TRACE"] = args.traces or "off"
+    # Requests replay the same probe images; measure the pipeline, not the result cache
+    os.environ["FACE_RESULT_CACHE_TTL"] = "0"
+    collector = TraceCollector()
+    decode = None
+    if args.photo_size:
+        log_with_time(f"Comparing full and adaptive decoding of {len(seeds)} photos at {args.photo_size} px")
+        decode = bench_decode(seeds, args.photo_size)
+    log_with_time("Comparing liveness scores of the quick-check region and the full frame")
+    liveness = bench_liveness(seeds, args.photo_size)
+    log_with_time("Comparing every embedding path with DeepFace.represent")
+    embedding_parity = bench_embedding_parity(seeds)
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="face_bench_") as workdir:
+        for corpus_size in corpus_sizes:
+            results += bench_corpus(
+                corpus_size, seeds, concurrency_levels, args.requests, rng, collector, workdir
+            )
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "inference_backend": INFERENCE_BACKEND,
+        "model": MODEL_NAME,
+        "seed_images": len(seeds),
+        "decode": decode,
+        "liveness": liveness,
+        "embedding_parity": embedding_parity,
+        "results": results
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = compare(results, json.load(f), args.tolerance)
+
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps({"out": args.out, "runs": len(results), "regressions": len(report.get("regressions", []))}))
+    failed = liveness["decision_mismatches"] or not embedding_parity["passed"]
+    sys.exit(1 if report.get("regressions") or failed else 0)
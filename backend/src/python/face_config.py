@@ -0,0 +1,31 @@
+# FACE_CONFIG.PY - settings shared by the face scripts and offline jobs
+#
+# Kept free of heavy imports so DB-only tools can use it without loading
+# DeepFace or OpenCV. The .env file is loaded here, before the settings
+# below are read, since the scripts import this before their main block runs.
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DETECTOR_BACKEND = 'mtcnn'  # Better speed/accuracy balance than retinaface
+# Embedding model for new encodings and for matching. Stored vectors are
+# tagged with their model and only same-model vectors are compared, so a
+# switch is staged with reembed_faces.py instead of re-registering everyone.
+MODEL_DIMENSIONS = {'Facenet': 128, 'Facenet512': 512}
+MODEL_NAME = os.getenv("FACE_MODEL_NAME", "Facenet")
+EMBEDDING_DIM = MODEL_DIMENSIONS[MODEL_NAME]
+# 'deepface' (TensorFlow/PyTorch) or 'onnx' (ONNX Runtime, see face_onnx.py)
+INFERENCE_BACKEND = os.getenv("FACE_INFERENCE_BACKEND", "deepface")
+# Cosine distance below which a probe counts as the same person; pick it
+# with calibrate_threshold.py against the stored templates
+MATCH_THRESHOLD = float(os.getenv("FACE_MATCH_THRESHOLD", 0.25))
+# Where the match path reads stored templates: 'mysql', or 'snapshot' for
+# the shared memory-mapped copy kept by embedding_snapshot.py
+MATCH_SOURCE = os.getenv("FACE_MATCH_SOURCE", "mysql")
+# Registration search for the same face under another employee ID:
+# 'off', 'warn' (store and report conflicts) or 'reject'
+DUPLICATE_CHECK_MODES = ("off", "warn", "reject")
+DUPLICATE_CHECK = os.getenv("FACE_DUPLICATE_CHECK", "off")
+DUPLICATE_IDENTITY_THRESHOLD = float(os.getenv("FACE_DUPLICATE_THRESHOLD", MATCH_THRESHOLD))
@@ -0,0 +1,284 @@
+# FACE_CROPS.PY - store of aligned face crops, keyed by face_data row
+#
+#   python face_crops.py stats
+#   python face_crops.py compact      # drop replaced and deleted crops
+#
+# With FACE_CROP_DIR set, register_face.py, match_face.py and
+# bulk_register_faces.py keep the aligned crop behind every stored template,
+# so later reprocessing (a new model with reembed_faces.py, a new
+# anti-spoofing version, threshold audits) starts from the crops instead of
+# decoding uploads and running detection again.
+#
+# Layout in FACE_CROP_DIR:
+#   crops-00000.u8   raw CROP_SIZE x CROP_SIZE x 3 uint8 RGB crops, back to
+#                    back, up to CHUNK_CROPS per file; memory-mapped read-only
+#   index.bin        append-only (row_id int64, chunk int32, slot int32)
+#                    records, the latest one per row wins; chunk -1 marks a
+#                    deleted crop
+#
+# Writers append under an flock on the directory, so several workers can
+# share one store. Readers map the chunks once and batch jobs stream crops
+# in storage order with iter_crop_batches, straight into embed_crops.
+import fcntl
+import json
+import os
+import re
+import sys
+from contextlib import contextmanager
+
+import numpy as np
+
+CROP_SIZE = 160  # Facenet and Facenet512 input size
+CROP_SHAPE = (CROP_SIZE, CROP_SIZE, 3)
+CROP_BYTES = CROP_SIZE * CROP_SIZE * 3
+CHUNK_CROPS = 2048  # ~150 MB per chunk file
+DELETED = -1
+COMPACT_BATCH = 256  # Crops copied per read during compaction
+
+_INDEX_RECORD = np.dtype([('row_id', '<i8'), ('chunk', '<i4'), ('slot', '<i4')])
+_CHUNK_NAME = re.compile(r'^crops-(\d+)\.u8$')
+
+def crop_dir():
+    return os.getenv("FACE_CROP_DIR") or None
+
+def enabled():
+    return crop_dir() is not None
+
+def to_crop(face):
+    """Aligned extract_faces crop (RGB, 0-1 floats, any size) -> uint8 CROP_SIZE square"""
+    import cv2
+    face = np.clip(np.asarray(face, dtype=np.float32) * 255, 0, 255).astype(np.uint8)
+    if face.shape[:2] != (CROP_SIZE, CROP_SIZE):
+        interpolation = cv2.INTER_AREA if face.shape[0] > CROP_SIZE else cv2.INTER_LINEAR
+        face = cv2.resize(face, (CROP_SIZE, CROP_SIZE), interpolation=interpolation)
+    return face
+
+def crop_to_face(crop):
+    """Stored crop -> the RGB 0-1 float layout of an extract_faces crop"""
+    return crop.astype(np.float32) / 255.0
+
+class CropStore:
+    def __init__(self, path):
+        self.path = path
+        self.maps = {}  # chunk -> read-only memmap
+        self.index_id = None  # (inode, size) of the index read so far
+        self.records = np.empty(0, dtype=_INDEX_RECORD)
+        self.live = None
+
+    def _chunk_path(self, chunk):
+        return os.path.join(self.path, f"crops-{chunk:05d}.u8")
+
+    def _index_path(self):
+        return os.path.join(self.path, "index.bin")
+
+    def _chunks(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(int(m.group(1)) for m in map(_CHUNK_NAME.match, os.listdir(self.path)) if m)
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(self.path, exist_ok=True)
+        fd = os.open(os.path.join(self.path, "lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _truncate_torn(path, record_size):
+        """Drop a partial record left by a crashed writer; returns the whole-record count"""
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size % record_size:
+            os.truncate(path, size - size % record_size)
+        return size // record_size
+
+    def _append_index(self, records):
+        self._truncate_torn(self._index_path(), _INDEX_RECORD.itemsize)
+        with open(self._index_path(), 'ab') as f:
+            f.write(np.array(records, dtype=_INDEX_RECORD).tobytes())
+
+    def _write_crops(self, crops, chunk, slot):
+        """Append crops from (chunk, slot) on; returns their (chunk, slot) locations"""
+        locations = []
+        f = open(self._chunk_path(chunk), 'ab')
+        try:
+            for crop in crops:
+                if slot >= CHUNK_CROPS:
+                    f.close()
+                    chunk, slot = chunk + 1, 0
+                    f = open(self._chunk_path(chunk), 'ab')
+                crop = np.ascontiguousarray(crop, dtype=np.uint8)
+                if crop.shape != CROP_SHAPE:
+                    raise ValueError(f"Crop must be {CROP_SHAPE}, got {crop.shape}")
+                f.write(crop.tobytes())
+                locations.append((chunk, slot))
+                slot += 1
+        finally:
+            f.close()
+        return locations
+
+    def save_many(self, items):
+        """Store [(row_id, uint8 crop)], replacing earlier crops of the same rows"""
+        if not items:
+            return
+        with self._locked():
+            chunks = self._chunks()
+            chunk = chunks[-1] if chunks else 0
+            slot = self._truncate_torn(self._chunk_path(chunk), CROP_BYTES)
+            locations = self._write_crops([crop for _, crop in items], chunk, slot)
+            self._append_index([(int(row_id), c, s) for (row_id, _), (c, s) in zip(items, locations)])
+
+    def delete(self, row_ids):
+        if not row_ids:
+            return
+        with self._locked():
+            self._append_index([(int(row_id), DELETED, DELETED) for row_id in row_ids])
+
+    def _refresh_index(self):
+        """Read index records appended since the last call, or all after a compaction"""
+        try:
+            st = os.stat(self._index_path())
+            inode, size = st.st_ino, st.st_size - st.st_size % _INDEX_RECORD.itemsize
+        except FileNotFoundError:
+            inode, size = None, 0
+        if self.index_id == (inode, size) and self.live is not None:
+            return
+        read_from = self.index_id[1] if self.index_id and self.index_id[0] == inode else 0
+        if read_from == 0:
+            # New or compacted (replaced) index: start over
+            self.records = np.empty(0, dtype=_INDEX_RECORD)
+            self.maps.clear()
+        if size > read_from:
+            with open(self._index_path(), 'rb') as f:
+                f.seek(read_from)
+                tail = np.frombuffer(f.read(size - read_from), dtype=_INDEX_RECORD)
+            self.records = np.concatenate([self.records, tail])
+        self.index_id = (inode, size)
+        # Keep each row's last record: unique() on the reversed log finds it first
+        latest = self.records[::-1]
+        _, first = np.unique(latest['row_id'], return_index=True)
+        latest = latest[first]
+        self.live = latest[latest['chunk'] != DELETED]
+
+    def locations(self):
+        """Live (row_id, chunk, slot) records, one per row, sorted by row_id"""
+        self._refresh_index()
+        return self.live
+
+    def _chunk(self, chunk, slots=0):
+        """Read-only map of a chunk holding at least `slots` crops"""
+        mapped = self.maps.get(chunk)
+        if mapped is None or len(mapped) < slots:
+            count = os.path.getsize(self._chunk_path(chunk)) // CROP_BYTES
+            mapped = np.memmap(self._chunk_path(chunk), dtype=np.uint8, mode='r', shape=(count,) + CROP_SHAPE)
+            self.maps[chunk] = mapped
+        return mapped
+
+    def read(self, located):
+        """(n, CROP_SIZE, CROP_SIZE, 3) crops for records sorted by (chunk, slot)"""
+        if len(located) == 0:
+            return np.empty((0,) + CROP_SHAPE, dtype=np.uint8)
+        parts = []
+        for chunk in np.unique(located['chunk']):
+            slots = located['slot'][located['chunk'] == chunk]
+            parts.append(self._chunk(int(chunk), int(slots.max()) + 1)[slots])
+        return np.concatenate(parts)
+
+    def iter_batches(self, row_ids=None, batch_size=64):
+        """Yield (row_ids, uint8 crop batch) in storage order, for all rows or the given ones"""
+        live = self.locations()
+        if row_ids is not None:
+            live = live[np.isin(live['row_id'], np.asarray(list(row_ids), dtype=np.int64))]
+        live = live[np.lexsort((live['slot'], live['chunk']))]
+        for start in range(0, len(live), batch_size):
+            part = live[start:start + batch_size]
+            yield part['row_id'].tolist(), self.read(part)
+
+    def stats(self):
+        chunks = self._chunks()
+        slots = sum(os.path.getsize(self._chunk_path(c)) // CROP_BYTES for c in chunks)
+        live = len(self.locations())
+        return {
+            "path": self.path,
+            "crops": live,
+            "dead_slots": slots - live,
+            "chunks": len(chunks),
+            "size_mb": round(slots * CROP_BYTES / (1024 * 1024), 1)
+        }
+
+    def compact(self):
+        """Rewrite live crops into fresh chunks and drop the rest"""
+        with self._locked():
+            old_chunks = self._chunks()
+            live = self.locations()
+            live = live[np.lexsort((live['slot'], live['chunk']))]
+            chunk, slot = (old_chunks[-1] + 1 if old_chunks else 0), 0
+            records = []
+            for start in range(0, len(live), COMPACT_BATCH):
+                part = live[start:start + COMPACT_BATCH]
+                locations = self._write_crops(self.read(part), chunk, slot)
+                records += [(int(r), c, s) for r, (c, s) in zip(part['row_id'], locations)]
+                chunk, slot = locations[-1][0], locations[-1][1] + 1
+
+            tmp_path = self._index_path() + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(np.array(records, dtype=_INDEX_RECORD).tobytes())
+            os.replace(tmp_path, self._index_path())
+            # Readers that mapped an old chunk keep it until they let go
+            for c in old_chunks:
+                os.remove(self._chunk_path(c))
+            self.maps.clear()
+        return self.stats()
+
+_store = None
+
+def get_store():
+    """The process-wide store for FACE_CROP_DIR"""
+    global _store
+    if _store is None or _store.path != crop_dir():
+        _store = CropStore(crop_dir())
+    return _store
+
+def save_crop(row_id, crop):
+    """Store the uint8 crop for a face_data row, replacing any earlier one"""
+    get_store().save_many([(row_id, crop)])
+
+def save_crops(items):
+    get_store().save_many(items)
+
+def delete_crops(row_ids):
+    get_store().delete(row_ids)
+
+def load_crops(row_ids):
+    """{row_id: uint8 crop} for the rows that have one"""
+    if not enabled():
+        return {}
+    crops = {}
+    for ids, batch in get_store().iter_batches(row_ids, CHUNK_CROPS):
+        crops.update(zip(ids, batch))
+    return crops
+
+def iter_crop_batches(row_ids=None, batch_size=64):
+    """Stream (row_ids, uint8 crop batch) in storage order"""
+    if not enabled():
+        return iter(())
+    return get_store().iter_batches(row_ids, batch_size)
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    if not enabled():
+        print(json.dumps({"success": False, "error": "FACE_CROP_DIR is not set"}))
+        sys.exit(1)
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    if command == "stats":
+        print(json.dumps(get_store().stats()))
+    elif command == "compact":
+        print(json.dumps(get_store().compact()))
+    else:
+        print(f"Unknown command: {command}", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,250 @@
+# FACE_DB.PY - pooled MySQL access for face_data
+#
+# One bounded pool per process, shared by every request in a long-lived
+# worker (a plain script run just uses one connection from it). Connections
+# are health-checked with a ping when they have been idle, and reconnected
+# or replaced if the server dropped them. The hot statements run as
+# server-side prepared statements, prepared once per connection.
+# mysql.connector is imported on first use so importing this module is free.
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_ACQUIRE_TIMEOUT = 10
+IDLE_PING_SECONDS = 30  # Ping connections that have been idle longer than this
+
+# Hot statements; each gets its own prepared cursor per connection
+STATEMENTS = {
+    "recent_encodings": """
+        SELECT employeeID, face_encoding, createdAt, id
+        FROM face_data
+        WHERE employeeID = %s
+        ORDER BY createdAt DESC
+            LIMIT %s
+    """,
+    "recent_encodings_for_update": """
+        SELECT employeeID, face_encoding, createdAt, id
+        FROM face_data
+        WHERE employeeID = %s
+        ORDER BY createdAt DESC
+            LIMIT %s
+        FOR UPDATE
+    """,
+    "insert_encoding": """
+        INSERT INTO face_data (employeeID, face_encoding, createdAt)
+        VALUES (%s, %s, NOW())
+    """,
+    "update_template": """
+        UPDATE face_data
+        SET face_encoding = %s, createdAt = NOW()
+        WHERE id = %s
+    """,
+    "delete_template": "DELETE FROM face_data WHERE id = %s AND employeeID = %s",
+    "employee_exists": "SELECT id FROM employee WHERE id = %s",
+    "employee_face_rows": "SELECT id FROM face_data WHERE employeeID = %s ORDER BY id FOR UPDATE",
+}
+
+def db_config():
+    """Connection settings from the .env file"""
+    return {
+        "host": os.getenv("DB_HOST"),
+        "user": os.getenv("DB_USER"),
+        "password": os.getenv("DB_PASS"),
+        "database": os.getenv("DB_DATABASE"),
+        "autocommit": False,
+    }
+
+def connect():
+    """Open a standalone MySQL connection (for one-off tools)"""
+    import mysql.connector
+    return mysql.connector.connect(**db_config())
+
+class FaceDb:
+    """A pooled connection with per-statement prepared cursors"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.statements = {}
+        self.plain_cursor = None
+        self.last_used = time.monotonic()
+
+    def execute(self, name, params=()):
+        """Run a named statement and return its cursor (for lastrowid/rowcount)"""
+        cursor = self.statements.get(name)
+        if cursor is None:
+            cursor = self.conn.cursor(prepared=True)
+            self.statements[name] = cursor
+        cursor.execute(STATEMENTS[name], params)
+        return cursor
+
+    def query(self, name, params=()):
+        """Run a named SELECT and return all rows"""
+        return self.execute(name, params).fetchall()
+
+    def cursor(self):
+        """A regular cursor for ad-hoc SQL on this connection"""
+        if self.plain_cursor is None:
+            self.plain_cursor = self.conn.cursor()
+        return self.plain_cursor
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def is_healthy(self):
+        """Ping idle connections, reconnecting once if the server went away"""
+        if time.monotonic() - self.last_used < IDLE_PING_SECONDS:
+            return True
+        import mysql.connector
+        before = self.conn.connection_id
+        try:
+            self.conn.ping(reconnect=True, attempts=2, delay=1)
+        except mysql.connector.Error:
+            return False
+        # Prepared statements don't survive a reconnect; a plain ping keeps them
+        if before is None or self.conn.connection_id != before:
+            self.reset_cursors()
+        return True
+
+    def reset_cursors(self):
+        import mysql.connector
+        for cursor in self.statements.values():
+            try:
+                cursor.close()
+            except mysql.connector.Error:
+                pass
+        self.statements = {}
+        self.plain_cursor = None
+
+    def close(self):
+        import mysql.connector
+        self.reset_cursors()
+        try:
+            self.conn.close()
+        except mysql.connector.Error:
+            pass
+
+class FaceDbPool:
+    """Bounded pool of FaceDb connections, opened lazily"""
+
+    def __init__(self, size=DEFAULT_POOL_SIZE, acquire_timeout=DEFAULT_ACQUIRE_TIMEOUT):
+        self.size = size
+        self.acquire_timeout = acquire_timeout
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.in_use = 0
+        self.waits = 0
+        self.reconnects = 0
+
+    def _open(self):
+        """Connect a new FaceDb for a slot already counted in opened"""
+        try:
+            return FaceDb(connect())
+        except Exception:
+            with self.lock:
+                self.opened -= 1
+            raise
+
+    def acquire(self):
+        with self.lock:
+            can_open = self.opened < self.size and self.idle.empty()
+            if can_open:
+                self.opened += 1  # Reserve the slot before connecting
+        if can_open:
+            db = self._open()
+        else:
+            try:
+                db = self.idle.get_nowait()
+            except queue.Empty:
+                with self.lock:
+                    self.waits += 1
+                try:
+                    db = self.idle.get(timeout=self.acquire_timeout)
+                except queue.Empty:
+                    raise TimeoutError("Timed out waiting for a database connection")
+
+            if not db.is_healthy():
+                db.close()
+                with self.lock:
+                    self.reconnects += 1
+                db = self._open()
+
+        with self.lock:
+            self.in_use += 1
+        return db
+
+    def release(self, db, broken=False):
+        import mysql.connector
+        with self.lock:
+            self.in_use -= 1
+        if broken:
+            db.close()
+            with self.lock:
+                self.opened -= 1
+            return
+        try:
+            # Never hand the next request someone else's open transaction
+            if db.conn.in_transaction:
+                db.rollback()
+        except mysql.connector.Error:
+            db.close()
+            with self.lock:
+                self.opened -= 1
+            return
+        db.last_used = time.monotonic()
+        self.idle.put(db)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a request"""
+        import mysql.connector
+        db = self.acquire()
+        broken = False
+        try:
+            yield db
+        except (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError):
+            # Lost connection mid-request: don't return it to the pool
+            broken = True
+            raise
+        finally:
+            self.release(db, broken)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": self.size,
+                "opened": self.opened,
+                "in_use": self.in_use,
+                "idle": self.idle.qsize(),
+                "waits": self.waits,
+                "reconnects": self.reconnects
+            }
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self.lock:
+            self.opened = self.in_use
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Return the process-wide pool, sized by FACE_DB_POOL_SIZE on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = FaceDbPool(
+                size=int(os.getenv("FACE_DB_POOL_SIZE", DEFAULT_POOL_SIZE)),
+                acquire_timeout=float(os.getenv("FACE_DB_ACQUIRE_TIMEOUT", DEFAULT_ACQUIRE_TIMEOUT))
+            )
+        return _pool
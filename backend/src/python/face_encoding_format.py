@@ -0,0 +1,124 @@
+# FACE_ENCODING_FORMAT.PY - binary layout for face_data.face_encoding
+#
+# Layout (all little-endian):
+#   magic       2 bytes   b'FE'
+#   version     uint8     1
+#   dim         uint16    embedding dimension
+#   name_len    uint8     length of the model name
+#   model_name  name_len bytes, ascii
+#   vector      dim * float32
+#
+# Version 2 carries one vector per model, so a row can hold the old and the
+# new model's embedding side by side while reembed_faces.py migrates a site:
+#   magic       2 bytes   b'FE'
+#   version     uint8     2
+#   count       uint8     number of embeddings
+#   count times: dim uint16, name_len uint8, model_name, dim * float32
+#
+# The vector decodes zero-copy with np.frombuffer. Rows written before this
+# format (pickled numpy arrays, comma separated or JSON strings) are still
+# readable through decode_stored_encoding until they are migrated with
+# migrate_face_encodings.py; they always came from LEGACY_MODEL_NAME.
+import json
+import pickle
+import struct
+
+import numpy as np
+
+FORMAT_MAGIC = b'FE'
+FORMAT_VERSION = 1
+MULTI_FORMAT_VERSION = 2
+LEGACY_MODEL_NAME = 'Facenet'
+_HEADER = struct.Struct('<2sBHB')
+_MULTI_HEADER = struct.Struct('<2sBB')
+_SECTION = struct.Struct('<HB')
+_DTYPE = np.dtype('<f4')
+
+def encode_embedding(embedding, model_name):
+    """Serialize an embedding to the versioned float32 format"""
+    vector = np.asarray(embedding, dtype=_DTYPE).ravel()
+    name = model_name.encode('ascii')
+    return _HEADER.pack(FORMAT_MAGIC, FORMAT_VERSION, vector.shape[0], len(name)) + name + vector.tobytes()
+
+def encode_embeddings(embeddings):
+    """Serialize {model_name: embedding}; a single model keeps the version 1 layout"""
+    if len(embeddings) == 1:
+        (model_name, embedding), = embeddings.items()
+        return encode_embedding(embedding, model_name)
+    parts = [_MULTI_HEADER.pack(FORMAT_MAGIC, MULTI_FORMAT_VERSION, len(embeddings))]
+    for model_name, embedding in embeddings.items():
+        vector = np.asarray(embedding, dtype=_DTYPE).ravel()
+        name = model_name.encode('ascii')
+        parts.append(_SECTION.pack(vector.shape[0], len(name)) + name + vector.tobytes())
+    return b''.join(parts)
+
+def is_encoded(blob):
+    return isinstance(blob, (bytes, bytearray, memoryview)) and bytes(blob[:2]) == FORMAT_MAGIC
+
+def decode_embedding(blob):
+    """Return (model_name, vector) for a blob in the binary format.
+
+    The vector is a read-only float32 view over the blob, no copy is made.
+    """
+    magic, version, dim, name_len = _HEADER.unpack_from(blob, 0)
+    if magic != FORMAT_MAGIC:
+        raise ValueError("Not a face encoding blob")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported face encoding version: {version}")
+    offset = _HEADER.size + name_len
+    model_name = bytes(blob[_HEADER.size:offset]).decode('ascii')
+    if len(blob) - offset != dim * _DTYPE.itemsize:
+        raise ValueError(f"Truncated face encoding: expected {dim} values")
+    return model_name, np.frombuffer(blob, dtype=_DTYPE, count=dim, offset=offset)
+
+def decode_embeddings(blob):
+    """Return {model_name: vector} for a blob in either binary version"""
+    magic, version, count = _MULTI_HEADER.unpack_from(blob, 0)
+    if magic != FORMAT_MAGIC:
+        raise ValueError("Not a face encoding blob")
+    if version == FORMAT_VERSION:
+        model_name, vector = decode_embedding(blob)
+        return {model_name: vector}
+    if version != MULTI_FORMAT_VERSION:
+        raise ValueError(f"Unsupported face encoding version: {version}")
+
+    embeddings = {}
+    offset = _MULTI_HEADER.size
+    for _ in range(count):
+        dim, name_len = _SECTION.unpack_from(blob, offset)
+        offset += _SECTION.size
+        model_name = bytes(blob[offset:offset + name_len]).decode('ascii')
+        offset += name_len
+        if len(blob) - offset < dim * _DTYPE.itemsize:
+            raise ValueError(f"Truncated face encoding: expected {dim} values")
+        embeddings[model_name] = np.frombuffer(blob, dtype=_DTYPE, count=dim, offset=offset)
+        offset += dim * _DTYPE.itemsize
+    return embeddings
+
+def decode_legacy_encoding(blob):
+    """Decode the pre-format storage: pickled arrays or text encodings"""
+    if isinstance(blob, (bytes, bytearray)):
+        return np.asarray(pickle.loads(blob), dtype=np.float64)
+    # Fallback for string format (if migrating from old system)
+    try:
+        return np.array([float(x) for x in blob.split(',')])
+    except ValueError:
+        return np.array(json.loads(blob))
+
+def stored_embeddings(blob):
+    """Return {model_name: vector} for any face_encoding value"""
+    if is_encoded(blob):
+        return decode_embeddings(blob)
+    return {LEGACY_MODEL_NAME: decode_legacy_encoding(blob)}
+
+def decode_stored_encoding(blob, model_name=None):
+    """Return (model_name, vector) for any face_encoding value.
+
+    With model_name only that model's vector is returned, and vector is None
+    when the row has none, so callers never compare across models. Without
+    it the row's first embedding is returned.
+    """
+    embeddings = stored_embeddings(blob)
+    if model_name is None:
+        return next(iter(embeddings.items()))
+    return model_name, embeddings.get(model_name)
@@ -0,0 +1,346 @@
+# FACE_INDEX.PY - 1:N identification index over face_data embeddings
+#
+# A pure-NumPy IVF (inverted file) index: embeddings are clustered with
+# spherical k-means and a query only scores the clusters closest to it.
+#
+#   python face_index.py build     # rebuild from face_data and persist
+#   python face_index.py stats
+#
+# The index lives in FACE_INDEX_PATH (an .npz snapshot) plus an append-only
+# log next to it; models other than Facenet get their own snapshot
+# (face_index.Facenet512.npz) so a model migration never mixes vectors. Inserts from register_face.py and match_face.py are
+# appended to the log as fixed-size records, so they are cheap and safe from
+# concurrent processes; loading replays the log on top of the snapshot.
+from dotenv import load_dotenv
+import json
+import os
+import struct
+import sys
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+from face_config import MODEL_NAME
+from face_encoding_format import LEGACY_MODEL_NAME
+from face_matcher import build_encoding_matrix, normalize
+
+DEFAULT_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'face_index.npz')
+DEFAULT_NPROBE = 8
+CONFLICT_NPROBE = 16  # Duplicate-identity checks look at more lists than identification
+KMEANS_ITERATIONS = 10
+MIN_LIST_SIZE = 64  # Below this many vectors per list, brute force is cheaper
+
+OP_ADD = 1
+OP_REMOVE_EMPLOYEE = 2
+OP_REMOVE_ROW = 3
+_LOG_HEADER = struct.Struct('<bqq')
+
+# One consistent set of row arrays; replaced as a whole so a search running
+# alongside a replay never pairs vectors with another version's ids
+_Rows = namedtuple("_Rows", ["vectors", "row_ids", "employee_ids", "lists"])
+
+def index_path(model_name=MODEL_NAME):
+    path = os.getenv("FACE_INDEX_PATH", DEFAULT_INDEX_PATH)
+    if model_name != LEGACY_MODEL_NAME:
+        root, ext = os.path.splitext(path)
+        path = f"{root}.{model_name}{ext}"
+    return path
+
+def _log_path(path):
+    return path + '.log'
+
+def _spherical_kmeans(vectors, nlist, iterations=KMEANS_ITERATIONS, seed=0):
+    """Cluster unit vectors by cosine similarity, returning unit centroids"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        norms = np.linalg.norm(sums, axis=1)
+        filled = norms > 0
+        # Keep the old centroid for clusters that ended up empty
+        centroids[filled] = sums[filled] / norms[filled, None]
+    return centroids
+
+class FaceIndex:
+    """Inverted-file index of normalized embeddings keyed by face_data row"""
+
+    def __init__(self, dim, centroids=None):
+        self.dim = dim
+        self.centroids = centroids if centroids is not None else np.empty((0, dim), dtype=np.float32)
+        self.rows = _Rows(
+            np.empty((0, dim), dtype=np.float32), np.empty(0, dtype=np.int64),
+            np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
+        )
+        self.log_offset = 0  # Bytes of the append log already applied
+
+    @property
+    def vectors(self):
+        return self.rows.vectors
+
+    @property
+    def row_ids(self):
+        return self.rows.row_ids
+
+    @property
+    def employee_ids(self):
+        return self.rows.employee_ids
+
+    @property
+    def lists(self):
+        return self.rows.lists
+
+    def __len__(self):
+        return len(self.rows.row_ids)
+
+    @classmethod
+    def build(cls, row_ids, employee_ids, vectors, dim):
+        """Cluster normalized vectors into roughly sqrt(N) inverted lists"""
+        index = cls(dim)
+        if len(vectors):
+            nlist = max(1, min(int(np.sqrt(len(vectors))), len(vectors) // MIN_LIST_SIZE))
+            index.centroids = _spherical_kmeans(vectors, nlist).astype(np.float32)
+        index._append(np.asarray(row_ids, dtype=np.int64), np.asarray(employee_ids, dtype=np.int64), vectors)
+        return index
+
+    def _assign(self, vectors):
+        if len(self.centroids) == 0:
+            return np.zeros(len(vectors), dtype=np.int32)
+        return np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+
+    def _append(self, row_ids, employee_ids, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        rows = self.rows
+        self.rows = _Rows(
+            np.concatenate([rows.vectors, vectors]),
+            np.concatenate([rows.row_ids, row_ids]),
+            np.concatenate([rows.employee_ids, employee_ids]),
+            np.concatenate([rows.lists, self._assign(vectors)])
+        )
+
+    def _keep(self, keep):
+        self.rows = _Rows(*(values[keep] for values in self.rows))
+
+    def add(self, row_id, employee_id, vector):
+        """Add one normalized vector, ignoring rows the index already holds"""
+        if np.any(self.row_ids == row_id):
+            return
+        self._append(np.array([row_id], dtype=np.int64), np.array([employee_id], dtype=np.int64), vector)
+
+    def remove_employee(self, employee_id):
+        self._keep(self.employee_ids != employee_id)
+
+    def remove_rows(self, row_ids):
+        self._keep(~np.isin(self.row_ids, row_ids))
+
+    def search(self, normalized_probe, top_k=5, nprobe=DEFAULT_NPROBE, exclude_employee=None):
+        """Return the top_k closest employees as dicts with cosine distances.
+
+        Each employee appears once, with the distance of its closest row.
+        """
+        rows = self.rows  # Searched as one consistent version
+        candidates = np.arange(len(rows.row_ids))
+        if len(self.centroids) > nprobe:
+            nearest_lists = np.argsort(-(self.centroids @ normalized_probe))[:nprobe]
+            candidates = np.flatnonzero(np.isin(rows.lists, nearest_lists))
+        if exclude_employee is not None:
+            candidates = candidates[rows.employee_ids[candidates] != exclude_employee]
+        if len(candidates) == 0:
+            return []
+
+        distances = 1.0 - rows.vectors[candidates] @ normalized_probe
+        order = np.argsort(distances)
+        ranked = candidates[order]
+        # First occurrence of each employee in distance order is its best row
+        _, first = np.unique(rows.employee_ids[ranked], return_index=True)
+        best = np.sort(first)[:top_k]
+
+        return [
+            {
+                "user_id": int(rows.employee_ids[ranked[i]]),
+                "distance": float(distances[order[i]]),
+                "similarity": float(1.0 - distances[order[i]]),
+                "face_data_id": int(rows.row_ids[ranked[i]])
+            }
+            for i in best
+        ]
+
+    def save(self, path):
+        """Write the snapshot atomically"""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, dim=self.dim, centroids=self.centroids, **self.rows._asdict())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load the snapshot and replay the append log on top of it"""
+        with np.load(path) as data:
+            index = cls(int(data["dim"]), data["centroids"])
+            index.rows = _Rows(*(data[name] for name in _Rows._fields))
+        index._replay(_log_path(path))
+        return index
+
+    def _replay(self, log_path):
+        """Apply log records written since the last replay.
+
+        Callers sharing an index serialize this (see load_or_build), so no
+        two replays read the same records and advance log_offset twice.
+        """
+        if not os.path.exists(log_path):
+            return
+        record_size = _LOG_HEADER.size + self.dim * 4
+        with open(log_path, 'rb') as f:
+            f.seek(self.log_offset)
+            data = f.read()
+        complete = len(data) - len(data) % record_size
+
+        # Batch consecutive adds so replay does one concatenate per run
+        pending = []
+        def flush():
+            if not pending:
+                return
+            row_ids = np.array([p[0] for p in pending], dtype=np.int64)
+            employee_ids = np.array([p[1] for p in pending], dtype=np.int64)
+            _, first = np.unique(row_ids, return_index=True)
+            fresh = np.zeros(len(row_ids), dtype=bool)
+            fresh[first] = True
+            fresh &= ~np.isin(row_ids, self.row_ids)
+            vectors = np.vstack([p[2] for p in pending])
+            self._append(row_ids[fresh], employee_ids[fresh], vectors[fresh])
+            pending.clear()
+
+        # A partially written final record is left for the next replay
+        for start in range(0, complete, record_size):
+            op, row_id, employee_id = _LOG_HEADER.unpack_from(data, start)
+            if op == OP_ADD:
+                vector = np.frombuffer(data, dtype='<f4', count=self.dim, offset=start + _LOG_HEADER.size)
+                pending.append((row_id, employee_id, vector))
+            elif op == OP_REMOVE_EMPLOYEE:
+                flush()
+                self.remove_employee(employee_id)
+            elif op == OP_REMOVE_ROW:
+                flush()
+                self.remove_rows([row_id])
+        flush()
+        self.log_offset += complete
+
+def _append_log(op, row_id, employee_id, vector, dim, path=None):
+    path = path or index_path()
+    # Without a snapshot there is nothing to keep current; the next build
+    # picks the row up from face_data
+    if not os.path.exists(path):
+        return
+    record = _LOG_HEADER.pack(op, row_id, employee_id) + np.asarray(vector, dtype='<f4').tobytes()
+    # O_APPEND keeps each fixed-size record intact across concurrent writers
+    fd = os.open(_log_path(path), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, record)
+    finally:
+        os.close(fd)
+
+def record_insert(row_id, employee_id, encoding, path=None):
+    """Append a newly inserted face_data row to the persisted index"""
+    vector = normalize(encoding)
+    if vector is not None:
+        _append_log(OP_ADD, int(row_id), int(employee_id), vector, len(vector), path)
+
+def record_delete(row_id, dim, path=None):
+    """Drop a deleted face_data row from the persisted index"""
+    _append_log(OP_REMOVE_ROW, int(row_id), 0, np.zeros(dim, dtype=np.float32), dim, path)
+
+def record_replace(employee_id, row_id, encoding, path=None):
+    """Replace every indexed row of an employee with one new encoding"""
+    vector = normalize(encoding)
+    if vector is None:
+        return
+    _append_log(OP_REMOVE_EMPLOYEE, 0, int(employee_id), np.zeros_like(vector), len(vector), path)
+    _append_log(OP_ADD, int(row_id), int(employee_id), vector, len(vector), path)
+
+def find_conflicts(index, encoding, employee_id, threshold, top_k=3):
+    """Other employees with a template within threshold of the encoding"""
+    vector = normalize(encoding)
+    if vector is None:
+        return []
+    return [
+        {"user_id": c["user_id"], "distance": c["distance"], "similarity": c["similarity"]}
+        for c in index.search(vector, top_k, CONFLICT_NPROBE, exclude_employee=int(employee_id))
+        if c["distance"] < threshold
+    ]
+
+def build_from_db(cursor, dim, model_name=None, path=None):
+    """Rebuild the index from every face_data row and persist it"""
+    path = path or index_path(model_name or MODEL_NAME)
+    log_path = _log_path(path)
+    # Rotate the log first so inserts made during the rebuild survive it
+    if os.path.exists(log_path):
+        os.replace(log_path, log_path + '.old')
+
+    cursor.execute("SELECT employeeID, face_encoding, id FROM face_data")
+    matrix, kept_records, skipped = build_encoding_matrix(cursor.fetchall(), dim, model_name)
+    index = FaceIndex.build(
+        [r[2] for r in kept_records], [r[0] for r in kept_records], matrix, dim
+    )
+    index.save(path)
+
+    if os.path.exists(log_path + '.old'):
+        os.remove(log_path + '.old')
+    return index, skipped
+
+# Index kept by long-lived processes, with the snapshot mtime it came from.
+# Request threads (face_worker --batch) load and replay it under _load_lock.
+_loaded = {"path": None, "mtime": None, "index": None}
+_load_lock = threading.Lock()
+
+def load_or_build(cursor, dim, model_name=None, path=None):
+    """Return the persisted index, building it from face_data the first time.
+
+    Within one process the loaded index is reused; later calls only replay
+    new log records, or reload if the snapshot was rebuilt.
+    """
+    path = path or index_path(model_name or MODEL_NAME)
+    with _load_lock:
+        if not os.path.exists(path):
+            build_from_db(cursor, dim, model_name, path)
+
+        mtime = os.path.getmtime(path)
+        if _loaded["path"] == path and _loaded["mtime"] == mtime:
+            _loaded["index"]._replay(_log_path(path))
+        else:
+            _loaded.update(path=path, mtime=mtime, index=FaceIndex.load(path))
+            if _loaded["index"].dim != dim:
+                # Snapshot written for another model; never search across models
+                index, _ = build_from_db(cursor, dim, model_name, path)
+                _loaded.update(mtime=os.path.getmtime(path), index=index)
+        return _loaded["index"]
+
+if __name__ == "__main__":
+    import face_db
+    from face_config import EMBEDDING_DIM
+
+    load_dotenv()
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    path = index_path()
+
+    if command == "build":
+        conn = face_db.connect()
+        cursor = conn.cursor()
+        try:
+            index, skipped = build_from_db(cursor, EMBEDDING_DIM, MODEL_NAME, path)
+        finally:
+            cursor.close()
+            conn.close()
+        print(json.dumps({"path": path, "vectors": len(index), "lists": len(index.centroids), "skipped": skipped}))
+    elif command == "stats":
+        index = FaceIndex.load(path)
+        print(json.dumps({
+            "path": path,
+            "vectors": len(index),
+            "employees": int(len(np.unique(index.employee_ids))),
+            "lists": len(index.centroids)
+        }))
+    else:
+        print(f"Usage: python face_index.py [build|stats]", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,80 @@
+# FACE_MATCHER.PY - vectorized cosine matching over stored face encodings
+import numpy as np
+
+from face_encoding_format import decode_stored_encoding
+from face_trace import annotate
+
+def normalize(vector):
+    """Return vector scaled to unit length as float32, or None for a zero vector"""
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        return None
+    return vector / norm
+
+def build_encoding_matrix(face_records, dim, model_name=None):
+    """Stack (employeeID, blob, createdAt) rows into a normalized (N, dim) matrix.
+
+    Returns (matrix, kept_records, skipped) where kept_records lines up with
+    the matrix rows and skipped counts rows that could not be used, keyed by
+    reason.
+    """
+    skipped = {"decode_error": 0, "model_mismatch": 0, "dimension_mismatch": 0, "zero_vector": 0}
+    vectors = []
+    kept_records = []
+
+    for record in face_records:
+        try:
+            _, vector = decode_stored_encoding(record[1], model_name)
+        except Exception:
+            skipped["decode_error"] += 1
+            continue
+        if vector is None:
+            skipped["model_mismatch"] += 1
+            continue
+        if vector.shape != (dim,):
+            skipped["dimension_mismatch"] += 1
+            continue
+        vectors.append(vector)
+        kept_records.append(record)
+
+    if not vectors:
+        return np.empty((0, dim), dtype=np.float32), [], skipped
+
+    matrix = np.vstack(vectors).astype(np.float32, copy=False)
+    norms = np.linalg.norm(matrix, axis=1)
+    nonzero = norms > 0
+    skipped["zero_vector"] = int(np.count_nonzero(~nonzero))
+    if not nonzero.all():
+        matrix = matrix[nonzero]
+        norms = norms[nonzero]
+        kept_records = [r for r, keep in zip(kept_records, nonzero) if keep]
+    matrix /= norms[:, None]
+
+    return matrix, kept_records, skipped
+
+def cosine_distances(matrix, normalized_probe):
+    """Cosine distance from the probe to every row in one matrix-vector product"""
+    return 1.0 - matrix @ normalized_probe
+
+def find_matches(matrix, kept_records, normalized_probe, threshold):
+    """Return (matches, best_match) for rows closer than threshold.
+
+    matches keep the order of kept_records; best_match is the closest one.
+    """
+    distances = cosine_distances(matrix, normalized_probe)
+    hits = np.flatnonzero(distances < threshold)
+    if len(distances):
+        annotate(nearest_distance=float(distances.min()))
+
+    matches = [
+        {
+            "user_id": kept_records[i][0],
+            "distance": float(distances[i]),
+            "similarity": float(1.0 - distances[i]),
+            "created_at": str(kept_records[i][2])
+        }
+        for i in hits
+    ]
+    best_match = matches[int(np.argmin(distances[hits]))] if len(hits) else None
+    return matches, best_match
@@ -0,0 +1,184 @@
+# FACE_METRICS.PY - Prometheus exporter for a long-running face worker
+#
+#   python face_worker.py --socket /tmp/face.sock --metrics-port 9464
+#   curl http://127.0.0.1:9464/metrics
+#
+# Request metrics are fed from the face_trace listener, once per finished
+# request: outcome counters, request and per-stage latency histograms, and
+# the nearest match distance. Everything else (encoding cache, DB pool,
+# micro-batch queue, fast-reject cascade) is read from the components'
+# stats() only when Prometheus scrapes, so the hot path pays for a few
+# dict updates under one lock and nothing more.
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import face_trace
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DISTANCE_BUCKETS = (0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.4, 0.5, 0.75, 1.0)
+
+# Error message fragments from match_face.py / register_face.py -> outcome label
+ERROR_OUTCOMES = (
+    ("Multiple faces detected", "multiple_faces"),
+    ("real face", "spoof"),
+    ("No face detected", "no_face"),
+    ("Poor image quality", "no_face"),
+    ("No face data found", "not_registered"),
+    ("already registered to employee", "duplicate_identity"),
+    ("Database", "db_error"),
+)
+
+def classify(trace):
+    """Outcome label for a finished request trace"""
+    error = trace.attrs.get("error")
+    if error:
+        for fragment, outcome in ERROR_OUTCOMES:
+            if fragment in str(error):
+                return outcome
+        return "error"
+    if trace.name == "register":
+        return "registered" if trace.attrs.get("success") else "error"
+    return "matched" if trace.attrs.get("matched") else "no_match"
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{str(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.series = {}  # label values -> [bucket counts..., count, sum]
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += 1
+        series[-1] += value
+
+    def render(self, name, label_names):
+        lines = []
+        for labels, series in sorted(self.series.items()):
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{name}_bucket{_labels(label_names + ('le',), labels + (bound,))} {count}")
+            lines.append(f"{name}_bucket{_labels(label_names + ('le',), labels + ('+Inf',))} {series[-2]}")
+            lines.append(f"{name}_count{_labels(label_names, labels)} {series[-2]}")
+            lines.append(f"{name}_sum{_labels(label_names, labels)} {series[-1]}")
+        return lines
+
+class FaceMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}  # (pipeline, outcome) -> count
+        self.cache_lookups = {}  # hit/miss -> count
+        self.request_seconds = Histogram(LATENCY_BUCKETS)
+        self.stage_seconds = Histogram(LATENCY_BUCKETS)
+        self.distance = Histogram(DISTANCE_BUCKETS)
+        self.collectors = []
+
+    def observe_trace(self, trace):
+        outcome = classify(trace)
+        nearest = trace.attrs.get("nearest_distance")
+        cache_hit = trace.attrs.get("encoding_cache_hit")
+        stages = trace.stage_totals()
+        with self.lock:
+            key = (trace.name, outcome)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.request_seconds.observe((trace.name,), trace.duration_ms / 1000)
+            for stage, ms in stages.items():
+                self.stage_seconds.observe((trace.name, stage), ms / 1000)
+            if nearest is not None:
+                self.distance.observe((trace.name,), nearest)
+            if cache_hit is not None:
+                result = "hit" if cache_hit else "miss"
+                self.cache_lookups[result] = self.cache_lookups.get(result, 0) + 1
+
+    def add_collector(self, collect):
+        """collect() returns [(name, type, help, value)] read at scrape time"""
+        self.collectors.append(collect)
+
+    def render(self):
+        lines = []
+
+        def header(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self.lock:
+            header("face_requests_total", "counter", "Face requests by pipeline and outcome")
+            for (pipeline, outcome), count in sorted(self.requests.items()):
+                lines.append(f'face_requests_total{{pipeline="{pipeline}",outcome="{outcome}"}} {count}')
+            header("face_request_duration_seconds", "histogram", "End-to-end request latency")
+            lines += self.request_seconds.render("face_request_duration_seconds", ("pipeline",))
+            header("face_stage_duration_seconds", "histogram", "Latency of each pipeline stage")
+            lines += self.stage_seconds.render("face_stage_duration_seconds", ("pipeline", "stage"))
+            header("face_match_nearest_distance", "histogram", "Cosine distance to the closest stored encoding")
+            lines += self.distance.render("face_match_nearest_distance", ("pipeline",))
+            header("face_encoding_cache_lookups_total", "counter", "Per-request encoding cache lookups")
+            for result, count in sorted(self.cache_lookups.items()):
+                lines.append(f'face_encoding_cache_lookups_total{{result="{result}"}} {count}')
+
+        for collect in self.collectors:
+            try:
+                samples = collect()
+            except Exception:
+                continue
+            for name, kind, help_text, value in samples:
+                header(name, kind, help_text)
+                lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+def component_collector(get_stats, fields):
+    """Collector exposing selected keys of a component's stats().
+
+    fields maps each stats key to (metric name, type, help).
+    """
+    def collect():
+        stats = get_stats()
+        if stats is None:
+            return []
+        return [
+            (name, kind, help_text, stats[key])
+            for key, (name, kind, help_text) in fields.items() if key in stats
+        ]
+    return collect
+
+_metrics = None
+
+def get_metrics():
+    """Process-wide metrics, subscribed to request traces on first use"""
+    global _metrics
+    if _metrics is None:
+        _metrics = FaceMetrics()
+        face_trace.add_listener(_metrics.observe_trace)
+    return _metrics
+
+def serve_metrics(port, host="127.0.0.1"):
+    """Serve /metrics in Prometheus text format from a daemon thread"""
+    metrics = get_metrics()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Keep scrapes out of the worker's stderr
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
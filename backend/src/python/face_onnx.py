@@ -0,0 +1,211 @@
+# FACE_ONNX.PY - optional ONNX Runtime backend for Facenet and anti-spoofing
+#
+#   python face_onnx.py export [--int8]
+#   python face_onnx.py parity <image> [<image> ...] [--int8] [--max-distance 0.02]
+#
+# export converts DeepFace's Facenet (Keras) and the two MiniFASNet
+# anti-spoofing models (PyTorch) to ONNX in FACE_ONNX_DIR, optionally with
+# dynamic int8 weight quantization. Set FACE_INFERENCE_BACKEND=onnx (and
+# FACE_ONNX_INT8=1 for the quantized files) to run them on CPU through ONNX
+# Runtime instead of TensorFlow/PyTorch; detection stays on MTCNN.
+#
+# parity runs both backends on sample images and exits 1 if any embedding
+# drifts past --max-distance (cosine) or a liveness decision differs. Run it
+# before switching a deployment over.
+from dotenv import load_dotenv
+import argparse
+import json
+import os
+import sys
+import threading
+
+import numpy as np
+
+from face_config import MODEL_NAME
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+FACENET_INPUT = (160, 160)
+ANTISPOOF_INPUT = (80, 80)
+ANTISPOOF_SCALES = (2.7, 4.0)  # Crop scales of the two MiniFASNet models, as in DeepFace
+DEFAULT_MAX_DISTANCE = 0.02
+DEFAULT_MAX_DISTANCE_INT8 = 0.05
+
+def model_dir():
+    return os.getenv("FACE_ONNX_DIR", os.path.join(SCRIPT_DIR, "onnx_models"))
+
+def model_path(name, int8=False):
+    return os.path.join(model_dir(), f"{name}{'.int8' if int8 else ''}.onnx")
+
+def quantize(src, dst):
+    """Dynamic int8 quantization of the weights; activations stay float"""
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    quantize_dynamic(src, dst, weight_type=QuantType.QInt8)
+
+def export_facenet():
+    import tensorflow as tf
+    import tf2onnx
+    from deepface import DeepFace
+
+    keras_model = DeepFace.build_model(MODEL_NAME).model
+    signature = (tf.TensorSpec((None, FACENET_INPUT[0], FACENET_INPUT[1], 3), tf.float32, name="input"),)
+    path = model_path("facenet")
+    tf2onnx.convert.from_keras(keras_model, input_signature=signature, opset=13, output_path=path)
+    return path
+
+def export_antispoof():
+    import torch
+    from deepface.models.spoofing.FasNet import Fasnet
+
+    fasnet = Fasnet()
+    paths = []
+    for name, model in (("antispoof_first", fasnet.first_model), ("antispoof_second", fasnet.second_model)):
+        path = model_path(name)
+        torch.onnx.export(
+            model.eval(), torch.zeros(1, 3, ANTISPOOF_INPUT[1], ANTISPOOF_INPUT[0]), path,
+            input_names=["input"], output_names=["logits"],
+            dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}}, opset_version=13
+        )
+        paths.append(path)
+    return paths
+
+def export_models(int8):
+    os.makedirs(model_dir(), exist_ok=True)
+    paths = [export_facenet()] + export_antispoof()
+    if int8:
+        quantized = []
+        for path in paths:
+            dst = path[:-len(".onnx")] + ".int8.onnx"
+            quantize(path, dst)
+            quantized.append(dst)
+        paths += quantized
+    return paths
+
+def _softmax(logits):
+    exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return exp / exp.sum(axis=1, keepdims=True)
+
+class OnnxBackend:
+    """ONNX Runtime sessions for Facenet and the anti-spoofing pair"""
+
+    def __init__(self, int8=False):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise RuntimeError("FACE_INFERENCE_BACKEND=onnx needs the onnxruntime package")
+
+        options = ort.SessionOptions()
+        # Follow the thread split face_pool.py sets up for TensorFlow
+        options.intra_op_num_threads = int(os.getenv("OMP_NUM_THREADS", 0))
+        options.inter_op_num_threads = 1
+
+        def session(name):
+            path = model_path(name, int8)
+            if not os.path.exists(path):
+                raise RuntimeError(f"ONNX model not found: {path} (run face_onnx.py export{' --int8' if int8 else ''})")
+            return ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+        self.facenet = session("facenet")
+        self.antispoof = [session("antispoof_first"), session("antispoof_second")]
+
+    def embed(self, faces):
+        """Embed aligned faces from detect_faces, one array per face"""
+        from deepface.modules import preprocessing
+        from face_pipeline import model_channels
+
+        batch = np.concatenate([
+            preprocessing.resize_image(img=model_channels(face["face"]), target_size=FACENET_INPUT)
+            for face in faces
+        ]).astype(np.float32)
+        embeddings = self.facenet.run(None, {self.facenet.get_inputs()[0].name: batch})[0]
+        return [np.asarray(embedding, dtype=np.float64) for embedding in embeddings]
+
+    def check_liveness(self, image, facial_area):
+        """Return (is_real, score) for a face box, matching DeepFace's Fasnet"""
+        from deepface.models.spoofing.FasNet import crop
+
+        x, y, w, h = (facial_area[k] for k in ("x", "y", "w", "h"))
+        prediction = np.zeros((1, 3))
+        for scale, session in zip(ANTISPOOF_SCALES, self.antispoof):
+            patch = crop(image, (x, y, w, h), scale, ANTISPOOF_INPUT[0], ANTISPOOF_INPUT[1])
+            tensor = patch.transpose(2, 0, 1)[np.newaxis].astype(np.float32)
+            prediction += _softmax(session.run(None, {session.get_inputs()[0].name: tensor})[0])
+        label = int(np.argmax(prediction))
+        return label == 1, float(prediction[0][label] / 2)
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend():
+    """Process-wide ONNX backend, loaded on first use"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = OnnxBackend(int8=os.getenv("FACE_ONNX_INT8", "0") == "1")
+        return _backend
+
+def parity(image_paths, int8, max_distance):
+    """Compare the ONNX backend against DeepFace on sample images"""
+    from deepface import DeepFace
+    from face_pipeline import decode_image, embed_face_deepface, DETECTOR_BACKEND
+
+    backend = OnnxBackend(int8)
+    distances = []
+    liveness_mismatches = []
+    score_deltas = []
+    skipped = []
+
+    for path in image_paths:
+        image = decode_image(path)
+        try:
+            faces = DeepFace.extract_faces(
+                img_path=image, detector_backend=DETECTOR_BACKEND,
+                enforce_detection=True, align=True, anti_spoofing=True
+            )
+        except ValueError:
+            skipped.append(path)
+            continue
+
+        for face in faces:
+            reference = embed_face_deepface(face)
+            candidate = backend.embed([face])[0]
+            cosine = np.dot(reference, candidate) / (np.linalg.norm(reference) * np.linalg.norm(candidate))
+            distances.append(float(1 - cosine))
+
+            is_real, score = backend.check_liveness(image, face["facial_area"])
+            if is_real != face.get("is_real"):
+                liveness_mismatches.append(path)
+            score_deltas.append(abs(score - float(face.get("antispoof_score", 0))))
+
+    passed = bool(distances) and max(distances) <= max_distance and not liveness_mismatches
+    return {
+        "int8": int8,
+        "faces": len(distances),
+        "skipped_images": skipped,
+        "max_distance": round(max(distances), 6) if distances else None,
+        "mean_distance": round(float(np.mean(distances)), 6) if distances else None,
+        "distance_budget": max_distance,
+        "liveness_mismatches": liveness_mismatches,
+        "max_score_delta": round(max(score_deltas), 6) if score_deltas else None,
+        "passed": passed
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export and check the ONNX inference backend")
+    parser.add_argument("command", choices=["export", "parity"])
+    parser.add_argument("images", nargs="*", help="sample images for parity")
+    parser.add_argument("--int8", action="store_true", help="quantized models (export also writes them)")
+    parser.add_argument("--max-distance", type=float, help="largest allowed cosine distance to DeepFace")
+    args = parser.parse_args()
+
+    load_dotenv()
+    if args.command == "export":
+        print(json.dumps({"exported": export_models(args.int8)}))
+    else:
+        if not args.images:
+            parser.error("parity needs at least one sample image")
+        max_distance = args.max_distance
+        if max_distance is None:
+            max_distance = DEFAULT_MAX_DISTANCE_INT8 if args.int8 else DEFAULT_MAX_DISTANCE
+        result = parity(args.images, args.int8, max_distance)
+        print(json.dumps(result))
+        sys.exit(0 if result["passed"] else 1)
@@ -0,0 +1,513 @@
+# FACE_PIPELINE.PY - image stages shared by match_face.py and register_face.py
+#
+# OpenCV and DeepFace (which pulls in TensorFlow) are imported inside the
+# stages that use them, so importing this module is cheap and scripts that
+# fail argument validation or only touch the database never load them.
+import os
+import sys
+import threading
+from datetime import datetime
+
+import numpy as np
+
+from face_trace import span
+from face_config import DETECTOR_BACKEND, MODEL_NAME, EMBEDDING_DIM, INFERENCE_BACKEND
+
+def log_with_time(message):
+    timestamp = datetime.now().strftime('%H:%M:%S.%f')[:-3]
+    print(f"[{timestamp}] {message}", file=sys.stderr, flush=True)
+
+def read_image_bytes(image_path):
+    """Read raw upload bytes from a file, or from stdin when the path is '-'"""
+    if image_path == '-':
+        return sys.stdin.buffer.read()
+    with open(image_path, 'rb') as f:
+        return f.read()
+
+def read_shared_memory(name, size):
+    """Copy an encoded image out of a named shared-memory buffer"""
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(shm.buf[:size])
+    finally:
+        shm.close()
+
+def read_source(image):
+    """Read a path ('-' for stdin) into bytes once so every decode can reuse them.
+
+    Raw bytes and ndarrays come back unchanged, and so does a path that
+    can't be read (detection then reports it as before).
+    """
+    if isinstance(image, str):
+        try:
+            return read_image_bytes(image)
+        except OSError:
+            return image
+    return image
+
+def decode_image(image):
+    """Decode a path, raw encoded bytes or an ndarray into a BGR ndarray.
+
+    Returns None when the input can't be decoded.
+    """
+    if isinstance(image, np.ndarray):
+        return image
+    import cv2
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        buffer = np.frombuffer(image, dtype=np.uint8)
+        return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    if image == '-':
+        return decode_image(read_image_bytes(image))
+    return cv2.imread(image)
+
+# Reduced-scale decoding: libjpeg can decode straight to 1/2, 1/4 or 1/8
+# scale by skipping the DCT detail that would be thrown away, so an upload
+# that is going to be shrunk anyway is never decoded at full size.
+# FACE_ADAPTIVE_DECODE=0 restores the full decode and the fixed-resolution
+# detection region (face_bench.py compares the two).
+ADAPTIVE_DECODE_ENABLED = os.getenv("FACE_ADAPTIVE_DECODE", "1") != "0"
+REDUCED_SCALES = (8, 4, 2)
+_JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+_JPEG_STANDALONE_MARKERS = {0x01, 0xD8} | set(range(0xD0, 0xD8))
+
+def jpeg_dimensions(data):
+    """(width, height) from a JPEG's frame header, or None for anything else.
+
+    These are the stored dimensions; EXIF orientation may swap them on decode.
+    """
+    if not isinstance(data, (bytes, bytearray, memoryview)) or bytes(data[:2]) != b'\xff\xd8':
+        return None
+    data = memoryview(data).cast('B')
+    offset = 2
+    while offset + 9 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:  # Fill byte
+            offset += 1
+            continue
+        if marker in _JPEG_STANDALONE_MARKERS:
+            offset += 2
+            continue
+        if marker in _JPEG_SOF_MARKERS:
+            height = (data[offset + 5] << 8) | data[offset + 6]
+            width = (data[offset + 7] << 8) | data[offset + 8]
+            return width, height
+        offset += 2 + ((data[offset + 2] << 8) | data[offset + 3])
+    return None
+
+def reduction_for(scale):
+    """Largest JPEG reduction whose output is still at least `scale` of full size"""
+    for factor in REDUCED_SCALES:
+        if 1.0 / factor >= scale:
+            return factor
+    return 1
+
+def decode_reduced(data, factor):
+    """Decode encoded bytes at 1/factor scale (1, 2, 4 or 8)"""
+    import cv2
+    flags = {
+        1: cv2.IMREAD_COLOR,
+        2: cv2.IMREAD_REDUCED_COLOR_2,
+        4: cv2.IMREAD_REDUCED_COLOR_4,
+        8: cv2.IMREAD_REDUCED_COLOR_8
+    }
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags[factor])
+
+def frame_reduction(image, target_size):
+    """JPEG reduction factor that still covers target_size, 1 if none applies"""
+    if not ADAPTIVE_DECODE_ENABLED:
+        return 1
+    dimensions = jpeg_dimensions(image)
+    if dimensions is None:
+        return 1
+    width, height = dimensions
+    # Either orientation, since EXIF rotation is applied after the header is read
+    scale = max(min(target_size[0] / height, target_size[1] / width),
+                min(target_size[0] / width, target_size[1] / height))
+    return reduction_for(scale)
+
+# Optimization 1: Image preprocessing function
+def preprocess_image(image, target_size=(640, 640)):
+    """Decode once and resize in memory to reduce processing time.
+
+    JPEG bytes larger than target_size are decoded directly at a reduced
+    scale that still covers it. Returns the decoded (and possibly resized)
+    BGR array, which DeepFace accepts directly. If the image can't be
+    decoded it is returned as-is so detection reports the failure.
+    """
+    try:
+        import cv2
+        factor = frame_reduction(image, target_size)
+        with span("decode", reduced=factor):
+            img = decode_reduced(image, factor) if factor > 1 else decode_image(image)
+        if img is None:
+            return image  # Return original if can't load
+        if factor > 1:
+            log_with_time(f"Decoded image at 1/{factor} scale")
+
+        # Resize if image is too large
+        height, width = img.shape[:2]
+        if height > target_size[0] or width > target_size[1]:
+            log_with_time(f"Resizing image from {width}x{height} to optimize processing")
+            # Calculate scaling factor to maintain aspect ratio
+            scale = min(target_size[0]/height, target_size[1]/width)
+            new_width = int(width * scale)
+            new_height = int(height * scale)
+            with span("resize"):
+                img = cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_AREA)
+
+        return img
+    except Exception as e:
+        log_with_time(f"Error preprocessing image: {str(e)}")
+        return image
+
+# Optimization 2: Quick face detection check
+# The Haar cascade runs with a lenient minNeighbors so that finding nothing
+# at all is a confident "no face". A face only counts as certain when its
+# cascade weight is above QUICK_STRONG_WEIGHT; weaker hits make the screen
+# inconclusive and the full frame goes to MTCNN as before.
+QUICK_MIN_NEIGHBORS = 3
+QUICK_STRONG_WEIGHT = float(os.getenv("FACE_QUICK_STRONG_WEIGHT", 4.0))
+QUICK_REJECT_ENABLED = os.getenv("FACE_QUICK_REJECT", "1") != "0"
+ROI_MARGIN = 0.5  # Context kept around the quick-check box, as a fraction of its size
+# The quick-check region goes to MTCNN at the resolution that makes the face
+# about FACE_TARGET_PX wide, the size the aligned crop is embedded at
+# anyway: big faces are shrunk, small ones are cut from a finer decode of
+# the upload (never beyond its full resolution) instead of being upscaled.
+FACE_TARGET_PX = int(os.getenv("FACE_TARGET_PX", 160))
+REDECODE_MIN_GAIN = 1.5  # Decode again only for at least this much more face detail
+
+NO_FACE = "no_face"
+MULTIPLE_FACES = "multiple_faces"
+SINGLE_FACE = "single_face"
+INCONCLUSIVE = "inconclusive"
+
+_cascade_local = threading.local()  # CascadeClassifier isn't safe to share between threads
+_cascade_lock = threading.Lock()
+_cascade_counters = {
+    "screened": 0,
+    "rejected_no_face": 0,
+    "rejected_multiple_faces": 0,
+    "roi_used": 0,
+    "roi_fallback": 0,
+    "full_frame": 0,
+    "screen_errors": 0
+}
+
+def _count(name):
+    with _cascade_lock:
+        _cascade_counters[name] += 1
+
+def cascade_stats():
+    """How often each stage of the detection cascade short-circuited"""
+    with _cascade_lock:
+        return dict(_cascade_counters)
+
+def _face_cascade():
+    """This thread's Haar cascade, loaded on first use"""
+    cascade = getattr(_cascade_local, "cascade", None)
+    if cascade is None:
+        import cv2
+        cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+        _cascade_local.cascade = cascade
+    return cascade
+
+def quick_face_check(image):
+    """Quick face detection using opencv to pre-filter images.
+
+    Returns (verdict, boxes): verdict is NO_FACE, MULTIPLE_FACES, SINGLE_FACE
+    or INCONCLUSIVE, and boxes are the confident (x, y, w, h) detections.
+    """
+    if not isinstance(image, np.ndarray):
+        return INCONCLUSIVE, []
+    try:
+        import cv2
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        boxes, _, weights = _face_cascade().detectMultiScale3(
+            gray, scaleFactor=1.1, minNeighbors=QUICK_MIN_NEIGHBORS, outputRejectLevels=True
+        )
+    except Exception as e:
+        _count("screen_errors")
+        log_with_time(f"Quick face check failed: {str(e)}")
+        return INCONCLUSIVE, []  # Proceed with full processing if quick check fails
+
+    weights = np.ravel(weights) if len(boxes) else np.empty(0)
+    strong = [tuple(int(v) for v in box) for box, weight in zip(boxes, weights) if weight >= QUICK_STRONG_WEIGHT]
+    log_with_time(f"Quick face check detected {len(boxes)} candidates, {len(strong)} confident")
+
+    if len(boxes) == 0:
+        return NO_FACE, []
+    if len(strong) > 1:
+        return MULTIPLE_FACES, strong
+    if len(strong) == 1 and len(boxes) == 1:
+        return SINGLE_FACE, strong
+    return INCONCLUSIVE, strong
+
+def crop_to_region(image, box, margin=ROI_MARGIN):
+    """Crop the quick-check box plus a margin; returns (crop, (x0, y0))"""
+    x, y, w, h = box
+    height, width = image.shape[:2]
+    x0 = max(0, int(x - w * margin))
+    y0 = max(0, int(y - h * margin))
+    x1 = min(width, int(x + w * (1 + margin)))
+    y1 = min(height, int(y + h * (1 + margin)))
+    return image[y0:y1, x0:x1], (x0, y0)
+
+def decode_finer(source, frame, gain):
+    """The upload decoded at gain times the frame's resolution (or its full size), or None.
+
+    Only JPEG bytes (at a reduced scale where possible) and already decoded
+    arrays have more detail to offer without a wasted full decode.
+    """
+    if isinstance(source, np.ndarray):
+        return source if source.shape[1] > frame.shape[1] else None
+    dimensions = jpeg_dimensions(source)
+    if dimensions is None:
+        return None
+    available = max(dimensions) / max(frame.shape[:2])
+    if available < REDECODE_MIN_GAIN:
+        return None
+    factor = reduction_for(gain / available)
+    with span("decode", step="region", reduced=factor):
+        return decode_reduced(source, factor)
+
+def _shrink(image, factor):
+    """Resize by factor (< 1); returns (image, the factor actually applied)"""
+    import cv2
+    width = max(1, int(round(image.shape[1] * factor)))
+    height = max(1, int(round(image.shape[0] * factor)))
+    with span("resize", step="region"):
+        shrunk = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+    return shrunk, width / image.shape[1]
+
+def detection_region(image, box, source=None):
+    """Crop the quick-check region for MTCNN at a resolution fit for the face.
+
+    Returns (crop, (x0, y0), scale): crop pixels are frame pixels times
+    scale, and (x0, y0) is the crop's origin in frame coordinates.
+    """
+    if not ADAPTIVE_DECODE_ENABLED:
+        crop, origin = crop_to_region(image, box)
+        return crop, origin, 1.0
+
+    want = FACE_TARGET_PX / max(box[2], 1)
+    if want >= REDECODE_MIN_GAIN and source is not None:
+        finer = decode_finer(source, image, want)
+        if finer is not None:
+            ratio = finer.shape[1] / image.shape[1]
+            crop, (x0, y0) = crop_to_region(finer, tuple(int(round(v * ratio)) for v in box))
+            scale = ratio
+            if ratio > want:
+                crop, applied = _shrink(crop, want / ratio)
+                scale = ratio * applied
+            return crop, (x0 / ratio, y0 / ratio), scale
+
+    crop, origin = crop_to_region(image, box)
+    if want < 1:
+        crop, scale = _shrink(crop, want)
+        return crop, origin, scale
+    return crop, origin, 1.0
+
+# Optimization 3: Detect, align and anti-spoof in a single detector pass
+_fasnet = None
+
+def check_liveness(frame, facial_area):
+    """Return (is_real, score) for one detected face box"""
+    global _fasnet
+    if INFERENCE_BACKEND == "onnx":
+        import face_onnx
+        return face_onnx.get_backend().check_liveness(frame, facial_area)
+    if _fasnet is None:
+        from deepface.models.spoofing.FasNet import Fasnet
+        _fasnet = Fasnet()
+    box = tuple(facial_area[k] for k in ("x", "y", "w", "h"))
+    return _fasnet.analyze(img=frame, facial_area=box)
+
+def extract_faces(image):
+    """Run MTCNN once with alignment; each face carries its aligned crop"""
+    from deepface import DeepFace
+    with span("detect"):
+        return DeepFace.extract_faces(
+            img_path=image,
+            detector_backend=DETECTOR_BACKEND,
+            enforce_detection=True,
+            align=True,
+            anti_spoofing=False
+        )
+
+def add_liveness(faces, frame):
+    """Score each face for anti-spoofing on frame, the image its boxes refer to.
+
+    Fasnet crops 2.7x and 4x the box around each face, so frame must be the
+    whole processed image, never a detection region cut out of it.
+    """
+    with span("antispoof", faces=len(faces)):
+        for face in faces:
+            face["is_real"], face["antispoof_score"] = check_liveness(frame, face["facial_area"])
+    return faces
+
+def detect_faces(image):
+    """Run MTCNN once with alignment, then anti-spoofing on its boxes.
+
+    Each returned face carries the aligned crop, so the embedding stage can
+    reuse it instead of detecting the face again. Anti-spoofing runs the
+    same Fasnet models DeepFace would (or their ONNX exports) as a separate
+    stage, so its cost shows up in its own span.
+    """
+    log_with_time(f"start deepface.extract_faces({DETECTOR_BACKEND}, antispoofing=true)")
+    faces = extract_faces(image)
+    add_liveness(faces, decode_image(image))
+    log_with_time(f"end deepface.extract_faces({DETECTOR_BACKEND}, antispoofing=true)")
+    return faces
+
+def to_frame_coordinates(faces, origin, scale):
+    """Map facial areas found in a detection region back onto the frame"""
+    x0, y0 = origin
+    for face in faces:
+        area = face.get("facial_area") or {}
+        if "x" in area:
+            area["x"] = int(round(area["x"] / scale + x0))
+            area["y"] = int(round(area["y"] / scale + y0))
+            area["w"] = int(round(area["w"] / scale))
+            area["h"] = int(round(area["h"] / scale))
+        for eye in ("left_eye", "right_eye"):
+            if area.get(eye) is not None:
+                area[eye] = (int(round(area[eye][0] / scale + x0)), int(round(area[eye][1] / scale + y0)))
+    return faces
+
+def locate_faces(image, source=None):
+    """Detect faces through the quick-check cascade, then MTCNN.
+
+    Images the quick check confidently rejects never reach MTCNN: no face
+    raises the same error detect_faces would, and multiple faces come back
+    as the quick-check boxes (without crops) so callers reject them as usual.
+    A single confident face only sends its region to MTCNN, scaled for the
+    face size (see detection_region; source is the upload the frame was
+    decoded from); if that crop yields nothing the full frame is tried once.
+    Anti-spoofing always scores the face on the full frame.
+    """
+    if not QUICK_REJECT_ENABLED:
+        return detect_faces(image)
+
+    log_with_time("start quick face detection check")
+    with span("quick_check"):
+        verdict, boxes = quick_face_check(image)
+    log_with_time(f"end quick face detection check ({verdict})")
+    _count("screened")
+
+    if verdict == NO_FACE:
+        _count("rejected_no_face")
+        raise ValueError("Face could not be detected by the quick face check")
+
+    if verdict == MULTIPLE_FACES:
+        _count("rejected_multiple_faces")
+        return [
+            {"facial_area": {"x": x, "y": y, "w": w, "h": h}, "quick_check": True}
+            for x, y, w, h in boxes
+        ]
+
+    if verdict == SINGLE_FACE:
+        crop, origin, scale = detection_region(image, boxes[0], source)
+        log_with_time(f"start deepface.extract_faces({DETECTOR_BACKEND}) on the quick-check region")
+        try:
+            faces = extract_faces(crop)
+        except ValueError:
+            faces = []
+        log_with_time(f"end deepface.extract_faces({DETECTOR_BACKEND}) on the quick-check region")
+        if faces:
+            _count("roi_used")
+            # The region only narrows detection; liveness needs the context around the box
+            to_frame_coordinates(faces, origin, scale)
+            return add_liveness(faces, image)
+        _count("roi_fallback")
+        log_with_time("No face found in quick-check region - retrying on the full frame")
+
+    _count("full_frame")
+    return detect_faces(image)
+
+def model_channels(face):
+    """Aligned RGB face(s), last axis channels -> the BGR order the embedding models take.
+
+    DeepFace.represent flips extract_faces' RGB crop before its forward pass,
+    so every path that feeds a model directly (embed_faces_batch, embed_crops,
+    face_onnx.py) flips it here the same way.
+    """
+    return face[..., ::-1]
+
+def aligned_face_to_bgr(face):
+    """Convert an extract_faces crop (RGB, 0-1 floats) to a BGR uint8 image"""
+    return np.clip(face[:, :, ::-1] * 255, 0, 255).astype(np.uint8)
+
+def embed_face(face):
+    """Generate a Facenet embedding for an aligned face from detect_faces"""
+    if INFERENCE_BACKEND == "onnx":
+        import face_onnx
+        return face_onnx.get_backend().embed([face])[0]
+    return embed_face_deepface(face)
+
+def embed_face_deepface(face):
+    """embed_face through DeepFace.represent, whatever the configured backend.
+
+    represent takes a BGR image and flips it back after its own skip-detector
+    pass, so the model sees the same channels as model_channels gives it.
+    """
+    from deepface import DeepFace
+    log_with_time(f"Start face encoding generation using {MODEL_NAME}, aligned crop")
+    face_encodings = DeepFace.represent(
+        img_path=aligned_face_to_bgr(face["face"]),
+        model_name=MODEL_NAME,
+        detector_backend='skip',  # Face is already detected and aligned
+        enforce_detection=False
+    )
+    log_with_time(f"end face encoding generation using {MODEL_NAME}, aligned crop")
+
+    if not face_encodings or len(face_encodings) == 0:
+        return None
+    return np.array(face_encodings[0]["embedding"])
+
+def embed_faces_batch(faces, model_name=MODEL_NAME):
+    """Embed several aligned faces from detect_faces in one forward pass.
+
+    Uses the same channel order and resize/normalization as DeepFace.represent,
+    so results match embed_face. model_name lets re-embedding jobs run a model other than the
+    configured one. Returns one embedding array per face.
+    """
+    if INFERENCE_BACKEND == "onnx" and model_name == MODEL_NAME:
+        import face_onnx
+        return face_onnx.get_backend().embed(faces)
+
+    from deepface import DeepFace
+    from deepface.modules import preprocessing
+
+    model = DeepFace.build_model(model_name)
+    target_size = model.input_shape
+    batch = np.concatenate([
+        preprocessing.resize_image(img=model_channels(face["face"]), target_size=(target_size[1], target_size[0]))
+        for face in faces
+    ])
+    log_with_time(f"Start batched face encoding generation using {model_name}, batch of {len(faces)}")
+    embeddings = np.asarray(model.model(batch, training=False))
+    log_with_time(f"end batched face encoding generation using {model_name}")
+    return [np.asarray(embedding, dtype=np.float64) for embedding in embeddings]
+
+def embed_crops(crops, model_name=MODEL_NAME):
+    """Embed a (N, size, size, 3) uint8 RGB batch of stored crops (face_crops.py).
+
+    Crops already at the model's input size go straight into the forward
+    pass, with no per-face resize; the result matches embed_faces_batch.
+    """
+    if INFERENCE_BACKEND == "onnx" and model_name == MODEL_NAME:
+        import face_onnx
+        return face_onnx.get_backend().embed([{"face": crop / 255.0} for crop in crops])
+
+    from deepface import DeepFace
+
+    model = DeepFace.build_model(model_name)
+    if tuple(crops.shape[1:3]) != tuple(model.input_shape):
+        return embed_faces_batch([{"face": crop / 255.0} for crop in crops], model_name)
+    log_with_time(f"Start crop batch encoding using {model_name}, batch of {len(crops)}")
+    embeddings = np.asarray(model.model(model_channels(crops).astype(np.float32) / 255.0, training=False))
+    log_with_time(f"end crop batch encoding using {model_name}")
+    return [np.asarray(embedding, dtype=np.float64) for embedding in embeddings]
@@ -0,0 +1,392 @@
+# FACE_POOL.PY - pre-forked pool of model-warm face workers
+#
+#   python face_pool.py --socket /tmp/face.sock [--workers 4] [--max-rss-mb 3072]
+#       [--max-requests 0] [--preload] [--metrics-port 9464]
+#
+# The supervisor forks the workers before anything imports TensorFlow, and
+# each worker loads its own models. TensorFlow intra-op threads are split
+# evenly between workers (inter-op is 1) so they don't oversubscribe cores.
+# Requests use the same JSON-lines protocol as face_worker.py. A match or
+# register goes to the worker its employee ID hashes to, so that worker's
+# encoding cache and result cache (with its single-flight for resent
+# uploads) see every request for the employee; anything else, or a request
+# whose worker is draining, goes to the worker with the fewest requests in
+# flight. After a stored template or a registration the other workers are
+# told to drop what they cached for the employee; an "invalidate" sent to
+# the pool reaches every worker. A worker that crashes (or sends a line
+# that isn't a JSON response) is replaced. Its in-flight
+# read-only requests are retried on another worker; a match or register
+# may already have written to face_data, so those fail with an error
+# instead of running twice. One that grows past --max-rss-mb (or serves
+# --max-requests) stops receiving work, drains, and is replaced.
+#
+# With --metrics-port each worker serves its own Prometheus metrics on
+# metrics-port + its slot index (a replacement reuses the slot's port).
+#
+# --preload loads the models once in the supervisor and forks the workers
+# from it, so they share the weights copy-on-write. TensorFlow's thread
+# pools and internal locks are not fork-safe and the TF_NUM_* settings no
+# longer apply once it is initialized, so a worker may hang on its first
+# inference; only use it with a build known to survive that.
+from dotenv import load_dotenv
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import sys
+import zlib
+
+from result_cache import WORKER_TTL_SECONDS
+
+RSS_CHECK_INTERVAL_SECONDS = 5
+MAX_RETRIES = 1
+RETRYABLE_ACTIONS = {"identify", "ping", "stats"}  # Safe to run again after a crash
+ROUTING_FIELDS = {"match": "employee_id", "register": "user_id"}
+
+def routing_key(request):
+    """Employee ID a request's caches are keyed by, or None"""
+    value = request.get(ROUTING_FIELDS.get(request.get("action"), ""))
+    return str(value) if value is not None else None
+
+def changes_templates(request, response):
+    """Whether other workers' caches of the employee are now stale"""
+    if request.get("action") == "register":
+        return bool(response.get("success"))
+    return request.get("action") == "match" and bool(response.get("stored"))
+
+def configure_threads(workers):
+    """Split cores between workers; must run before TensorFlow is imported"""
+    cores = os.cpu_count() or 1
+    intra_op = max(1, cores // workers)
+    os.environ["TF_NUM_INTRAOP_THREADS"] = str(intra_op)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+    os.environ["OMP_NUM_THREADS"] = str(intra_op)
+    return intra_op
+
+def rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError):
+        return 0.0
+
+def run_child(sock, worker, preload, metrics_port=0):
+    """Worker process body: serve JSON lines from the supervisor until EOF.
+
+    Without preload, worker is None and the models are imported and loaded
+    here, after the fork.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if not preload:
+        import face_worker
+        worker = face_worker.FaceWorker()
+        worker.warm_up()
+    if metrics_port:
+        worker.start_metrics(metrics_port)
+    worker.start_snapshot_refresh()
+    stream = sock.makefile("rwb")
+    try:
+        for raw in stream:
+            line = raw.decode("utf-8")
+            if line.strip():
+                stream.write((worker.handle_line(line) + "\n").encode("utf-8"))
+                stream.flush()
+    finally:
+        worker.close()
+        os._exit(0)
+
+class WorkerSlot:
+    def __init__(self, index):
+        self.index = index
+        self.pid = None
+        self.reader = None
+        self.writer = None
+        self.inflight = {}  # seq -> (request, future, retries)
+        self.served = 0
+        self.retiring = False
+
+class Supervisor:
+    def __init__(self, worker, size, max_rss_mb, max_requests, preload, metrics_port=0):
+        self.worker = worker
+        self.metrics_port = metrics_port
+        self.slots = [WorkerSlot(i) for i in range(size)]
+        self.max_rss_mb = max_rss_mb
+        self.max_requests = max_requests
+        self.preload = preload
+        self.seq = 0
+        self.restarts = 0
+        self.available = None
+        self.server = None
+        self.clients = set()  # Client connection sockets, closed in forked children
+        self.tasks = set()  # Strong references; the event loop only keeps weak ones
+
+    def start_task(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def spawn(self, slot):
+        parent_sock, child_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            parent_sock.close()
+            # A respawned child must not hold the listen socket, client
+            # connections or other workers' pipes open after the parent lets go
+            for fd in self.inherited_fds():
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+            run_child(
+                child_sock, self.worker, self.preload,
+                self.metrics_port + slot.index if self.metrics_port else 0
+            )
+
+        child_sock.close()
+        slot.pid = pid
+        slot.served = 0
+        slot.retiring = False
+        slot.reader, slot.writer = await asyncio.open_connection(sock=parent_sock)
+        self.start_task(self.read_responses(slot))
+        self.available.set()
+        print(f"Face pool worker {slot.index} started (pid {pid})", file=sys.stderr, flush=True)
+
+    def inherited_fds(self):
+        """Supervisor descriptors a freshly forked worker closes"""
+        sockets = [s.writer.transport.get_extra_info("socket") for s in self.slots if s.writer is not None]
+        sockets += list(self.server.sockets) if self.server is not None else []
+        sockets += list(self.clients)
+        return [sock.fileno() for sock in sockets if sock is not None and sock.fileno() >= 0]
+
+    async def read_responses(self, slot):
+        try:
+            while True:
+                raw = await slot.reader.readline()
+                if not raw:
+                    break
+                response = json.loads(raw)
+                request, future, _ = slot.inflight.pop(response.pop("id", None), (None, None, 0))
+                if future is None or future.done():
+                    continue
+                if "id" in request:
+                    response["id"] = request["id"]
+                future.set_result(response)
+        except Exception as e:
+            # A torn or garbage line leaves the stream out of step: restart the worker
+            print(f"Face pool worker {slot.index} sent an unreadable response ({str(e)}) - restarting it",
+                  file=sys.stderr, flush=True)
+            try:
+                os.kill(slot.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        await self.replace(slot)
+
+    async def replace(self, slot):
+        """Reap a finished worker, retry its in-flight requests and fork a new one"""
+        orphaned = list(slot.inflight.values())
+        slot.inflight.clear()
+        if slot.writer is not None:
+            slot.writer.close()
+        slot.writer = None  # Nothing is routed here until the replacement is up
+
+        try:
+            _, status = await asyncio.get_running_loop().run_in_executor(None, os.waitpid, slot.pid, 0)
+        except ChildProcessError:
+            status = 0
+        if not slot.retiring:
+            print(f"Face pool worker {slot.index} exited unexpectedly (status {status})", file=sys.stderr, flush=True)
+
+        self.restarts += 1
+        await self.spawn(slot)
+
+        for request, future, retries in orphaned:
+            self.retry_or_fail(request, future, retries, "Face worker crashed while processing the request")
+
+    def retry_or_fail(self, request, future, retries, error):
+        """Run a request that lost its worker again if that is safe, else answer with error"""
+        if future.done():
+            return
+        if retries < MAX_RETRIES and request.get("action") in RETRYABLE_ACTIONS:
+            self.start_task(self.forward(request, future, retries + 1))
+        else:
+            # A match or register may have written before the crash; don't apply it twice
+            future.set_result({"error": error})
+
+    def pick_slot(self, key=None):
+        ready = [s for s in self.slots if s.writer is not None and not s.retiring]
+        if not ready:
+            return None
+        if key is not None:
+            owner = self.slots[zlib.crc32(key.encode("utf-8")) % len(self.slots)]
+            if owner in ready:
+                return owner
+        return min(ready, key=lambda s: len(s.inflight))
+
+    async def forward(self, request, future, retries=0, slot=None):
+        """Send a request to a worker (the given slot, or one picked for it); returns the slot"""
+        if slot is None:
+            slot = self.pick_slot(routing_key(request))
+            while slot is None:
+                self.available.clear()
+                await self.available.wait()
+                slot = self.pick_slot(routing_key(request))
+
+        self.seq += 1
+        seq = self.seq
+        slot.inflight[seq] = (request, future, retries)
+        if request.get("action") != "invalidate":
+            slot.served += 1
+        if self.max_requests and slot.served >= self.max_requests:
+            slot.retiring = True
+        try:
+            slot.writer.write((json.dumps(dict(request, id=seq)) + "\n").encode("utf-8"))
+            await slot.writer.drain()
+        except (ConnectionError, OSError) as e:
+            # The worker died mid-send; read_responses replaces it, and this
+            # request is answered here rather than left to its orphan list
+            if slot.inflight.pop(seq, None) is not None:
+                self.retry_or_fail(request, future, retries, f"Face worker unavailable: {str(e)}")
+        return slot
+
+    async def dispatch(self, request):
+        loop = asyncio.get_running_loop()
+        if request.get("action") == "invalidate":
+            # From outside the pool (compact_face_data.py --notify): any worker may hold the employee
+            futures = []
+            for slot in self.slots:
+                if slot.writer is not None:
+                    futures.append(loop.create_future())
+                    await self.forward(request, futures[-1], slot=slot)
+            await asyncio.gather(*futures)
+            return dict({"ok": True, "workers": len(futures)}, **({"id": request["id"]} if "id" in request else {}))
+        future = loop.create_future()
+        served_by = await self.forward(request, future)
+        response = await future
+        if changes_templates(request, response):
+            # Other workers may hold the employee from a request routed
+            # while its own worker was draining
+            invalidate = {"action": "invalidate", "employee_id": routing_key(request)}
+            for slot in self.slots:
+                if slot is not served_by and slot.writer is not None:
+                    self.start_task(self.forward(invalidate, loop.create_future(), slot=slot))
+        return response
+
+    async def monitor(self):
+        """Retire workers over the memory cap and close drained retirees"""
+        while True:
+            await asyncio.sleep(RSS_CHECK_INTERVAL_SECONDS)
+            for slot in self.slots:
+                if slot.writer is None:
+                    continue
+                if self.max_rss_mb and not slot.retiring and rss_mb(slot.pid) > self.max_rss_mb:
+                    print(f"Face pool worker {slot.index} over memory cap - recycling", file=sys.stderr, flush=True)
+                    slot.retiring = True
+                if slot.retiring and not slot.inflight:
+                    # EOF makes the worker exit; read_responses then replaces it
+                    slot.writer.close()
+
+    def stats(self):
+        return {
+            "workers": [
+                {"pid": s.pid, "inflight": len(s.inflight), "served": s.served,
+                 "rss_mb": round(rss_mb(s.pid), 1), "retiring": s.retiring}
+                for s in self.slots
+            ],
+            "restarts": self.restarts
+        }
+
+    async def handle_client(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        client_sock = writer.get_extra_info("socket")
+        self.clients.add(client_sock)
+        pending = set()
+        write_lock = asyncio.Lock()
+
+        async def respond(line):
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("request must be a JSON object")
+            except ValueError as e:
+                response = {"error": f"Invalid request: {str(e)}"}
+            else:
+                if request.get("action") == "pool_stats":
+                    response = dict(self.stats(), **({"id": request["id"]} if "id" in request else {}))
+                else:
+                    response = await self.dispatch(request)
+            async with write_lock:
+                writer.write((json.dumps(response) + "\n").encode("utf-8"))
+                await writer.drain()
+
+        while True:
+            raw = await reader.readline()
+            if not raw:
+                break
+            line = raw.decode("utf-8")
+            if line.strip():
+                task = loop.create_task(respond(line))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+
+        if pending:
+            await asyncio.gather(*pending)
+        self.clients.discard(client_sock)
+        writer.close()
+
+    async def serve(self, socket_path):
+        self.available = asyncio.Event()
+        for slot in self.slots:
+            await self.spawn(slot)
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = await asyncio.start_unix_server(self.handle_client, path=socket_path)
+        self.server = server
+        self.start_task(self.monitor())
+        print(f"Face pool listening on {socket_path} with {len(self.slots)} workers", file=sys.stderr, flush=True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            os.remove(socket_path)
+            for slot in self.slots:
+                if slot.pid:
+                    os.kill(slot.pid, signal.SIGTERM)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-forked pool of face workers")
+    parser.add_argument("--socket", required=True, help="unix socket path to serve on")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 1) // 2))
+    parser.add_argument("--max-rss-mb", type=float, default=0, help="recycle a worker above this RSS (0 = off)")
+    parser.add_argument("--max-requests", type=int, default=0, help="recycle a worker after this many requests (0 = off)")
+    parser.add_argument("--preload", action="store_true",
+                        help="load models once before forking (TensorFlow is not fork-safe; see above)")
+    parser.add_argument("--metrics-port", type=int, default=0, help="first per-worker Prometheus port (0 = off)")
+    args = parser.parse_args()
+
+    load_dotenv()
+    # Each worker keeps its own result cache for resent uploads
+    os.environ.setdefault("FACE_RESULT_CACHE_TTL", str(WORKER_TTL_SECONDS))
+    intra_op = configure_threads(args.workers)
+
+    from face_pipeline import log_with_time
+    log_with_time(f"Face pool starting: {args.workers} workers x {intra_op} TF threads")
+
+    worker = None
+    if args.preload:
+        log_with_time("Warning: --preload initializes TensorFlow before forking; workers may deadlock")
+        # Imported only now so TensorFlow picks up the thread settings above
+        import face_worker
+        worker = face_worker.FaceWorker()
+        worker.warm_up()
+
+    supervisor = Supervisor(
+        worker, args.workers, args.max_rss_mb, args.max_requests, args.preload, args.metrics_port
+    )
+    try:
+        asyncio.run(supervisor.serve(args.socket))
+    except KeyboardInterrupt:
+        pass
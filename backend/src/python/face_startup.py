@@ -0,0 +1,100 @@
+# FACE_STARTUP.PY - import-time profile and cold-start budget for the face scripts
+#
+#   python face_startup.py profile [--module match_face] [--top 15]
+#   python face_startup.py bench [--module register_face] [--runs 5] [--budget-ms 1000]
+#
+# profile imports the modules in a fresh interpreter with -X importtime and
+# reports the time spent per top-level package. bench measures cold start
+# (fresh interpreter + importing the modules) over several runs and exits 1
+# if the median is over budget (--budget-ms, or FACE_STARTUP_BUDGET_MS), or
+# if a heavy dependency got imported at module level again.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+DEFAULT_MODULES = ["match_face", "register_face"]
+DEFAULT_BUDGET_MS = 1000
+# Must only be imported on the code paths that need them
+HEAVY_MODULES = ["deepface", "tensorflow", "cv2", "PIL", "mysql"]
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def run_python(args):
+    return subprocess.run(
+        [sys.executable] + args, cwd=SCRIPT_DIR, capture_output=True, text=True, check=True
+    )
+
+def profile_imports(modules):
+    """Return {top-level package: (self_ms, import count)} for importing modules"""
+    result = run_python(["-X", "importtime", "-c", f"import {', '.join(modules)}"])
+    packages = defaultdict(lambda: [0.0, 0])
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        package = packages[name.strip().split(".")[0]]
+        package[0] += int(self_us) / 1000
+        package[1] += 1
+    return packages
+
+def cold_start(modules):
+    """One cold start: (wall ms, heavy modules that got imported)"""
+    probe = (
+        f"import json, sys; import {', '.join(modules)}; "
+        f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    )
+    start = time.perf_counter()
+    result = run_python(["-c", probe])
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    return elapsed_ms, json.loads(result.stdout)
+
+def bench(modules, runs, budget_ms):
+    timings = []
+    heavy = set()
+    for _ in range(runs):
+        elapsed_ms, loaded = cold_start(modules)
+        timings.append(elapsed_ms)
+        heavy.update(loaded)
+
+    median_ms = statistics.median(timings)
+    return {
+        "modules": modules,
+        "runs": runs,
+        "median_ms": round(median_ms, 1),
+        "max_ms": round(max(timings), 1),
+        "budget_ms": budget_ms,
+        "heavy_imports": sorted(heavy),
+        "passed": median_ms <= budget_ms and not heavy
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile and budget the face scripts' startup time")
+    parser.add_argument("command", choices=["profile", "bench"])
+    parser.add_argument("--module", action="append", help="module to import (repeatable)")
+    parser.add_argument("--top", type=int, default=15, help="packages to list in profile mode")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float,
+                        default=float(os.getenv("FACE_STARTUP_BUDGET_MS", DEFAULT_BUDGET_MS)))
+    args = parser.parse_args()
+    modules = args.module or DEFAULT_MODULES
+
+    if args.command == "profile":
+        packages = profile_imports(modules)
+        ranked = sorted(packages.items(), key=lambda item: item[1][0], reverse=True)
+        print(json.dumps({
+            "modules": modules,
+            "total_ms": round(sum(ms for ms, _ in packages.values()), 1),
+            "packages": [
+                {"package": name, "self_ms": round(ms, 1), "imports": count}
+                for name, (ms, count) in ranked[:args.top]
+            ]
+        }))
+    else:
+        result = bench(modules, args.runs, args.budget_ms)
+        print(json.dumps(result))
+        sys.exit(0 if result["passed"] else 1)
@@ -0,0 +1,64 @@
+# FACE_TEMPLATES.PY - bounded set of representative encodings per employee
+#
+# Every successful match used to add a face_data row. Instead each employee
+# keeps at most MAX_TEMPLATES_PER_EMPLOYEE templates:
+#   - a new encoding within DUPLICATE_DISTANCE of an existing template adds
+#     nothing and is skipped
+#   - when the set is full, the closest pair of templates (new one included)
+#     is the most redundant, and the older encoding of that pair is evicted
+# The same rule replayed oldest-to-newest compacts existing rows (see
+# compact_face_data.py), so storage and lookup cost stay flat per employee.
+import numpy as np
+
+MAX_TEMPLATES_PER_EMPLOYEE = 20
+DUPLICATE_DISTANCE = 0.02
+
+SKIP = "skip"
+INSERT = "insert"
+REPLACE = "replace"
+
+def plan_insert(templates, new_vector, max_templates=MAX_TEMPLATES_PER_EMPLOYEE,
+                duplicate_distance=DUPLICATE_DISTANCE):
+    """Decide what to do with a new normalized encoding.
+
+    templates is a (k, dim) matrix of normalized encodings ordered newest
+    first. Returns (SKIP, None), (INSERT, None) or (REPLACE, i) where i is
+    the row of templates to evict.
+    """
+    if len(templates) == 0:
+        return INSERT, None
+
+    new_similarities = templates @ new_vector
+    closest_to_new = int(np.argmax(new_similarities))
+    if 1.0 - new_similarities[closest_to_new] < duplicate_distance:
+        return SKIP, None
+
+    if len(templates) < max_templates:
+        return INSERT, None
+
+    similarities = templates @ templates.T
+    np.fill_diagonal(similarities, -np.inf)
+    i, j = np.unravel_index(int(np.argmax(similarities)), similarities.shape)
+
+    # The new encoding is the newest, so if it is part of the closest pair
+    # its partner goes; otherwise the older of the pair (higher row) goes
+    if new_similarities[closest_to_new] >= similarities[i, j]:
+        return REPLACE, closest_to_new
+    return REPLACE, int(max(i, j))
+
+def select_templates(vectors, max_templates=MAX_TEMPLATES_PER_EMPLOYEE,
+                     duplicate_distance=DUPLICATE_DISTANCE):
+    """Return indices of the vectors to keep.
+
+    vectors is an (n, dim) matrix of normalized encodings ordered oldest
+    first; the incremental rule is replayed over them in that order.
+    """
+    kept = []  # Newest first, matching plan_insert's ordering
+    for index in range(len(vectors)):
+        action, evict = plan_insert(vectors[kept], vectors[index], max_templates, duplicate_distance)
+        if action == SKIP:
+            continue
+        if action == REPLACE:
+            del kept[evict]
+        kept.insert(0, index)
+    return sorted(kept)
@@ -0,0 +1,205 @@
+# FACE_TRACE.PY - per-request timing spans and slow-request profiling
+#
+# Each pipeline request (match, identify, register) runs as one trace. The
+# stages inside it record named spans with time.perf_counter, and when the
+# request finishes the trace is written as a single JSON line:
+#
+#   {"trace": "match", "trace_id": "...", "duration_ms": 412.3,
+#    "attrs": {"employee_id": "12", "matched": true, ...},
+#    "spans": [{"name": "decode", "start_ms": 0.1, "duration_ms": 8.2}, ...]}
+#
+# FACE_TRACE picks where traces go: "stderr" (default), "off", or a file
+# path to append JSON lines to.
+#
+# Profiling is opt-in: with FACE_PROFILE_SAMPLE=0.05, 5% of requests run
+# under cProfile, and those slower than FACE_PROFILE_SLOW_MS (default 1000)
+# are dumped to FACE_PROFILE_DIR as .prof files (pstats format, readable by
+# snakeviz or python -m pstats). Only one request per process is profiled
+# at a time; a sampled request that starts while another is being profiled
+# just isn't. Traces carry pid and thread ids, so a py-spy recording of a
+# worker can be matched to the requests it saw.
+#
+# Tracing never fails a request: errors while profiling, writing or
+# notifying listeners are reported on stderr and dropped.
+import contextvars
+import cProfile
+import functools
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+DEFAULT_SLOW_MS = 1000
+
+_current = contextvars.ContextVar("face_trace", default=None)
+_listeners = []
+# cProfile can't run in two threads at once (on 3.12+ enable() raises while
+# another profiler holds the sys.monitoring tool slot)
+_profile_lock = threading.Lock()
+
+class Trace:
+    def __init__(self, name, attrs):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.attrs = dict(attrs)
+        self.spans = []
+        self.stack = []
+        self.started_at = datetime.now()
+        self.start = time.perf_counter()
+        self.duration_ms = None
+
+    def annotate(self, **attrs):
+        self.attrs.update(attrs)
+
+    def stage_totals(self):
+        """Milliseconds per span name, summed over repeated spans"""
+        totals = {}
+        for s in self.spans:
+            totals[s["name"]] = totals.get(s["name"], 0.0) + s["duration_ms"]
+        return totals
+
+    def to_dict(self):
+        return {
+            "trace": self.name,
+            "trace_id": self.trace_id,
+            "start": self.started_at.isoformat(timespec="milliseconds"),
+            "duration_ms": round(self.duration_ms, 3),
+            "pid": os.getpid(),
+            "thread": threading.get_ident(),
+            "attrs": self.attrs,
+            "spans": self.spans
+        }
+
+def current_trace():
+    return _current.get()
+
+def annotate(**attrs):
+    """Add attributes to the current request trace, if there is one"""
+    t = _current.get()
+    if t is not None:
+        t.annotate(**attrs)
+
+def add_listener(listener):
+    """Call listener(trace) for every finished request trace"""
+    _listeners.append(listener)
+
+@contextmanager
+def span(name, **attrs):
+    """Time a stage of the current request; a no-op outside a trace"""
+    t = _current.get()
+    if t is None:
+        yield
+        return
+
+    record = {"name": name}
+    if t.stack:
+        record["parent"] = t.stack[-1]
+    record.update(attrs)
+    t.stack.append(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        t.stack.pop()
+        record["start_ms"] = round((start - t.start) * 1000, 3)
+        record["duration_ms"] = round((end - start) * 1000, 3)
+        t.spans.append(record)
+
+def _emit(t):
+    output = os.getenv("FACE_TRACE", "stderr")
+    if output == "off":
+        return
+    line = json.dumps(t.to_dict(), default=str)
+    if output == "stderr":
+        print(line, file=sys.stderr, flush=True)
+    else:
+        with open(output, "a") as f:
+            f.write(line + "\n")
+
+def _trace_error(stage, error):
+    print(f"Request trace {stage} failed: {str(error)}", file=sys.stderr, flush=True)
+
+def _start_profile():
+    """A running profiler for a sampled request, or None"""
+    try:
+        sample = float(os.getenv("FACE_PROFILE_SAMPLE", 0))
+        if sample <= 0 or random.random() >= sample:
+            return None
+    except ValueError as e:
+        _trace_error("sampling", e)
+        return None
+    if not _profile_lock.acquire(blocking=False):
+        return None  # Another request is being profiled; skip this sample
+    try:
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+    except Exception as e:
+        _profile_lock.release()
+        _trace_error("profiling", e)
+        return None
+
+def _finish_profile(profile, t):
+    try:
+        profile.disable()
+    finally:
+        _profile_lock.release()
+    if t.duration_ms < float(os.getenv("FACE_PROFILE_SLOW_MS", DEFAULT_SLOW_MS)):
+        return
+    directory = os.getenv("FACE_PROFILE_DIR", ".")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{t.name}-{t.trace_id}-{int(t.duration_ms)}ms.prof")
+    profile.dump_stats(path)
+    t.attrs["profile"] = path
+
+@contextmanager
+def trace(name, **attrs):
+    """Run a request as a trace, or as a span if a trace is already active"""
+    if _current.get() is not None:
+        with span(name, **attrs):
+            yield _current.get()
+        return
+
+    t = Trace(name, attrs)
+    token = _current.set(t)
+    profile = _start_profile()
+    try:
+        yield t
+    finally:
+        t.duration_ms = (time.perf_counter() - t.start) * 1000
+        _current.reset(token)
+        if profile is not None:
+            try:
+                _finish_profile(profile, t)
+            except Exception as e:
+                _trace_error("profiling", e)
+        try:
+            _emit(t)
+        except Exception as e:
+            _trace_error("output", e)
+        for listener in _listeners:
+            try:
+                listener(t)
+            except Exception as e:
+                _trace_error("listener", e)
+
+def traced(name):
+    """Run a pipeline function returning (response, exit_code) as one trace"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with trace(name) as t:
+                response, exit_code = fn(*args, **kwargs)
+                t.annotate(exit_code=exit_code)
+                for key in ("matched", "stored", "success", "error"):
+                    if key in response:
+                        t.attrs[key] = response[key]
+                return response, exit_code
+        return wrapper
+    return decorator
@@ -0,0 +1,358 @@
+# FACE_WORKER.PY - long-lived worker for match and register requests
+#
+# Loads DeepFace models, .env and a MySQL connection pool once, then serves
+# requests as JSON lines, either on stdin/stdout or on a local unix socket:
+#
+#   python face_worker.py                      # stdin/stdout
+#   python face_worker.py --socket /tmp/face.sock
+#   python face_worker.py --socket /tmp/face.sock --batch [--batch-window-ms 5]
+#       [--max-batch-size 16] [--threads 8]
+#   python face_worker.py ... --metrics-port 9464   # Prometheus /metrics (face_metrics.py)
+#
+# With --batch the socket server is asyncio based: requests from concurrent
+# clients run their image stages on a thread pool and their aligned faces
+# are embedded together in micro-batches (see face_batcher.py). Liveness is
+# still checked per image, right after its detection pass.
+#
+# Request:  {"id": 7, "action": "match", "image_path": "...", "employee_id": "12"}
+#           {"id": 8, "action": "register", "image_path": "...", "user_id": "12",
+#            "duplicate_check": "reject"}   # optional, defaults to FACE_DUPLICATE_CHECK
+#           {"id": 9, "action": "identify", "image_path": "...", "top_k": 5}
+#           {"action": "stats"}
+#           {"action": "invalidate", "employee_id": "12"}   # drop cached templates/results
+#           The image may instead be sent inline as "image_b64" (base64 of the
+#           uploaded bytes) or via shared memory as "shm_name" + "shm_size".
+# Response: the same JSON object match_face.py / register_face.py print,
+#           with "id" echoed back when the request carried one.
+from dotenv import load_dotenv
+import argparse
+import asyncio
+import base64
+import concurrent.futures
+import json
+import os
+import socketserver
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from deepface import DeepFace
+
+import match_face
+import register_face
+from embedding_cache import get_encoding_cache
+from result_cache import get_result_cache, WORKER_TTL_SECONDS
+import embedding_snapshot
+from face_db import get_pool
+from face_metrics import get_metrics, component_collector, serve_metrics
+from face_batcher import MicroBatcher, DEFAULT_WINDOW_MS, DEFAULT_MAX_BATCH_SIZE
+from face_pipeline import (
+    log_with_time, read_shared_memory, embed_face, embed_faces_batch, quick_face_check, check_liveness, cascade_stats,
+    DETECTOR_BACKEND, MODEL_NAME, INFERENCE_BACKEND
+)
+from face_config import MATCH_SOURCE, DUPLICATE_CHECK_MODES
+
+# A request thread waiting on the batcher gives up after this long, so one
+# stuck batch fails its callers instead of hanging every request behind it
+EMBED_TIMEOUT_SECONDS = float(os.getenv("FACE_EMBED_TIMEOUT", 30))
+
+class FaceWorker:
+    """Holds warm models and the DB pool shared across requests"""
+
+    def __init__(self):
+        self.batcher = None
+
+    def warm_up(self):
+        """Build Facenet, MTCNN and the anti-spoofing model once up front"""
+        log_with_time("start model warm-up")
+        if INFERENCE_BACKEND == "onnx":
+            import face_onnx
+            face_onnx.get_backend()
+        else:
+            DeepFace.build_model(MODEL_NAME)
+        blank = np.zeros((160, 160, 3), dtype=np.uint8)
+        try:
+            # A blank frame is enough to make DeepFace load and cache the
+            # detector weights
+            DeepFace.extract_faces(
+                img_path=blank,
+                detector_backend=DETECTOR_BACKEND,
+                enforce_detection=False,
+                align=True,
+                anti_spoofing=False
+            )
+            check_liveness(blank, {"x": 40, "y": 40, "w": 80, "h": 80})  # Loads the anti-spoofing models
+        except Exception as e:
+            log_with_time(f"Detector warm-up failed: {str(e)}")
+        quick_face_check(blank)  # Loads the Haar cascade for the fast-reject stage
+        log_with_time("end model warm-up")
+
+    def request_image(self, request):
+        """Return the image a request refers to: raw bytes or a file path"""
+        if "image_b64" in request:
+            return base64.b64decode(request["image_b64"])
+        if "shm_name" in request:
+            return read_shared_memory(request["shm_name"], int(request["shm_size"]))
+        return request["image_path"]
+
+    def handle(self, request, embed=embed_face):
+        action = request.get("action")
+
+        if action == "match":
+            image = self.request_image(request)
+            with get_pool().connection() as db:
+                response, _ = match_face.match_face(image, str(request["employee_id"]), db, embed)
+            return response
+
+        if action == "identify":
+            image = self.request_image(request)
+            with get_pool().connection() as db:
+                response, _ = match_face.identify_face(
+                    image, db, int(request.get("top_k", match_face.IDENTIFY_TOP_K)), embed
+                )
+            return response
+
+        if action == "register":
+            try:
+                user_id_int = int(request["user_id"])
+            except (TypeError, ValueError):
+                return {"success": False, "error": "user_id must be a valid integer"}
+            duplicate_check = request.get("duplicate_check", register_face.DUPLICATE_CHECK)
+            if duplicate_check not in DUPLICATE_CHECK_MODES:
+                return {"success": False, "error": f"duplicate_check must be one of {', '.join(DUPLICATE_CHECK_MODES)}"}
+            response, _ = register_face.register_face(
+                self.request_image(request), user_id_int, embed, duplicate_check
+            )
+            return response
+
+        if action == "ping":
+            return {"ok": True}
+
+        if action == "invalidate":
+            # Another pool worker changed this employee's templates
+            get_encoding_cache().invalidate(request["employee_id"])
+            get_result_cache().invalidate(request["employee_id"])
+            return {"ok": True}
+
+        if action == "stats":
+            stats = {"encoding_cache": get_encoding_cache().stats(), "result_cache": get_result_cache().stats(),
+                     "db_pool": get_pool().stats(), "cascade": cascade_stats()}
+            if MATCH_SOURCE == "snapshot":
+                stats["snapshot"] = embedding_snapshot.get_snapshot().stats()
+            if self.batcher:
+                stats["batcher"] = self.batcher.stats()
+            return stats
+
+        return {"error": f"Unknown action: {action}"}
+
+    def handle_line(self, line, embed=embed_face):
+        """Decode one JSON request line and return one JSON response line"""
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return json.dumps({"error": f"Invalid request: {str(e)}"})
+
+        try:
+            response = self.handle(request, embed)
+        except KeyError as e:
+            response = {"error": f"Missing field: {str(e)}"}
+        except Exception as e:
+            response = {"error": str(e)}
+
+        if isinstance(request, dict) and "id" in request:
+            response = dict(response, id=request["id"])
+        return json.dumps(response)
+
+    def start_metrics(self, port):
+        """Export request metrics and component stats on a local HTTP port"""
+        metrics = get_metrics()
+        metrics.add_collector(component_collector(get_encoding_cache().stats, {
+            "employees": ("face_encoding_cache_employees", "gauge", "Employees held in the encoding cache"),
+            "bytes": ("face_encoding_cache_bytes", "gauge", "Encoding cache size"),
+            "hits": ("face_encoding_cache_hits_total", "counter", "Encoding cache hits"),
+            "misses": ("face_encoding_cache_misses_total", "counter", "Encoding cache misses")
+        }))
+        metrics.add_collector(component_collector(get_result_cache().stats, {
+            "entries": ("face_result_cache_entries", "gauge", "Match results held for resent images"),
+            "hits": ("face_result_cache_hits_total", "counter", "Resent images answered from the cache"),
+            "phash_hits": ("face_result_cache_phash_hits_total", "counter", "Re-encoded resends matched by perceptual hash"),
+            "misses": ("face_result_cache_misses_total", "counter", "Match requests that ran the pipeline"),
+            "inflight_waits": ("face_result_cache_inflight_waits_total", "counter", "Duplicates that waited for the first request")
+        }))
+        metrics.add_collector(component_collector(get_pool().stats, {
+            "size": ("face_db_pool_size", "gauge", "Maximum DB connections"),
+            "in_use": ("face_db_pool_in_use", "gauge", "DB connections borrowed by requests"),
+            "idle": ("face_db_pool_idle", "gauge", "Open DB connections waiting in the pool"),
+            "waits": ("face_db_pool_waits_total", "counter", "Requests that waited for a DB connection"),
+            "reconnects": ("face_db_pool_reconnects_total", "counter", "Dropped DB connections replaced")
+        }))
+        metrics.add_collector(component_collector(lambda: self.batcher.stats() if self.batcher else None, {
+            "queue_depth": ("face_batch_queue_depth", "gauge", "Faces waiting for the next embedding batch"),
+            "batches": ("face_batches_total", "counter", "Embedding batches run"),
+            "items": ("face_batch_items_total", "counter", "Faces embedded in batches"),
+            "fill_rate": ("face_batch_fill_rate", "gauge", "Mean batch size over max batch size")
+        }))
+        metrics.add_collector(component_collector(cascade_stats, {
+            name: (f"face_cascade_{name}_total", "counter", f"Fast-reject cascade: {name.replace('_', ' ')}")
+            for name in cascade_stats()
+        }))
+        if MATCH_SOURCE == "snapshot":
+            metrics.add_collector(component_collector(embedding_snapshot.get_snapshot().stats, {
+                "rows": ("face_snapshot_rows", "gauge", "Live rows in the embedding snapshot"),
+                "dead_slots": ("face_snapshot_dead_slots", "gauge", "Replaced or deleted rows awaiting a rewrite"),
+                "high_water_id": ("face_snapshot_high_water_id", "gauge", "Highest face_data id in the snapshot")
+            }))
+        serve_metrics(port)
+        log_with_time(f"Metrics on http://127.0.0.1:{port}/metrics")
+
+    def start_snapshot_refresh(self):
+        """Keep the shared embedding snapshot current; one process per host does the work"""
+        if MATCH_SOURCE == "snapshot":
+            embedding_snapshot.start_refresher(get_pool())
+            log_with_time(f"Refreshing embedding snapshot in {embedding_snapshot.snapshot_dir()}")
+
+    def close(self):
+        get_pool().close()
+        log_with_time("Database connection closed")
+
+def protocol_stdout():
+    """Keep the real stdout for protocol lines and send every other write to stderr.
+
+    DeepFace and TensorFlow occasionally print to stdout. Pointing fd 1 and
+    sys.stdout at stderr once, before any request thread starts, keeps them
+    off the protocol channel without swapping sys.stdout per request.
+    """
+    sys.stdout.flush()
+    out = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+    return out
+
+def serve_stdio(worker, out):
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        out.write(worker.handle_line(line) + "\n")
+        out.flush()
+
+def serve_socket(worker, socket_path):
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for raw in self.rfile:
+                line = raw.decode("utf-8")
+                if not line.strip():
+                    continue
+                self.wfile.write((worker.handle_line(line) + "\n").encode("utf-8"))
+                self.wfile.flush()
+
+    # UnixStreamServer handles one client at a time, which keeps model
+    # inference and the shared DB connection single-threaded
+    with socketserver.UnixStreamServer(socket_path, Handler) as server:
+        log_with_time(f"Face worker listening on {socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(socket_path)
+
+async def serve_batched(worker, socket_path, window_ms, max_batch_size, threads):
+    """Serve concurrent socket clients, micro-batching their embeddings"""
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    loop = asyncio.get_running_loop()
+    worker.batcher = MicroBatcher(embed_faces_batch, window_ms, max_batch_size)
+    worker.batcher.start()
+    executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="request")
+
+    def batched_embed(face):
+        # Called on a request thread: hand the face to the event loop's
+        # batcher and block this thread until its batch has run
+        future = asyncio.run_coroutine_threadsafe(worker.batcher.submit(face), loop)
+        try:
+            return future.result(timeout=EMBED_TIMEOUT_SECONDS)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise TimeoutError(f"Embedding batch did not finish within {EMBED_TIMEOUT_SECONDS}s")
+
+    async def handle_client(reader, writer):
+        pending = set()
+        write_lock = asyncio.Lock()
+
+        async def respond(line):
+            response = await loop.run_in_executor(executor, worker.handle_line, line, batched_embed)
+            async with write_lock:
+                writer.write((response + "\n").encode("utf-8"))
+                await writer.drain()
+
+        # Requests on one connection run concurrently; responses carry their "id"
+        while True:
+            raw = await reader.readline()
+            if not raw:
+                break
+            line = raw.decode("utf-8")
+            if line.strip():
+                task = loop.create_task(respond(line))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+
+        if pending:
+            await asyncio.gather(*pending)
+        writer.close()
+
+    server = await asyncio.start_unix_server(handle_client, path=socket_path)
+    log_with_time(f"Batched face worker listening on {socket_path}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await worker.batcher.stop()
+        executor.shutdown(wait=True)
+        os.remove(socket_path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Long-lived face match/register worker")
+    parser.add_argument("--socket", help="serve on this unix socket path instead of stdin/stdout")
+    parser.add_argument("--batch", action="store_true", help="micro-batch embeddings across concurrent requests (needs --socket)")
+    parser.add_argument("--batch-window-ms", type=float, default=DEFAULT_WINDOW_MS)
+    parser.add_argument("--max-batch-size", type=int, default=DEFAULT_MAX_BATCH_SIZE)
+    parser.add_argument("--threads", type=int, default=8, help="request threads in --batch mode")
+    parser.add_argument("--metrics-port", type=int, default=int(os.getenv("FACE_METRICS_PORT", 0)),
+                        help="serve Prometheus metrics on this local port (0 = off)")
+    args = parser.parse_args()
+    if args.batch and not args.socket:
+        parser.error("--batch requires --socket")
+
+    log_with_time("Face worker started")
+    load_dotenv()
+    # Resent uploads can only be answered from memory in a long-lived process
+    os.environ.setdefault("FACE_RESULT_CACHE_TTL", str(WORKER_TTL_SECONDS))
+    if args.batch:
+        # One connection per request thread unless configured otherwise
+        os.environ.setdefault("FACE_DB_POOL_SIZE", str(args.threads))
+
+    # In stdio mode stdout is the protocol channel; set it aside before model
+    # loading can print anything to it
+    out = protocol_stdout() if not (args.batch or args.socket) else None
+    worker = FaceWorker()
+    worker.warm_up()
+    if args.metrics_port:
+        worker.start_metrics(args.metrics_port)
+    worker.start_snapshot_refresh()
+    log_with_time("Face worker ready")
+
+    try:
+        if args.batch:
+            asyncio.run(serve_batched(
+                worker, args.socket, args.batch_window_ms, args.max_batch_size, args.threads
+            ))
+        elif args.socket:
+            serve_socket(worker, args.socket)
+        else:
+            serve_stdio(worker, out)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.close()
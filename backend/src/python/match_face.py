@@ -2,317 +2,440 @@
 from dotenv import load_dotenv
 import sys
 import json
-import mysql.connector
-import os
 import numpy as np
-from deepface import DeepFace
-import pickle
+from face_encoding_format import encode_embedding
+from face_matcher import normalize, build_encoding_matrix, find_matches
+from face_templates import plan_insert, SKIP, REPLACE, MAX_TEMPLATES_PER_EMPLOYEE
+import face_index
+import face_crops
+from face_trace import span, annotate, traced
+from face_db import get_pool
+from face_config import MATCH_THRESHOLD, MATCH_SOURCE
+from embedding_cache import get_encoding_cache
+from result_cache import get_result_cache, content_hash, perceptual_hash
+import embedding_snapshot
 from datetime import datetime
-import cv2
-import tempfile
-
-def log_with_time(message):
-    timestamp = datetime.now().strftime('%H:%M:%S.%f')[:-3]
-    print(f"[{timestamp}] {message}", file=sys.stderr, flush=True)
-
-# Load environment variables from .env
-log_with_time("Match face Script started")
-dotenv_loaded = load_dotenv()
-if not dotenv_loaded:
-    sys.exit(1)
-
-# Get command line arguments
-image_path = sys.argv[1]
-employee_id = sys.argv[2]
-
-# Configuration
-MATCH_THRESHOLD = 0.25
-MAX_FACE_RECORDS_PER_USER = 20  # Limit face records per user for performance
-
-# Optimization 1: Image preprocessing function
-def preprocess_image(image_path, target_size=(640, 640)):
-    """Resize image to reduce processing time while maintaining quality"""
+from face_pipeline import (
+    log_with_time, read_image_bytes, read_source, decode_image, decode_reduced, jpeg_dimensions,
+    preprocess_image, locate_faces, embed_face, EMBEDDING_DIM, MODEL_NAME
+)
+
+# Configuration (MATCH_THRESHOLD comes from face_config / FACE_MATCH_THRESHOLD)
+MAX_FACE_RECORDS_PER_USER = MAX_TEMPLATES_PER_EMPLOYEE  # Templates are bounded, so this covers them all
+IDENTIFY_TOP_K = 5  # Candidates returned in identification mode
+# Image rejections that depend only on the picture, so a resend gets the same answer
+CACHEABLE_ERRORS = ("No face detected", "Multiple faces detected", "real face")
+
+def update_face_index(row_id, employee_id, face_encoding):
+    """Keep the 1:N identification index in step with a face_data insert"""
     try:
-        img = cv2.imread(image_path)
-        if img is None:
-            return image_path  # Return original if can't load
-
-        # Resize if image is too large
-        height, width = img.shape[:2]
-        if height > target_size[0] or width > target_size[1]:
-            log_with_time(f"Resizing image from {width}x{height} to optimize processing")
-            # Calculate scaling factor to maintain aspect ratio
-            scale = min(target_size[0]/height, target_size[1]/width)
-            new_width = int(width * scale)
-            new_height = int(height * scale)
-            img = cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_AREA)
-
-            # Save resized image to temporary file
-            temp_fd, temp_path = tempfile.mkstemp(suffix='.jpg')
-            os.close(temp_fd)  # Close file descriptor
-            cv2.imwrite(temp_path, img)
-            log_with_time(f"Image resized and saved to temporary file")
-            return temp_path
-
-        return image_path
+        face_index.record_insert(row_id, employee_id, face_encoding)
     except Exception as e:
-        log_with_time(f"Error preprocessing image: {str(e)}")
-        return image_path
+        log_with_time(f"Face index update failed: {str(e)}")
 
-# Optimization 2: Quick face detection check
-def quick_face_check(image_path):
-    """Quick face detection using opencv to pre-filter images"""
+def remove_from_face_index(row_id):
     try:
-        faces = DeepFace.extract_faces(
-            img_path=image_path,
-            detector_backend='opencv',  # Fastest detector
-            enforce_detection=False,
-            align=False,
-            anti_spoofing=False
-        )
-        face_count = len(faces) if faces else 0
-        log_with_time(f"Quick face check detected {face_count} faces")
-        return face_count == 1  # Return True if exactly one face
+        face_index.record_delete(row_id, EMBEDDING_DIM)
     except Exception as e:
-        log_with_time(f"Quick face check failed: {str(e)}")
-        return False  # Proceed with full processing if quick check fails
+        log_with_time(f"Face index update failed: {str(e)}")
 
-def store_face_encoding_to_db(employee_id, face_encoding, cursor, conn):
+def store_face_crop(row_id, face, evicted_row_id=None):
+    """Retain the aligned crop behind a stored template (FACE_CROP_DIR)"""
+    if not face_crops.enabled() or face is None:
+        return
+    try:
+        face_crops.save_crop(row_id, face_crops.to_crop(face["face"]))
+        if evicted_row_id is not None:
+            face_crops.delete_crops([evicted_row_id])
+    except Exception as e:
+        log_with_time(f"Face crop store failed: {str(e)}")
+
+def replan_insert(employee_id, face_encoding, db):
+    """Plan a template insert from the employee's rows as they are now.
+
+    The rows stay locked until the caller commits or rolls back; with none
+    yet, the next-key lock on the employeeID range still holds back another
+    transaction's first insert. Returns (action, row id to evict or None).
+    """
+    with span("db_fetch", step="replan"):
+        face_records = db.query("recent_encodings_for_update", (employee_id, MAX_FACE_RECORDS_PER_USER))
+    matrix, kept_records, _ = build_encoding_matrix(face_records, EMBEDDING_DIM, MODEL_NAME)
+    action, evict_index = plan_insert(matrix, normalize(face_encoding))
+    return action, kept_records[evict_index][3] if action == REPLACE else None
+
+def store_face_encoding_to_db(employee_id, face_encoding, db, evicted_row_id=None, face=None):
+    """Insert a matched encoding as a new template, evicting one if the set is full.
+
+    evicted_row_id is the eviction the caller planned from the templates it
+    matched against. Those may be stale (the encoding cache, the snapshot,
+    another worker or a concurrent match), so the plan is made again from
+    the employee's rows, locked until commit, and that plan is the one
+    written. face is the aligned face from detection, kept in the crop
+    store if enabled. Returns True once stored, False on a storage error,
+    or None when the templates turned out to cover the encoding already.
+    """
+    import mysql.connector
     try:
         # Convert face encoding to binary format for LONGBLOB storage
-        face_encoding_blob = pickle.dumps(face_encoding)
-
-        # Insert new row with face encoding (keep all data, don't delete)
-        cursor.execute("""
-                       INSERT INTO face_data (employeeID, face_encoding, createdAt)
-                       VALUES (%s, %s, NOW())
-                       """, (employee_id, face_encoding_blob))
-
-        conn.commit()
+        face_encoding_blob = encode_embedding(face_encoding, MODEL_NAME)
+
+        # Keep the template set bounded: an INSERT planned from a stale
+        # "not full yet" view would grow it as surely as a stale eviction
+        planned_row_id = evicted_row_id
+        action, evicted_row_id = replan_insert(employee_id, face_encoding, db)
+        stale = evicted_row_id != planned_row_id
+        if stale:
+            log_with_time("Templates changed since they were read - storing as planned from face_data")
+            get_encoding_cache().invalidate(employee_id)
+        if action == SKIP:
+            db.rollback()
+            return None
+        # Drop the evicted template in the same transaction
+        if evicted_row_id is not None and db.execute("delete_template", (evicted_row_id, employee_id)).rowcount == 0:
+            raise RuntimeError(f"Template {evicted_row_id} vanished while locked")
+
+        row_id = db.execute("insert_encoding", (employee_id, face_encoding_blob)).lastrowid
+
+        db.commit()
+        if evicted_row_id is not None:
+            remove_from_face_index(evicted_row_id)
+        update_face_index(row_id, employee_id, face_encoding)
+        store_face_crop(row_id, face, evicted_row_id)
+
+        # Write-through so the next verification sees this encoding without a SELECT
+        normalized = normalize(face_encoding)
+        if normalized is not None and not stale:
+            get_encoding_cache().prepend(
+                employee_id, normalized,
+                (employee_id, None, datetime.now().replace(microsecond=0), row_id),
+                MAX_FACE_RECORDS_PER_USER, evicted_row_id
+            )
         return True
     except mysql.connector.Error as db_error:
-        conn.rollback()
-        print(json.dumps({"matched": False, "error": f"Database storage error: {str(db_error)}"}))
+        db.rollback()
+        log_with_time(f"Database storage error: {str(db_error)}")
         return False
     except Exception as e:
-        conn.rollback()
-        print(json.dumps({"matched": False, "error": f"Storage error: {str(e)}"}))
+        db.rollback()
+        log_with_time(f"Storage error: {str(e)}")
         return False
 
-def get_recent_face_encodings(employee_id, cursor, limit=MAX_FACE_RECORDS_PER_USER):
-    cursor.execute("""
-                   SELECT employeeID, face_encoding, createdAt
-                   FROM face_data
-                   WHERE employeeID = %s
-                   ORDER BY createdAt DESC
-                       LIMIT %s
-                   """, (employee_id, limit))
-    results = cursor.fetchall()
-    return results
-
-# Database connection
-log_with_time("start database connection")
-conn = mysql.connector.connect(
-    host=os.getenv("DB_HOST"),
-    user=os.getenv("DB_USER"),
-    password=os.getenv("DB_PASS"),
-    database=os.getenv("DB_DATABASE"),
-    autocommit=False
-)
-cursor = conn.cursor()
-log_with_time("end database connection")
+def get_recent_face_encodings(employee_id, db, limit=MAX_FACE_RECORDS_PER_USER):
+    with span("db_fetch"):
+        return db.query("recent_encodings", (employee_id, limit))
+
+def load_employee_encodings(employee_id, db):
+    """Return the employee's cache entry: normalized matrix, records and skip counts.
+
+    Served from the embedding snapshot (FACE_MATCH_SOURCE=snapshot) or the
+    embedding cache when possible, otherwise fetched from face_data and
+    decoded once. Returns None if the employee has no face data.
+    """
+    if MATCH_SOURCE == "snapshot":
+        with span("snapshot_lookup"):
+            entry = embedding_snapshot.get_snapshot().employee_encodings(employee_id, MAX_FACE_RECORDS_PER_USER)
+        annotate(snapshot_hit=entry is not None)
+        if entry is not None:
+            return entry
+        # Not in the snapshot yet (e.g. registered since the last refresh)
+
+    cache = get_encoding_cache()
+    entry = cache.get(employee_id)
+    annotate(encoding_cache_hit=entry is not None)
+    if entry is not None:
+        return entry
+
+    face_records = get_recent_face_encodings(employee_id, db)
+    if not face_records:
+        return None
 
-# Track temporary file for cleanup
-temp_image_path = None
+    with span("deserialize", records=len(face_records)):
+        matrix, kept_records, skipped = build_encoding_matrix(face_records, EMBEDDING_DIM, MODEL_NAME)
+    return cache.put(employee_id, matrix, kept_records, skipped, len(face_records))
 
-try:
-    # Optimization 3: Preprocess image first
+def capture_face_encoding(image, embed=embed_face):
+    """Run the image stages and return (captured_encoding, face, error_response).
+
+    face is the aligned face the encoding came from. error_response is the
+    JSON payload to return when the image is rejected, otherwise None. embed turns the aligned face into an encoding; the
+    worker swaps in a micro-batched version.
+    """
+    # Optimization 3: Decode once (at reduced scale where possible) and resize in memory
     log_with_time("start image preprocessing")
-    processed_image_path = preprocess_image(image_path)
-    if processed_image_path != image_path:
-        temp_image_path = processed_image_path  # Track for cleanup
+    image = read_source(image)
+    processed_image = preprocess_image(image)
     log_with_time("end image preprocessing")
 
-    # Optimization 4: Quick face detection check
-    log_with_time("start quick face detection check")
-    if not quick_face_check(processed_image_path):
-        log_with_time("Quick face check failed - proceeding with full processing")
-        # Don't exit here, let the full processing handle the error properly
-    else:
-        log_with_time("Quick face check passed - single face detected")
-    log_with_time("end quick face detection check")
-
-    # Optimization 5: Use MTCNN for better speed/accuracy balance
-    detector_backend = 'mtcnn'  # Change from 'retinaface' to 'mtcnn' for better performance
-
+    # Optimization 4/5: Quick-check cascade, then detect, align and anti-spoof once with MTCNN
     try:
-        log_with_time(f"start deepface.extract_faces({detector_backend}, antispoofing=true)")
-        faces = DeepFace.extract_faces(
-            img_path=processed_image_path,
-            detector_backend=detector_backend,
-            enforce_detection=True,
-            align=True,
-            anti_spoofing=True
-        )
-        log_with_time(f"end deepface.extract_faces({detector_backend}, antispoofing=true)")
+        faces = locate_faces(processed_image, source=image)
 
         # Check if faces were detected
         if not faces or len(faces) == 0:
-            print(json.dumps({"matched": False, "error": "No face detected in the image"}))
-            sys.exit(1)
+            return None, None, {"matched": False, "error": "No face detected in the image"}
 
         # Reject image if more than one face is detected
         if len(faces) > 1:
-            print(json.dumps({
+            return None, None, {
                 "matched": False,
                 "stored": False,
                 "error": f"Multiple faces detected. Please ensure only one face is visible."
-            }))
-            sys.exit(1)
+            }
 
         # Check if the face is real (not spoofed)
         if not faces[0].get("is_real", False):
-            print(json.dumps({
+            return None, None, {
                 "matched": False,
                 "stored": False,
                 "error": "Please use a real face, not a photo or video"
-            }))
-            sys.exit(1)
+            }
 
     except Exception as spoof_error:
-        print(json.dumps({
+        return None, None, {
             "matched": False,
             "stored": False,
             "error": f"Poor image quality or no face detected. Please try again."
-        }))
-        sys.exit(1)
-
-    # Optimization 6: Use same detector backend for consistency and speed
-    log_with_time(f"Start face encoding generation using Facenet, {detector_backend}")
-    face_encodings = DeepFace.represent(
-        img_path=processed_image_path,
-        model_name='Facenet',  # Changed to Facenet (128D) for consistency
-        detector_backend=detector_backend,  # Use same detector as above
-        enforce_detection=True
-    )
-    log_with_time(f"end face encoding generation using Facenet, {detector_backend}")
-
-    if not face_encodings or len(face_encodings) == 0:
-        print(json.dumps({"matched": False, "error": "No face detected in the image"}))
-        sys.exit(1)
+        }
 
-    captured_encoding = np.array(face_encodings[0]["embedding"])
+    # Optimization 6: Embed the aligned crop from the detection pass
+    with span("embed"):
+        captured_encoding = embed(faces[0])
+    if captured_encoding is None:
+        return None, None, {"matched": False, "error": "No face detected in the image"}
 
     # Validate encoding dimension
-    if len(captured_encoding) != 128:
-        print(json.dumps({"matched": False, "error": f"Unexpected encoding dimension: {len(captured_encoding)}. Expected 128"}))
-        sys.exit(1)
+    if len(captured_encoding) != EMBEDDING_DIM:
+        return None, None, {"matched": False, "error": f"Unexpected encoding dimension: {len(captured_encoding)}. Expected {EMBEDDING_DIM}"}
 
-    # FIRST MATCH WITH THE DATABASE - Get most recent 20 face encodings for this employee
-    face_records = get_recent_face_encodings(employee_id, cursor)
-
-    if not face_records:
-        print(json.dumps({
-            "matched": False,
-            "stored": False,
-            "error": "No face data found for this employee. Please register first."
-        }))
-        sys.exit(1)
+    return captured_encoding, faces[0], None
 
-    # Optimization 7: Vectorized distance calculation for better performance
-    log_with_time(f"Starting optimized face comparison with {len(face_records)} stored encodings")
-    matches_found = []
-    best_match = None
-    best_distance = float('inf')
+def hash_image(image, with_phash):
+    """Return (image, digest, phash) for the result cache.
 
-    # Pre-normalize captured encoding for efficiency
-    norm_captured = np.linalg.norm(captured_encoding)
-    if norm_captured == 0:
-        print(json.dumps({"matched": False, "error": "Invalid face encoding detected"}))
-        sys.exit(1)
+    Paths are read once and the bytes passed on. The perceptual hash only
+    needs a thumbnail, so JPEGs are decoded for it at 1/8 scale.
+    """
+    if isinstance(image, str):
+        image = read_image_bytes(image)
+    if isinstance(image, np.ndarray):
+        digest = content_hash(str(image.shape).encode() + image.tobytes())
+    else:
+        digest = content_hash(image)
+    phash = None
+    if with_phash:
+        with span("decode", step="phash"):
+            thumbnail = decode_reduced(image, 8) if jpeg_dimensions(image) else decode_image(image)
+        if thumbnail is not None:
+            phash = perceptual_hash(thumbnail)
+    return image, digest, phash
+
+def is_cacheable(response):
+    """Only results a resend of the same image would get again"""
+    error = response.get("error")
+    if error is not None:
+        return any(fragment in error for fragment in CACHEABLE_ERRORS)
+    # A match whose storage failed should be retried for real
+    return not (response.get("matched") and not response.get("stored") and "storage failed" in response.get("message", ""))
+
+def replay(entry):
+    """A cached response; it never reports a store, the original request did that"""
+    response = dict(entry["response"], cached=True)
+    if response.get("stored"):
+        response["stored"] = False
+        response["message"] = "Face matched; encoding already stored from this image"
+    return response, entry["exit_code"]
+
+@traced("match")
+def match_face(image, employee_id, db, embed=embed_face):
+    """Match an image against the employee's stored encodings.
+
+    image may be a file path ('-' for stdin), raw encoded bytes or an
+    already decoded BGR ndarray. Returns (response, exit_code) where
+    response is the JSON payload the script prints and exit_code is the
+    status the script exits with. A resend of an image answered within
+    FACE_RESULT_CACHE_TTL gets the earlier response (see result_cache.py).
+    """
+    annotate(employee_id=str(employee_id))
+    cache = get_result_cache()
+    if not cache.enabled:
+        return run_match(image, employee_id, db, embed)
+
+    with span("result_cache"):
+        try:
+            image, digest, phash = hash_image(image, cache.phash_bits is not None)
+        except OSError:
+            digest = None  # Unreadable path; the pipeline reports it
+        entry, owner = cache.lookup(employee_id, digest, phash) if digest else (None, False)
+    annotate(result_cache_hit=entry is not None)
+    if entry is not None:
+        log_with_time("Same image answered recently - returning cached result")
+        return replay(entry)
+
+    response, exit_code = None, None
+    try:
+        response, exit_code = run_match(image, employee_id, db, embed)
+        return response, exit_code
+    finally:
+        if owner:
+            cacheable = response is not None and is_cacheable(response)
+            cache.finish(employee_id, digest, phash, response if cacheable else None, exit_code)
+
+def run_match(image, employee_id, db, embed=embed_face):
+    """The match pipeline itself, without the result cache"""
+    try:
+        captured_encoding, face, error_response = capture_face_encoding(image, embed)
+        if error_response:
+            return error_response, 1
 
-    normalized_captured = captured_encoding / norm_captured
+        # FIRST MATCH WITH THE DATABASE - Get most recent 20 face encodings for this employee
+        employee_encodings = load_employee_encodings(employee_id, db)
 
-    for i, (employeeID, face_encoding_blob, created_at) in enumerate(face_records):
-        try:
-            # Deserialize the stored encoding (should be pickled binary data)
-            if isinstance(face_encoding_blob, bytes):
-                stored_encoding = pickle.loads(face_encoding_blob)
+        if employee_encodings is None:
+            return {
+                "matched": False,
+                "stored": False,
+                "error": "No face data found for this employee. Please register first."
+            }, 1
+
+        records_checked = employee_encodings["records_checked"]
+
+        # Optimization 7: Score all stored encodings in one matrix-vector product
+        log_with_time(f"Starting optimized face comparison with {records_checked} stored encodings")
+
+        # Pre-normalize captured encoding for efficiency
+        normalized_captured = normalize(captured_encoding)
+        if normalized_captured is None:
+            return {"matched": False, "error": "Invalid face encoding detected"}, 1
+
+        skipped = employee_encodings["skipped"]
+        records_skipped = sum(skipped.values())
+        if records_skipped:
+            log_with_time(f"Skipped {records_skipped} unusable stored encodings: {skipped}")
+
+        with span("compare", records=records_checked):
+            matches_found, best_match = find_matches(
+                employee_encodings["matrix"], employee_encodings["records"], normalized_captured, MATCH_THRESHOLD
+            )
+
+        log_with_time(f"Face matching completed - Found {len(matches_found)} matches")
+
+        # ONLY STORE IF FACE MATCHES
+        if matches_found:
+            # Store the captured face encoding as a template unless the set already covers it
+            with span("compare", step="plan_insert"):
+                action, evict_index = plan_insert(employee_encodings["matrix"], normalized_captured)
+
+            storage_success = None
+            if action != SKIP:
+                evicted_row_id = employee_encodings["records"][evict_index][3] if action == REPLACE else None
+                with span("db_write"):
+                    storage_success = store_face_encoding_to_db(
+                        employee_id, captured_encoding, db, evicted_row_id, face
+                    )
+
+            response = {
+                "matched": True,
+                "stored": bool(storage_success),
+                "best_match": best_match,
+                "all_matches": matches_found,
+                "total_matches": len(matches_found),
+                "records_checked": records_checked,
+                "records_skipped": records_skipped
+            }
+            if storage_success is None:
+                log_with_time("Captured encoding duplicates a stored template - not storing")
+                response["message"] = "Face matched; encoding already covered by stored templates"
+            elif storage_success:
+                response["message"] = "Face matched and encoding stored successfully"
             else:
-                # Fallback for string format (if migrating from old system)
-                try:
-                    stored_encoding = np.array([float(x) for x in face_encoding_blob.split(',')])
-                except:
-                    stored_encoding = np.array(json.loads(face_encoding_blob))
-
-            stored_encoding = np.array(stored_encoding)
-
-            # Calculate cosine similarity/distance (optimized)
-            norm_stored = np.linalg.norm(stored_encoding)
-            if norm_stored == 0:
-                continue  # Skip if stored encoding is zero vector
-
-            normalized_stored = stored_encoding / norm_stored
-            cosine_similarity = np.dot(normalized_captured, normalized_stored)
-            cosine_distance = 1 - cosine_similarity
-
-            if cosine_distance < MATCH_THRESHOLD:
-                match_info = {
-                    "user_id": employeeID,
-                    "distance": float(cosine_distance),
-                    "similarity": float(cosine_similarity),
-                    "created_at": str(created_at)
-                }
-                matches_found.append(match_info)
-
-                # Track best match
-                if cosine_distance < best_distance:
-                    best_distance = cosine_distance
-                    best_match = match_info
-
-        except Exception as e:
-            continue
-
-    log_with_time(f"Face matching completed - Found {len(matches_found)} matches")
-
-    # ONLY STORE IF FACE MATCHES
-    if matches_found:
-        # Store the captured face encoding since it's a successful match
-        storage_success = store_face_encoding_to_db(employee_id, captured_encoding, cursor, conn)
-
-        response = {
-            "matched": True,
-            "stored": storage_success,
-            "best_match": best_match,
-            "all_matches": matches_found,
-            "total_matches": len(matches_found),
-            "records_checked": len(face_records),
-            "message": "Face matched and encoding stored successfully" if storage_success else "Face matched but storage failed"
-        }
-        print(json.dumps(response))
-    else:
+                response["message"] = "Face matched but storage failed"
+            return response, 0
+
         # DO NOT STORE if no match found
-        response = {
+        return {
             "matched": False,
             "stored": False,
-            "records_checked": len(face_records),
+            "records_checked": records_checked,
+            "records_skipped": records_skipped,
             "message": "Face does not match any stored encodings. Not storing unmatched face."
-        }
-        print(json.dumps(response))
+        }, 0
 
-except Exception as e:
-    conn.rollback()
-    print(json.dumps({"matched": False, "stored": False, "error": str(e)}))
+    except Exception as e:
+        db.rollback()
+        return {"matched": False, "stored": False, "error": str(e)}, 0
 
-finally:
-    # Cleanup temporary file if created
-    if temp_image_path and os.path.exists(temp_image_path):
-        try:
-            os.remove(temp_image_path)
-            log_with_time("Temporary image file cleaned up")
-        except Exception as e:
-            log_with_time(f"Error cleaning up temporary file: {str(e)}")
-
-    cursor.close()
-    conn.close()
-    log_with_time("Script execution completed")
\ No newline at end of file
+@traced("identify")
+def identify_face(image, db, top_k=IDENTIFY_TOP_K, embed=embed_face):
+    """Identify who is in the image by searching every employee's encodings.
+
+    Returns (response, exit_code) like match_face. The response lists the
+    top_k closest employees; matched is True when the closest one is within
+    MATCH_THRESHOLD. Nothing is stored in identification mode.
+    """
+    try:
+        captured_encoding, _, error_response = capture_face_encoding(image, embed)
+        if error_response:
+            return error_response, 1
+
+        normalized_captured = normalize(captured_encoding)
+        if normalized_captured is None:
+            return {"matched": False, "error": "Invalid face encoding detected"}, 1
+
+        log_with_time("start face index search")
+        with span("index_load"):
+            index = face_index.load_or_build(db.cursor(), EMBEDDING_DIM, MODEL_NAME)
+        with span("compare", records=len(index)):
+            candidates = index.search(normalized_captured, top_k)
+        if candidates:
+            annotate(nearest_distance=candidates[0]["distance"])
+        log_with_time(f"end face index search - {len(candidates)} candidates from {len(index)} encodings")
+
+        if candidates and candidates[0]["distance"] < MATCH_THRESHOLD:
+            return {
+                "matched": True,
+                "stored": False,
+                "best_match": candidates[0],
+                "candidates": candidates,
+                "records_checked": len(index),
+                "message": "Face identified"
+            }, 0
+
+        return {
+            "matched": False,
+            "stored": False,
+            "candidates": candidates,
+            "records_checked": len(index),
+            "message": "Face does not match any registered employee."
+        }, 0
+
+    except Exception as e:
+        return {"matched": False, "stored": False, "error": str(e)}, 0
+
+if __name__ == "__main__":
+    # Load environment variables from .env
+    log_with_time("Match face Script started")
+    dotenv_loaded = load_dotenv()
+    if not dotenv_loaded:
+        sys.exit(1)
+
+    # Get command line arguments: <image_path> <employee_id>, or
+    # <image_path> --identify to search every employee (1:N)
+    image_path = sys.argv[1]
+    employee_id = sys.argv[2]
+
+    # Database connection
+    log_with_time("start database connection")
+    pool = get_pool()
+    try:
+        with pool.connection() as db:
+            log_with_time("end database connection")
+            if employee_id == "--identify":
+                response, exit_code = identify_face(image_path, db)
+            else:
+                response, exit_code = match_face(image_path, employee_id, db)
+        print(json.dumps(response))
+    finally:
+        pool.close()
+        log_with_time("Script execution completed")
+
+    sys.exit(exit_code)
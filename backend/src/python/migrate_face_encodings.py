@@ -0,0 +1,77 @@
+# MIGRATE_FACE_ENCODINGS.PY - convert legacy face_data rows to the binary format
+#
+#   python migrate_face_encodings.py [--batch-size 500] [--model Facenet] [--dry-run]
+#
+# Rows holding pickled numpy arrays (or the older text encodings) are
+# rewritten in place as float32 blobs tagged with --model. Rows already in
+# the new format are skipped, so the command can be re-run safely.
+from dotenv import load_dotenv
+import argparse
+import json
+
+import mysql.connector
+
+import face_db
+
+from face_encoding_format import (
+    encode_embedding, decode_legacy_encoding, is_encoded, FORMAT_MAGIC, LEGACY_MODEL_NAME
+)
+from face_pipeline import log_with_time
+
+def migrate(conn, model_name, batch_size, dry_run):
+    cursor = conn.cursor()
+    converted = 0
+    failed = []
+    last_id = 0
+
+    try:
+        while True:
+            # Walk the table by primary key and only fetch rows still in the old format
+            cursor.execute("""
+                           SELECT id, face_encoding
+                           FROM face_data
+                           WHERE id > %s AND LEFT(face_encoding, 2) <> %s
+                           ORDER BY id
+                               LIMIT %s
+                           """, (last_id, FORMAT_MAGIC, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            updates = []
+            for row_id, blob in rows:
+                last_id = row_id
+                if is_encoded(blob):
+                    continue
+                try:
+                    updates.append((encode_embedding(decode_legacy_encoding(blob), model_name), row_id))
+                except Exception as e:
+                    failed.append({"id": row_id, "error": str(e)})
+
+            if updates and not dry_run:
+                cursor.executemany("UPDATE face_data SET face_encoding = %s WHERE id = %s", updates)
+                conn.commit()
+            converted += len(updates)
+            log_with_time(f"Converted {converted} rows (last id {last_id})")
+    except mysql.connector.Error:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    return {"converted": converted, "failed": len(failed), "failures": failed, "dry_run": dry_run}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert pickled face_data encodings to the binary format")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--model", default=LEGACY_MODEL_NAME, help="model name to tag legacy rows with")
+    parser.add_argument("--dry-run", action="store_true", help="decode and count rows without writing")
+    args = parser.parse_args()
+
+    load_dotenv()
+    conn = face_db.connect()
+    try:
+        result = migrate(conn, args.model, args.batch_size, args.dry_run)
+        print(json.dumps(result))
+    finally:
+        conn.close()
@@ -0,0 +1,222 @@
+# REEMBED_FACES.PY - recompute stored embeddings with another model
+#
+#   python reembed_faces.py --model Facenet512 [--batch-size 64] [--max-rate 20] [--threads 2]
+#   python reembed_faces.py --drop-model Facenet
+#
+# Moves a site to a new embedding model without downtime or re-enrolment.
+# Every face_data row keeps its current vector and gains one from --model
+# (the multi-model blob layout in face_encoding_format.py), computed from
+# the aligned crop retained in the crop store (FACE_CROP_DIR, see
+# face_crops.py), streamed in storage order straight into the model without
+# decoding images or running detection again. Workers only ever compare
+# vectors from their own FACE_MODEL_NAME, so both generations can serve at
+# once:
+#
+#   1. Run with --model <new> while the workers stay on the old model.
+#   2. Set FACE_MODEL_NAME=<new> and restart the workers.
+#   3. Run with --model <new> again for templates stored in the meantime,
+#      then with --drop-model <old> to strip the old vectors.
+#
+# The job is throttled (--max-rate faces/second, --threads for TensorFlow,
+# lowered CPU priority) and resumable: rows that already carry the model are
+# skipped, so it can be stopped and re-run at any point. Rows are updated
+# only if their blob is unchanged since they were read, so a template
+# replaced concurrently by match_face.py is left for the next run.
+from dotenv import load_dotenv
+import argparse
+import json
+import os
+import sys
+import time
+
+import face_crops
+import face_db
+import face_index
+from embedding_snapshot import EmbeddingSnapshot, snapshot_dir
+from face_config import MODEL_DIMENSIONS, MODEL_NAME
+from face_encoding_format import stored_embeddings, encode_embeddings
+from face_pipeline import log_with_time
+
+DEFAULT_BATCH_SIZE = 64
+SCAN_BATCH_SIZE = 1000  # face_data rows read per query
+
+def scan_face_data(cursor, batch_size=SCAN_BATCH_SIZE):
+    """Yield lists of (id, employeeID, face_encoding) rows in id order, one query each"""
+    last_id = 0
+    while True:
+        cursor.execute("""
+                       SELECT id, employeeID, face_encoding
+                       FROM face_data
+                       WHERE id > %s
+                       ORDER BY id
+                           LIMIT %s
+                       """, (last_id, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+def write_updates(conn, cursor, updates, dry_run):
+    """UPDATE (new blob, id, old blob) rows; returns how many were still unchanged"""
+    if not updates or dry_run:
+        return len(updates)
+    cursor.executemany("UPDATE face_data SET face_encoding = %s WHERE id = %s AND face_encoding = %s", updates)
+    conn.commit()
+    return cursor.rowcount
+
+class Throttle:
+    """Sleep so that at most max_rate faces per second are processed"""
+
+    def __init__(self, max_rate):
+        self.max_rate = max_rate
+        self.started = time.monotonic()
+        self.done = 0
+
+    def wait(self, count):
+        self.done += count
+        if self.max_rate > 0:
+            ahead = self.done / self.max_rate - (time.monotonic() - self.started)
+            if ahead > 0:
+                time.sleep(ahead)
+
+def embed_rows(conn, cursor, pending, model_name, batch_size, throttle, counts, covered, dry_run):
+    """Stream the pending rows' crops through model_name and add the vectors to the rows.
+
+    pending maps row id -> (employeeID, blob, {model: vector}). Crops are
+    read from the store in storage order, batch_size per forward pass.
+    """
+    from face_pipeline import embed_crops
+
+    found = 0
+    for row_ids, crops in face_crops.iter_crop_batches(pending, batch_size):
+        vectors = embed_crops(crops, model_name)
+        updates = []
+        for row_id, vector in zip(row_ids, vectors):
+            employee_id, blob, embeddings = pending[row_id]
+            if len(vector) != MODEL_DIMENSIONS[model_name]:
+                counts["failed"] += 1
+                continue
+            updates.append((encode_embeddings(dict(embeddings, **{model_name: vector})), row_id, blob))
+            covered.add(employee_id)
+        written = write_updates(conn, cursor, updates, dry_run)
+        counts["reembedded"] += written
+        counts["changed_concurrently"] += len(updates) - written
+        found += len(row_ids)
+        throttle.wait(len(row_ids))
+    counts["no_crop"] += len(pending) - found
+
+def reembed(conn, model_name, batch_size, max_rate, dry_run):
+    read_cursor = conn.cursor()
+    write_cursor = conn.cursor()
+    counts = {"scanned": 0, "already_done": 0, "reembedded": 0, "no_crop": 0,
+              "changed_concurrently": 0, "failed": 0}
+    covered, employees = set(), set()
+    throttle = Throttle(max_rate)
+
+    try:
+        for rows in scan_face_data(read_cursor):
+            pending = {}
+            for row_id, employee_id, blob in rows:
+                counts["scanned"] += 1
+                employees.add(employee_id)
+                try:
+                    embeddings = stored_embeddings(blob)
+                except Exception:
+                    counts["failed"] += 1
+                    continue
+                if model_name in embeddings:
+                    counts["already_done"] += 1
+                    covered.add(employee_id)
+                    continue
+                pending[row_id] = (employee_id, blob, embeddings)
+            embed_rows(conn, write_cursor, pending, model_name, batch_size, throttle, counts, covered, dry_run)
+            log_with_time(f"Re-embedded {counts['reembedded']} rows ({counts['scanned']} scanned, last id {rows[-1][0]})")
+
+        # Have the new model's identification index ready before workers switch
+        if counts["reembedded"] and not dry_run:
+            face_index.build_from_db(write_cursor, MODEL_DIMENSIONS[model_name], model_name,
+                                     face_index.index_path(model_name))
+            # Re-embedding leaves createdAt alone, so an existing snapshot
+            # of the model can't see these rows incrementally
+            snapshot = EmbeddingSnapshot(snapshot_dir(model_name), model_name, MODEL_DIMENSIONS[model_name])
+            if snapshot.load() is not None:
+                snapshot.refresh(write_cursor, full=True, wait=True)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        read_cursor.close()
+        write_cursor.close()
+
+    # Employees left without any template under the model (no retained
+    # crops); they would have to register again once the workers switch
+    return dict(counts, model=model_name, employees_without_model=sorted(employees - covered))
+
+def drop_model(conn, model_name, dry_run):
+    """Strip model_name's vectors from rows that also carry another model"""
+    read_cursor = conn.cursor()
+    write_cursor = conn.cursor()
+    counts = {"scanned": 0, "dropped": 0, "only_model": 0, "changed_concurrently": 0, "failed": 0}
+    try:
+        for rows in scan_face_data(read_cursor):
+            updates = []
+            for row_id, _, blob in rows:
+                counts["scanned"] += 1
+                try:
+                    embeddings = stored_embeddings(blob)
+                except Exception:
+                    counts["failed"] += 1
+                    continue
+                if model_name not in embeddings:
+                    continue
+                if len(embeddings) == 1:
+                    counts["only_model"] += 1  # Never leave a row without a vector
+                    continue
+                del embeddings[model_name]
+                updates.append((encode_embeddings(embeddings), row_id, blob))
+            written = write_updates(conn, write_cursor, updates, dry_run)
+            counts["dropped"] += written
+            counts["changed_concurrently"] += len(updates) - written
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        read_cursor.close()
+        write_cursor.close()
+    return dict(counts, model=model_name)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-embed stored faces with another model from retained crops")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--model", choices=sorted(MODEL_DIMENSIONS), help="model to add embeddings for")
+    mode.add_argument("--drop-model", choices=sorted(MODEL_DIMENSIONS), help="model whose embeddings to remove")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="crops per forward pass")
+    parser.add_argument("--max-rate", type=float, default=0, help="faces per second, 0 for no limit")
+    parser.add_argument("--threads", type=int, default=1, help="TensorFlow threads")
+    parser.add_argument("--dry-run", action="store_true", help="compute but do not write")
+    args = parser.parse_args()
+
+    load_dotenv()
+    if args.drop_model == MODEL_NAME:
+        print(json.dumps({"success": False, "error": f"{MODEL_NAME} is still the configured FACE_MODEL_NAME"}))
+        sys.exit(1)
+    if args.model and not face_crops.enabled():
+        print(json.dumps({"success": False, "error": "FACE_CROP_DIR is not set; no crops to re-embed from"}))
+        sys.exit(1)
+
+    # Stay in the background: few threads, low priority. Must run before TensorFlow loads.
+    os.environ["TF_NUM_INTRAOP_THREADS"] = str(args.threads)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+    os.environ["OMP_NUM_THREADS"] = str(args.threads)
+    os.nice(10)
+
+    conn = face_db.connect()
+    try:
+        if args.model:
+            result = reembed(conn, args.model, args.batch_size, args.max_rate, args.dry_run)
+        else:
+            result = drop_model(conn, args.drop_model, args.dry_run)
+        print(json.dumps(dict(result, success=True, dry_run=args.dry_run)))
+    finally:
+        conn.close()
@@ -2,93 +2,23 @@
 from dotenv import load_dotenv
 import os
 import sys
-import mysql.connector
 import json
-import numpy as np
-from deepface import DeepFace
-import pickle
-from PIL import Image
-import cv2
-import tempfile
-from datetime import datetime
-
-def log_with_time(message):
-    timestamp = datetime.now().strftime('%H:%M:%S.%f')[:-3]
-    print(f"[{timestamp}] {message}", file=sys.stderr, flush=True)
-
-# Load environment variables from .env
-log_with_time("Register face Script started")
-dotenv_loaded = load_dotenv()
-# if not dotenv_loaded:
-#     print("Error: .env file not found or could not be loaded", file=sys.stderr)
-#     sys.exit(1)
-
-# Get arguments
-# if len(sys.argv) < 3:
-#     print("Usage: python register_face.py <image_path> <user_id>", file=sys.stderr)
-#     sys.exit(1)
-
-image_path = sys.argv[1]
-user_id = sys.argv[2]
-
-# Validate user_id is numeric
-try:
-    user_id_int = int(user_id)
-except ValueError:
-    print("Error: user_id must be a valid integer", file=sys.stderr)
-    sys.exit(1)
-
-# Optimization 1: Image preprocessing function
-def preprocess_image(image_path, target_size=(640, 640)):
-    """Resize image to reduce processing time while maintaining quality"""
-    try:
-        img = cv2.imread(image_path)
-        if img is None:
-            return image_path  # Return original if can't load
-
-        # Resize if image is too large
-        height, width = img.shape[:2]
-        if height > target_size[0] or width > target_size[1]:
-            log_with_time(f"Resizing image from {width}x{height} to optimize processing")
-            # Calculate scaling factor to maintain aspect ratio
-            scale = min(target_size[0]/height, target_size[1]/width)
-            new_width = int(width * scale)
-            new_height = int(height * scale)
-            img = cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_AREA)
-
-            # Save resized image to temporary file
-            temp_fd, temp_path = tempfile.mkstemp(suffix='.jpg')
-            os.close(temp_fd)  # Close file descriptor
-            cv2.imwrite(temp_path, img)
-            log_with_time(f"Image resized and saved to temporary file")
-            return temp_path
-
-        return image_path
-    except Exception as e:
-        log_with_time(f"Error preprocessing image: {str(e)}")
-        return image_path
-
-# Optimization 2: Quick face detection check
-def quick_face_check(image_path):
-    """Quick face detection using opencv to pre-filter images"""
-    try:
-        faces = DeepFace.extract_faces(
-            img_path=image_path,
-            detector_backend='opencv',  # Fastest detector
-            enforce_detection=False,
-            align=False,
-            anti_spoofing=False
-        )
-        face_count = len(faces) if faces else 0
-        log_with_time(f"Quick face check detected {face_count} faces")
-        return face_count == 1  # Return True if exactly one face
-    except Exception as e:
-        log_with_time(f"Quick face check failed: {str(e)}")
-        return False  # Proceed with full processing if quick check fails
+from face_encoding_format import encode_embedding
+import face_index
+import face_crops
+from face_trace import span, annotate, traced
+from face_db import get_pool
+from embedding_cache import get_encoding_cache
+from result_cache import get_result_cache
+from face_config import DUPLICATE_CHECK, DUPLICATE_IDENTITY_THRESHOLD
+from face_pipeline import (
+    log_with_time, read_source, preprocess_image, locate_faces, embed_face, EMBEDDING_DIM, MODEL_NAME
+)
 
 def validate_image(image_path):
     if not os.path.exists(image_path):
         raise FileNotFoundError(f"Image file not found: {image_path}")
+    from PIL import Image
     try:
         with Image.open(image_path) as img:
             img.verify()
@@ -96,37 +26,20 @@ def validate_image(image_path):
     except Exception as e:
         raise ValueError(f"Invalid image file: {e}")
 
-def extract_face_encoding(image_path):
-    temp_image_path = None
+def extract_face_encoding(image, embed=embed_face, keep_crop=False):
+    """Return the encoding for a path, raw bytes or decoded ndarray.
+
+    With keep_crop, returns (encoding, aligned uint8 crop) for face_crops.
+    """
     try:
-        # Optimization 3: Preprocess image first
+        # Optimization 3: Decode once (at reduced scale where possible) and resize in memory
         log_with_time("start image preprocessing")
-        processed_image_path = preprocess_image(image_path)
-        if processed_image_path != image_path:
-            temp_image_path = processed_image_path  # Track for cleanup
+        image = read_source(image)
+        processed_image = preprocess_image(image)
         log_with_time("end image preprocessing")
 
-        # Optimization 4: Quick face detection check
-        log_with_time("start quick face detection check")
-        if not quick_face_check(processed_image_path):
-            log_with_time("Quick face check failed - proceeding with full processing")
-        else:
-            log_with_time("Quick face check passed - single face detected")
-        log_with_time("end quick face detection check")
-
-        # Use optimized detector backend (mtcnn for better speed/accuracy balance)
-        detector_backend = 'mtcnn'
-
-        # Anti-spoofing check
-        log_with_time(f"start deepface.extract_faces({detector_backend}, antispoofing=true)")
-        faces = DeepFace.extract_faces(
-            img_path=processed_image_path,
-            detector_backend=detector_backend,
-            enforce_detection=True,
-            align=True,
-            anti_spoofing=True
-        )
-        log_with_time(f"end deepface.extract_faces({detector_backend}, antispoofing=true)")
+        # Optimization 4: Quick-check cascade, then detect, align and anti-spoof once with MTCNN
+        faces = locate_faces(processed_image, source=image)
 
         # Check if faces were detected
         if not faces or len(faces) == 0:
@@ -140,24 +53,18 @@ def extract_face_encoding(image_path):
         if not faces[0].get("is_real", False):
             raise ValueError("Please use a real face, not a photo or video")
 
-        # Generate face encoding using same detector
-        log_with_time(f"Start face encoding generation using Facenet, {detector_backend}")
-        face_encodings = DeepFace.represent(
-            img_path=processed_image_path,
-            model_name='Facenet',
-            detector_backend=detector_backend,
-            enforce_detection=True
-        )
-        log_with_time(f"end face encoding generation using Facenet, {detector_backend}")
-
-        if not face_encodings or len(face_encodings) == 0:
-            raise ValueError("No face detected in the image.")
+        # Generate face encoding from the aligned crop of the same pass
+        with span("embed"):
+            face_encoding = embed(faces[0])
 
-        face_encoding = np.array(face_encodings[0]["embedding"])
+        if face_encoding is None:
+            raise ValueError("No face detected in the image.")
 
-        if len(face_encoding) != 128:
+        if len(face_encoding) != EMBEDDING_DIM:
             raise ValueError(f"Unexpected encoding dimension: {len(face_encoding)}")
 
+        if keep_crop:
+            return face_encoding, face_crops.to_crop(faces[0]["face"])
         return face_encoding
 
     except Exception as e:
@@ -165,82 +72,141 @@ def extract_face_encoding(image_path):
             raise ValueError("No face detected in the image. Please ensure the image contains a clear face.")
         else:
             raise ValueError(f"Face encoding extraction failed: {str(e)}")
-    finally:
-        # Cleanup temporary file if created
-        if temp_image_path and os.path.exists(temp_image_path):
+
+def store_face_data_binary(user_id_int, face_encoding_blob):
+    """Store the employee's one registered template.
+
+    A re-registration keeps a single row: the employee's other templates
+    are deleted, so nothing (e.g. reembed_faces.py from their old crops)
+    can bring the replaced face back. Returns (row_id, deleted row ids).
+    """
+    import mysql.connector
+    log_with_time("start database connection")
+    with get_pool().connection() as db:
+        log_with_time("end database connection")
+        try:
+            # Check if employee exists
+            if not db.query("employee_exists", (user_id_int,)):
+                raise ValueError(f"Employee with ID {user_id_int} not found in employee table")
+
+            # Check if face data already exists (locking the rows until commit)
+            existing_rows = [row[0] for row in db.query("employee_face_rows", (user_id_int,))]
+
+            if existing_rows:
+                log_with_time(f"Replacing existing face data ({len(existing_rows)} templates)")
+                row_id, deleted = existing_rows[0], existing_rows[1:]
+                for stale_id in deleted:
+                    db.execute("delete_template", (stale_id, user_id_int))
+                db.execute("update_template", (face_encoding_blob, row_id))
+            else:
+                log_with_time("Inserting new face data")
+                row_id, deleted = db.execute("insert_encoding", (user_id_int, face_encoding_blob)).lastrowid, []
+
+            db.commit()
+            get_encoding_cache().invalidate(user_id_int)
+            get_result_cache().invalidate(user_id_int)  # Cached match answers predate these templates
+            log_with_time("Face data stored successfully")
+            return row_id, deleted
+
+        except mysql.connector.Error as db_error:
+            db.rollback()
+            raise Exception(f"Database error: {str(db_error)}")
+
+def find_identity_conflicts(user_id_int, face_encoding):
+    """Search every other employee's templates for the same face"""
+    with get_pool().connection() as db:
+        index = face_index.load_or_build(db.cursor(), EMBEDDING_DIM, MODEL_NAME)
+    return face_index.find_conflicts(index, face_encoding, user_id_int, DUPLICATE_IDENTITY_THRESHOLD)
+
+@traced("register")
+def register_face(image, user_id_int, embed=embed_face, duplicate_check=DUPLICATE_CHECK):
+    """Register a face for the employee.
+
+    image may be a file path ('-' for stdin), raw encoded bytes or an
+    already decoded BGR ndarray. duplicate_check ('off', 'warn' or
+    'reject') controls the search for the same face under other employees.
+
+    Returns (response, exit_code) where response is the JSON payload the
+    script prints and exit_code is the status the script exits with.
+    """
+    annotate(employee_id=str(user_id_int))
+    try:
+        # validate_image(image_path)
+        crop = None
+        if face_crops.enabled():
+            face_encoding, crop = extract_face_encoding(image, embed, keep_crop=True)
+        else:
+            face_encoding = extract_face_encoding(image, embed)
+
+        conflicts = []
+        if duplicate_check != "off":
+            with span("duplicate_check"):
+                conflicts = find_identity_conflicts(user_id_int, face_encoding)
+            if conflicts:
+                log_with_time(f"Face also matches employees {[c['user_id'] for c in conflicts]}")
+                if duplicate_check == "reject":
+                    return {
+                        "success": False,
+                        "error": f"Face already registered to employee {conflicts[0]['user_id']}",
+                        "conflicts": conflicts
+                    }, 1
+
+        # Use binary storage method (LONGBLOB)
+        face_encoding_blob = encode_embedding(face_encoding, MODEL_NAME)
+        with span("db_write"):
+            row_id, deleted_rows = store_face_data_binary(user_id_int, face_encoding_blob)
+
+        # Keep the 1:N identification index in step with the stored template
+        try:
+            face_index.record_replace(user_id_int, row_id, face_encoding)
+        except Exception as e:
+            log_with_time(f"Face index update failed: {str(e)}")
+
+        # Retain the aligned crop so the template can be re-embedded later,
+        # and drop the crops of the templates this registration replaced
+        if face_crops.enabled():
             try:
-                os.remove(temp_image_path)
-                log_with_time("Temporary image file cleaned up")
+                if crop is not None:
+                    face_crops.save_crop(row_id, crop)
+                face_crops.delete_crops(deleted_rows)
             except Exception as e:
-                log_with_time(f"Error cleaning up temporary file: {str(e)}")
+                log_with_time(f"Face crop store failed: {str(e)}")
 
-def store_face_data_binary(user_id_int, face_encoding_blob):
-    conn = None
-    cursor = None
+        log_with_time("Registration completed successfully")
+        response = {"success": True, "message": "Face registered successfully"}
+        if conflicts:
+            response["conflicts"] = conflicts
+        return response, 0
 
+    except Exception as e:
+        log_with_time(f"Registration failed: {str(e)}")
+        return {"success": False, "error": str(e)}, 1
+
+if __name__ == "__main__":
+    # Load environment variables from .env
+    log_with_time("Register face Script started")
+    dotenv_loaded = load_dotenv()
+    # if not dotenv_loaded:
+    #     print("Error: .env file not found or could not be loaded", file=sys.stderr)
+    #     sys.exit(1)
+
+    # Get arguments
+    # if len(sys.argv) < 3:
+    #     print("Usage: python register_face.py <image_path> <user_id>", file=sys.stderr)
+    #     sys.exit(1)
+
+    image_path = sys.argv[1]
+    user_id = sys.argv[2]
+
+    # Validate user_id is numeric
     try:
-        log_with_time("start database connection")
-        conn = mysql.connector.connect(
-            host=os.getenv("DB_HOST"),
-            user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASS"),
-            database=os.getenv("DB_DATABASE"),
-            autocommit=False
-        )
-        cursor = conn.cursor()
-        log_with_time("end database connection")
-
-        # Check if employee exists
-        cursor.execute("SELECT id FROM employee WHERE id = %s", (user_id_int,))
-        if not cursor.fetchone():
-            raise ValueError(f"Employee with ID {user_id_int} not found in employee table")
-
-        # Check if face data already exists
-        cursor.execute("SELECT id FROM face_data WHERE employeeID = %s", (user_id_int,))
-        existing_record = cursor.fetchone()
-
-        if existing_record:
-            log_with_time("Updating existing face data")
-            cursor.execute("""
-                           UPDATE face_data
-                           SET face_encoding = %s, createdAt = NOW()
-                           WHERE employeeID = %s
-                           """, (face_encoding_blob, user_id_int))
-        else:
-            log_with_time("Inserting new face data")
-            cursor.execute("""
-                           INSERT INTO face_data (employeeID, face_encoding, createdAt)
-                           VALUES (%s, %s, NOW())
-                           """, (user_id_int, face_encoding_blob))
-
-        conn.commit()
-        log_with_time("Face data stored successfully")
-
-    except mysql.connector.Error as db_error:
-        if conn:
-            conn.rollback()
-        raise Exception(f"Database error: {str(db_error)}")
-
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-        log_with_time("Database connection closed")
-
-# Main execution
-try:
-    # validate_image(image_path)
-    face_encoding = extract_face_encoding(image_path)
-
-    # Use binary storage method (LONGBLOB)
-    face_encoding_blob = pickle.dumps(face_encoding)
-    store_face_data_binary(user_id_int, face_encoding_blob)
-
-    log_with_time("Registration completed successfully")
-    print(json.dumps({"success": True, "message": "Face registered successfully"}))
-
-except Exception as e:
-    log_with_time(f"Registration failed: {str(e)}")
-    print(json.dumps({"success": False, "error": str(e)}))
-    sys.exit(1)
\ No newline at end of file
+        user_id_int = int(user_id)
+    except ValueError:
+        print("Error: user_id must be a valid integer", file=sys.stderr)
+        sys.exit(1)
+
+    response, exit_code = register_face(image_path, user_id_int)
+    get_pool().close()
+    log_with_time("Database connection closed")
+    print(json.dumps(response))
+    sys.exit(exit_code)
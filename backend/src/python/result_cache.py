@@ -0,0 +1,181 @@
+# RESULT_CACHE.PY - short-lived cache of match results keyed by image content
+#
+# The mobile client retries uploads, users double-tap and flaky networks
+# resend the same photo. In a long-lived process (face_worker.py,
+# face_pool.py) a match request whose image bytes hash (SHA-256) to one
+# already answered for the same employee within FACE_RESULT_CACHE_TTL
+# seconds gets the earlier response back without running detection,
+# anti-spoofing or embedding. A one-shot script can never hit, so the TTL
+# defaults to 0 (off) and the long-lived processes turn it on.
+#
+# With FACE_RESULT_CACHE_PHASH=1 a 64-bit difference hash of the decoded
+# image is kept as well, so a resend that was re-encoded on the way (same
+# picture, different bytes) also hits when its hash is within
+# FACE_RESULT_CACHE_PHASH_BITS bits of a cached one. A near-identical image
+# may be a photo or screen replay of the one just accepted, so only
+# rejections are reused this way; replaying a match takes the exact bytes.
+# The hash is taken from a 1/8-scale decode, so it costs a fraction of the
+# pipeline's own decode.
+#
+# A cached response never stores anything: the template (if any) was
+# written by the request that computed it, so the replay reports
+# "stored": false and "cached": true. Concurrent identical requests are
+# collapsed too; the second one waits for the first instead of running the
+# pipeline and racing it to insert a second face_data row.
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_TTL_SECONDS = 0  # Off unless a long-lived process sets FACE_RESULT_CACHE_TTL
+WORKER_TTL_SECONDS = 30
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_PHASH_BITS = 4
+INFLIGHT_WAIT_SECONDS = 30  # How long a duplicate waits for the first request
+HASH_SIZE = 8  # dHash grid: 8x8 comparisons -> 64 bits
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def perceptual_hash(image):
+    """64-bit difference hash of a decoded BGR image"""
+    import cv2
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int(np.packbits(bits).view('>u8')[0])
+
+class ResultCache:
+    """LRU of (employee, image hash) -> response with a TTL and single-flight"""
+
+    def __init__(self, max_entries, ttl_seconds, phash_bits=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.phash_bits = phash_bits  # None disables perceptual matching
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.hits = 0
+        self.phash_hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.ttl_seconds > 0 and self.max_entries > 0
+
+    def _expired(self, entry):
+        return time.monotonic() - entry["stored_at"] > self.ttl_seconds
+
+    def _find(self, key, phash):
+        """Fresh entry for the exact key, else a perceptually close rejection; lock held"""
+        entry = self.entries.get(key)
+        if entry is not None and self._expired(entry):
+            del self.entries[key]
+            entry = None
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        if phash is None or self.phash_bits is None:
+            return None
+        # Scan is bounded by max_entries and only touches this employee's entries
+        employee_id = key[0]
+        for other_key, other in self.entries.items():
+            if other_key[0] != employee_id or other["phash"] is None or self._expired(other):
+                continue
+            if other["response"].get("matched"):
+                continue  # Never vouch for a look-alike image without anti-spoofing it
+            if bin(other["phash"] ^ phash).count("1") <= self.phash_bits:
+                self.entries.move_to_end(other_key)
+                self.phash_hits += 1
+                return other
+        return None
+
+    def lookup(self, employee_id, digest, phash=None):
+        """Return (cached entry, owns_key).
+
+        With no cached entry the caller owns the key and must call finish()
+        once its response is ready (or it gave up). If another request is
+        computing the same key this waits for it first.
+        """
+        key = (str(employee_id), digest)
+        with self.lock:
+            entry = self._find(key, phash)
+            if entry is not None:
+                return entry, False
+            event = self.inflight.get(key)
+            if event is None:
+                self.inflight[key] = threading.Event()
+                self.misses += 1
+                return None, True
+            self.waits += 1
+
+        event.wait(INFLIGHT_WAIT_SECONDS)
+        with self.lock:
+            entry = self._find(key, phash)
+            if entry is not None:
+                return entry, False
+            # The first request failed in an uncacheable way; run it again
+            self.misses += 1
+            if key not in self.inflight:
+                self.inflight[key] = threading.Event()
+                return None, True
+            return None, False
+
+    def finish(self, employee_id, digest, phash=None, response=None, exit_code=None):
+        """Release an owned key, caching the response if one is given"""
+        key = (str(employee_id), digest)
+        with self.lock:
+            if response is not None:
+                self.entries.pop(key, None)
+                self.entries[key] = {
+                    "response": response,
+                    "exit_code": exit_code,
+                    "phash": phash,
+                    "stored_at": time.monotonic()
+                }
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            event = self.inflight.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def invalidate(self, employee_id):
+        employee_id = str(employee_id)
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == employee_id]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "phash_hits": self.phash_hits,
+                "misses": self.misses,
+                "inflight_waits": self.waits
+            }
+
+_result_cache = None
+
+def get_result_cache():
+    """Return the process-wide cache, created from FACE_RESULT_CACHE_* settings on first use"""
+    global _result_cache
+    if _result_cache is None:
+        phash = os.getenv("FACE_RESULT_CACHE_PHASH", "0") != "0"
+        _result_cache = ResultCache(
+            max_entries=int(os.getenv("FACE_RESULT_CACHE_SIZE", DEFAULT_MAX_ENTRIES)),
+            ttl_seconds=float(os.getenv("FACE_RESULT_CACHE_TTL", DEFAULT_TTL_SECONDS)),
+            phash_bits=int(os.getenv("FACE_RESULT_CACHE_PHASH_BITS", DEFAULT_PHASH_BITS)) if phash else None
+        )
+    return _result_cache
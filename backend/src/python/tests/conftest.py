@@ -0,0 +1,5 @@
+# The face scripts import each other as top-level modules from backend/src/python
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
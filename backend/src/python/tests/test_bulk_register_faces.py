@@ -0,0 +1,89 @@
+import json
+
+import bulk_register_faces
+
+class RecordingCursor:
+    def __init__(self, existing):
+        self.existing = existing  # (employeeID, id) rows the SELECT ... FOR UPDATE returns
+        self.statements = []
+
+    def execute(self, sql, params=()):
+        self.statements.append(("execute", " ".join(sql.split()), list(params)))
+
+    def executemany(self, sql, rows):
+        self.statements.append(("executemany", " ".join(sql.split()), list(rows)))
+
+    def fetchall(self):
+        return self.existing
+
+class Conn:
+    def __init__(self):
+        self.commits = self.rollbacks = 0
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+def test_write_chunk_inserts_new_employees_in_one_statement():
+    conn, cursor = Conn(), RecordingCursor([])
+    with_face_data = set()
+    deleted = bulk_register_faces.write_chunk(conn, cursor, [(1, b"a"), (2, b"b"), (3, b"c")], with_face_data)
+
+    assert deleted == [] and conn.commits == 1
+    (kind, sql, params), = cursor.statements
+    assert kind == "execute"
+    assert sql.endswith("VALUES (%s, %s, NOW()), (%s, %s, NOW()), (%s, %s, NOW())")
+    assert params == [1, b"a", 2, b"b", 3, b"c"]
+    assert with_face_data == {1, 2, 3}
+
+def test_write_chunk_keeps_one_row_for_re_registered_employees():
+    conn, cursor = Conn(), RecordingCursor([(5, 10), (5, 11), (5, 12)])
+    deleted = bulk_register_faces.write_chunk(conn, cursor, [(5, b"new"), (6, b"b")], {5})
+
+    assert deleted == [11, 12]
+    kinds = [(kind, sql.split()[0]) for kind, sql, _ in cursor.statements]
+    assert kinds == [("execute", "SELECT"), ("execute", "INSERT"), ("execute", "DELETE"), ("execute", "UPDATE")]
+    assert cursor.statements[1][2] == [6, b"b"]
+    assert cursor.statements[3][2] == [10, b"new"]
+
+def test_re_registrations_update_in_one_statement():
+    conn, cursor = Conn(), RecordingCursor([(5, 10), (6, 20), (7, 30)])
+    bulk_register_faces.write_chunk(conn, cursor, [(5, b"a"), (6, b"b"), (7, b"c")], {5, 6, 7})
+
+    (kind, sql, params), = [s for s in cursor.statements if s[1].startswith("UPDATE")]
+    assert kind == "execute"
+    assert sql.count("SELECT %s AS id") == 3
+    assert params == [10, b"a", 20, b"b", 30, b"c"]
+
+class EmptyConn(Conn):
+    def cursor(self):
+        return EmptyCursor()
+
+class EmptyCursor(RecordingCursor):
+    def __init__(self):
+        super().__init__([])
+
+    def close(self):
+        pass
+
+def test_report_keeps_the_manifest_spelling_so_a_resume_skips_the_row(tmp_path):
+    report = str(tmp_path / "report.jsonl")
+    rows = [("012", "a.jpg")]
+
+    # No employee 12 yet: the row fails and is reported as "012"
+    counts = bulk_register_faces.bulk_register(EmptyConn(), rows, report, 1, 10, False, "off")
+    assert counts["failed"] == 1
+    assert bulk_register_faces.read_report(report)[1] == {("012", "a.jpg")}
+
+    counts = bulk_register_faces.bulk_register(EmptyConn(), rows, report, 1, 10, False, "off")
+    assert counts["skipped"] == 1
+
+def test_zero_padded_ids_count_as_duplicates(tmp_path):
+    report = str(tmp_path / "report.jsonl")
+    counts = bulk_register_faces.bulk_register(EmptyConn(), [("12", "a.jpg"), ("012", "b.jpg")], report, 1, 10, False, "off")
+    with open(report) as f:
+        errors = [json.loads(line)["error"] for line in f]
+    assert counts["failed"] == 2
+    assert "Duplicate user_id in manifest" in errors
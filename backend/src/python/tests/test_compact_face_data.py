@@ -0,0 +1,69 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+import compact_face_data
+import embedding_snapshot
+from face_config import EMBEDDING_DIM, MODEL_NAME
+from face_encoding_format import encode_embedding
+
+class SqliteConn:
+    """Runs compaction's MySQL-style SQL against SQLite"""
+
+    def __init__(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.conn.execute("CREATE TABLE face_data (id INTEGER PRIMARY KEY, employeeID INTEGER, face_encoding BLOB, createdAt TEXT)")
+
+    def cursor(self):
+        return SqliteCursor(self.conn.cursor())
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+class SqliteCursor:
+    def __init__(self, cursor):
+        self.inner = cursor
+
+    def execute(self, sql, params=()):
+        self.inner.execute(sql.replace("%s", "?"), params)
+
+    def fetchall(self):
+        return self.inner.fetchall()
+
+    def close(self):
+        self.inner.close()
+
+@pytest.fixture(autouse=True)
+def no_side_stores(monkeypatch, tmp_path):
+    monkeypatch.delenv("FACE_CROP_DIR", raising=False)
+    monkeypatch.setenv("FACE_INDEX_PATH", str(tmp_path / "face_index.npz"))
+    monkeypatch.setattr(embedding_snapshot, "_snapshot", embedding_snapshot.EmbeddingSnapshot(str(tmp_path / "snapshot")))
+
+def add_rows(conn, employee_id, vectors, first_id):
+    for i, vector in enumerate(vectors):
+        conn.conn.execute("INSERT INTO face_data VALUES (?, ?, ?, ?)",
+                          (first_id + i, employee_id, encode_embedding(vector, MODEL_NAME), f"2026-01-01 00:00:{i:02d}"))
+
+def test_employees_that_lost_rows_are_notified():
+    conn = SqliteConn()
+    rng = np.random.default_rng(0)
+    add_rows(conn, 7, rng.standard_normal((5, EMBEDDING_DIM)), 1)
+    add_rows(conn, 8, rng.standard_normal((2, EMBEDDING_DIM)), 10)
+    notified = []
+
+    result = compact_face_data.compact(conn, [], 3, 0.02, False, notified.extend)
+
+    assert result["deleted"] == 2
+    assert notified == [7]
+    assert conn.conn.execute("SELECT COUNT(*) FROM face_data WHERE employeeID = 7").fetchone()[0] == 3
+
+def test_dry_run_notifies_nobody():
+    conn = SqliteConn()
+    add_rows(conn, 7, np.random.default_rng(0).standard_normal((5, EMBEDDING_DIM)), 1)
+    notified = []
+    assert compact_face_data.compact(conn, [], 3, 0.02, True, notified.extend)["deleted"] == 2
+    assert notified == []
@@ -0,0 +1,58 @@
+import time
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from embedding_cache import EmbeddingCache
+
+DIM = 4
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    return now
+
+def put(cache, employee_id, rows=1):
+    records = [(employee_id, b"blob", datetime(2026, 1, 1), i) for i in range(rows)]
+    return cache.put(employee_id, np.zeros((rows, DIM), dtype=np.float32), records, {}, rows)
+
+def entry_bytes():
+    cache = EmbeddingCache(1 << 20, 60)
+    put(cache, 1)
+    return cache.stats()["bytes"]
+
+def test_get_refreshes_recency_and_the_oldest_entry_is_evicted(clock):
+    cache = EmbeddingCache(entry_bytes() * 2, 60)
+    put(cache, 1)
+    put(cache, 2)
+    assert cache.get(1) is not None
+    put(cache, 3)
+    assert cache.get(2) is None
+    assert cache.get(1) is not None and cache.get(3) is not None
+    assert cache.stats()["bytes"] <= cache.max_bytes
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = EmbeddingCache(1 << 20, 60)
+    put(cache, 1)
+    clock[0] += 59
+    assert cache.get(1) is not None
+    clock[0] += 2
+    assert cache.get(1) is None
+    assert cache.stats()["employees"] == 0 and cache.stats()["bytes"] == 0
+
+def test_records_drop_their_blobs():
+    cache = EmbeddingCache(1 << 20, 60)
+    put(cache, 1)
+    assert cache.get(1)["records"][0][1] is None
+
+def test_prepend_adds_the_newest_row_and_drops_the_evicted_one():
+    cache = EmbeddingCache(1 << 20, 60)
+    put(cache, 1, rows=3)
+    vector = np.ones(DIM, dtype=np.float32)
+    cache.prepend(1, vector, (1, b"blob", datetime(2026, 2, 1), 9), limit=3, evicted_row_id=1)
+    entry = cache.get(1)
+    assert [r[3] for r in entry["records"]] == [9, 0, 2]
+    assert np.array_equal(entry["matrix"][0], vector)
+    assert cache.stats()["bytes"] == cache._entry_size(entry)
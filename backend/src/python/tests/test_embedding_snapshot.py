@@ -0,0 +1,79 @@
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from embedding_snapshot import EmbeddingSnapshot
+from face_encoding_format import encode_embedding
+
+DIM = 4
+
+class SqliteCursor:
+    """Runs the snapshot's MySQL-style queries against SQLite"""
+
+    def __init__(self, conn):
+        self.cursor = conn.cursor()
+
+    def execute(self, sql, params=()):
+        self.cursor.execute(sql.replace("%s", "?"), params)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+@pytest.fixture
+def conn():
+    sqlite3.register_converter("TIMESTAMP", lambda value: datetime.fromisoformat(value.decode()))
+    conn = sqlite3.connect(":memory:", detect_types=sqlite3.PARSE_DECLTYPES)
+    conn.execute("""
+        CREATE TABLE face_data (
+            id INTEGER PRIMARY KEY, employeeID INTEGER, face_encoding BLOB, createdAt TIMESTAMP
+        )
+    """)
+    yield conn
+    conn.close()
+
+def insert(conn, row_id, employee_id, created, value):
+    vector = np.full(DIM, value, dtype=np.float32)
+    conn.execute("INSERT OR REPLACE INTO face_data VALUES (?, ?, ?, ?)",
+                 (row_id, employee_id, encode_embedding(vector, "Facenet"), created.isoformat(sep=" ")))
+
+def test_incremental_refresh_appends_and_replaces(conn, tmp_path):
+    snapshot = EmbeddingSnapshot(str(tmp_path), "Facenet", DIM)
+    insert(conn, 1, 7, datetime(2026, 1, 1), 1.0)
+    insert(conn, 2, 8, datetime(2026, 1, 2), 2.0)
+    assert snapshot.refresh(SqliteCursor(conn))["rebuilt"]
+    before = snapshot.load()
+
+    insert(conn, 3, 7, datetime(2026, 1, 3), 3.0)  # New template
+    insert(conn, 2, 8, datetime(2026, 1, 4), 4.0)  # Re-registration re-stamps the row
+    result = snapshot.refresh(SqliteCursor(conn))
+    assert (result["added"], result["removed"]) == (2, 1)
+
+    state = snapshot.load()
+    assert state is not before
+    assert before.meta["count"] == 2 and len(before.order) == 2  # The old state stays whole
+    assert [r[3] for r in snapshot.employee_encodings(7, 5)["records"]] == [3, 1]
+    assert [r[3] for r in snapshot.employee_encodings(8, 5)["records"]] == [2]
+    assert snapshot.stats()["rows"] == 3
+
+def test_load_without_files_returns_none(tmp_path):
+    snapshot = EmbeddingSnapshot(str(tmp_path), "Facenet", DIM)
+    assert snapshot.load() is None
+    assert snapshot.employee_encodings(7, 5) is None
+
+def test_refresh_picks_up_a_lower_id_committed_late(conn, tmp_path):
+    snapshot = EmbeddingSnapshot(str(tmp_path), "Facenet", DIM)
+    insert(conn, 1, 7, datetime(2026, 1, 1, 9, 0, 0), 1.0)
+    snapshot.refresh(SqliteCursor(conn))
+
+    # Row 3 commits first and moves the marks past row 2, written a few
+    # seconds earlier by a transaction that commits after the refresh
+    insert(conn, 3, 8, datetime(2026, 1, 1, 9, 0, 10), 3.0)
+    snapshot.refresh(SqliteCursor(conn))
+    insert(conn, 2, 9, datetime(2026, 1, 1, 9, 0, 5), 2.0)
+    result = snapshot.refresh(SqliteCursor(conn), sweep=False)
+
+    assert result["added"] == 1
+    assert [r[3] for r in snapshot.employee_encodings(9, 5)["records"]] == [2]
+    assert snapshot.stats()["rows"] == 3
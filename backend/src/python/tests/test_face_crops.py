@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+
+import face_crops
+from face_crops import CropStore, CROP_SHAPE, CROP_BYTES
+
+def crop(value):
+    return np.full(CROP_SHAPE, value, dtype=np.uint8)
+
+def test_save_replace_and_delete(tmp_path):
+    store = CropStore(str(tmp_path))
+    store.save_many([(1, crop(1)), (2, crop(2))])
+    store.save_many([(1, crop(3))])
+    store.delete([2])
+    ids, batch = next(store.iter_batches())
+    assert ids == [1]
+    assert batch[0][0, 0, 0] == 3
+
+def test_torn_writes_are_truncated_before_the_next_append(tmp_path):
+    store = CropStore(str(tmp_path))
+    store.save_many([(1, crop(1))])
+    # A writer that crashed mid-crop and mid-index-record
+    with open(store._chunk_path(0), "ab") as f:
+        f.write(b"\x07" * (CROP_BYTES // 2))
+    with open(store._index_path(), "ab") as f:
+        f.write(b"\x02\x00\x00")
+
+    # Readers skip the partial index record
+    assert CropStore(str(tmp_path)).locations()["row_id"].tolist() == [1]
+
+    store.save_many([(2, crop(2))])
+    assert os.path.getsize(store._chunk_path(0)) == 2 * CROP_BYTES
+    crops = dict(zip(*next(CropStore(str(tmp_path)).iter_batches())))
+    assert sorted(crops) == [1, 2]
+    assert crops[2][0, 0, 0] == 2
+
+def test_compact_keeps_only_live_crops(tmp_path):
+    store = CropStore(str(tmp_path))
+    store.save_many([(i, crop(i)) for i in range(1, 5)])
+    store.delete([2, 3])
+    stats = store.compact()
+    assert (stats["crops"], stats["dead_slots"]) == (2, 0)
+    ids, batch = next(CropStore(str(tmp_path)).iter_batches())
+    assert ids == [1, 4] and batch[1][0, 0, 0] == 4
+
+def test_crop_round_trip_layout():
+    face = np.random.default_rng(0).random((200, 200, 3))
+    stored = face_crops.to_crop(face)
+    assert stored.shape == CROP_SHAPE and stored.dtype == np.uint8
+    assert face_crops.crop_to_face(stored).max() <= 1.0
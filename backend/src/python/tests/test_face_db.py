@@ -0,0 +1,41 @@
+import pytest
+
+import face_db
+from face_db import FaceDb
+
+class FakeConnection:
+    def __init__(self):
+        self.connection_id = 1
+        self.drop_on_ping = False
+
+    def ping(self, reconnect=False, attempts=1, delay=0):
+        if self.drop_on_ping and reconnect:
+            self.connection_id += 1
+
+    def cursor(self, prepared=False):
+        return FakeCursor()
+
+class FakeCursor:
+    def execute(self, sql, params=()):
+        pass
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def idle_db(monkeypatch):
+    pytest.importorskip("mysql.connector")
+    db = FaceDb(FakeConnection())
+    db.execute("employee_exists", (7,))
+    db.last_used -= face_db.IDLE_PING_SECONDS + 1
+    return db
+
+def test_idle_ping_keeps_prepared_statements(idle_db):
+    prepared = idle_db.statements["employee_exists"]
+    assert idle_db.is_healthy()
+    assert idle_db.statements["employee_exists"] is prepared
+
+def test_reconnect_drops_prepared_statements(idle_db):
+    idle_db.conn.drop_on_ping = True
+    assert idle_db.is_healthy()
+    assert idle_db.statements == {}
@@ -0,0 +1,60 @@
+import json
+import pickle
+
+import numpy as np
+import pytest
+
+from face_encoding_format import (
+    encode_embedding, encode_embeddings, decode_embedding, decode_embeddings, decode_stored_encoding,
+    is_encoded, LEGACY_MODEL_NAME
+)
+
+VECTOR = np.arange(128, dtype=np.float32) / 128
+
+def test_version_1_round_trip():
+    blob = encode_embedding(VECTOR, "Facenet")
+    assert is_encoded(blob) and blob[2] == 1
+    model_name, vector = decode_embedding(blob)
+    assert model_name == "Facenet"
+    assert np.array_equal(vector, VECTOR)
+
+def test_single_model_keeps_the_version_1_layout():
+    assert encode_embeddings({"Facenet": VECTOR}) == encode_embedding(VECTOR, "Facenet")
+
+def test_version_2_round_trip():
+    other = np.ones(512, dtype=np.float32)
+    blob = encode_embeddings({"Facenet": VECTOR, "Facenet512": other})
+    assert blob[2] == 2
+    embeddings = decode_embeddings(blob)
+    assert list(embeddings) == ["Facenet", "Facenet512"]
+    assert np.array_equal(embeddings["Facenet"], VECTOR)
+    assert np.array_equal(embeddings["Facenet512"], other)
+    assert decode_stored_encoding(blob, "Facenet512")[1].shape == (512,)
+    assert decode_stored_encoding(blob, "ArcFace") == ("ArcFace", None)
+
+def test_version_1_length_must_match_exactly():
+    blob = encode_embedding(VECTOR, "Facenet")
+    with pytest.raises(ValueError, match="Truncated"):
+        decode_embedding(blob[:-4])
+    with pytest.raises(ValueError, match="Truncated"):
+        decode_embedding(blob + b"\0\0\0\0")
+
+def test_version_2_rejects_a_short_section():
+    blob = encode_embeddings({"Facenet": VECTOR, "Facenet512": np.ones(512, dtype=np.float32)})
+    with pytest.raises(ValueError, match="Truncated"):
+        decode_embeddings(blob[:-4])
+
+def test_unknown_version_and_magic_are_rejected():
+    blob = bytearray(encode_embedding(VECTOR, "Facenet"))
+    blob[2] = 9
+    with pytest.raises(ValueError, match="Unsupported"):
+        decode_embeddings(bytes(blob))
+    with pytest.raises(ValueError, match="Not a face encoding"):
+        decode_embedding(b"XX" + bytes(blob[2:]))
+
+def test_legacy_rows_decode_as_the_legacy_model():
+    values = [0.25, -0.5, 1.0]
+    for blob in (pickle.dumps(np.array(values)), ",".join(map(str, values)), json.dumps(values)):
+        model_name, vector = decode_stored_encoding(blob)
+        assert model_name == LEGACY_MODEL_NAME
+        assert vector.tolist() == values
@@ -0,0 +1,78 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+import face_index
+from face_index import FaceIndex
+
+DIM = 16
+
+def unit_vectors(count, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((count, DIM)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+@pytest.fixture
+def index_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(face_index, "_loaded", {"path": None, "mtime": None, "index": None})
+    path = str(tmp_path / "face_index.npz")
+    vectors = unit_vectors(10)
+    FaceIndex.build(np.arange(1, 11), np.arange(1, 11) % 3, vectors, DIM).save(path)
+    return path
+
+def test_concurrent_loads_replay_each_record_once(index_file):
+    face_index.load_or_build(None, DIM, path=index_file)
+    for i, vector in enumerate(unit_vectors(200, seed=1)):
+        face_index.record_insert(100 + i, 5, vector, path=index_file)
+
+    barrier = threading.Barrier(8)
+    def load():
+        barrier.wait()
+        face_index.load_or_build(None, DIM, path=index_file)
+    threads = [threading.Thread(target=load) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    index = face_index.load_or_build(None, DIM, path=index_file)
+    assert len(index) == 210
+    assert len(np.unique(index.row_ids)) == 210
+
+    # Records written after the concurrent replays are not skipped
+    face_index.record_insert(999, 6, unit_vectors(1, seed=2)[0], path=index_file)
+    assert 999 in face_index.load_or_build(None, DIM, path=index_file).row_ids
+
+def test_search_ranks_each_employee_once_by_its_closest_row():
+    vectors = np.eye(DIM, dtype=np.float32)[:4]
+    index = FaceIndex.build([1, 2, 3, 4], [10, 10, 20, 30], vectors, DIM)
+    probe = vectors[0] * 0.8 + vectors[2] * 0.6
+    results = index.search(probe, top_k=5)
+    assert [r["user_id"] for r in results] == [10, 20, 30]
+    assert results[0]["face_data_id"] == 1
+    assert results[0]["distance"] == pytest.approx(0.2)
+    assert [r["user_id"] for r in index.search(probe, exclude_employee=10)] == [20, 30]
+
+def test_search_probes_the_nearest_lists():
+    vectors = unit_vectors(400, seed=3)
+    index = FaceIndex.build(np.arange(400), np.arange(400), vectors, DIM)
+    assert len(index.centroids) > 1
+    for i in (0, 123, 399):
+        assert index.search(vectors[i], top_k=1, nprobe=1)[0]["face_data_id"] == i
+
+def test_replay_applies_adds_and_removes_and_leaves_a_torn_record(index_file):
+    vectors = unit_vectors(3, seed=4)
+    face_index.record_insert(50, 7, vectors[0], path=index_file)
+    face_index.record_insert(50, 7, vectors[0], path=index_file)  # Same row twice
+    face_index.record_delete(1, DIM, path=index_file)
+    face_index.record_replace(2, 51, vectors[1], path=index_file)
+    with open(index_file + ".log", "ab") as f:
+        f.write(b"\x01\x00")  # A record cut short by a crashed writer
+
+    index = FaceIndex.load(index_file)
+    assert list(index.row_ids[index.row_ids >= 50]) == [50, 51]
+    assert 1 not in index.row_ids
+    assert list(index.row_ids[index.employee_ids == 2]) == [51]
+    assert index.log_offset == os.path.getsize(index_file + ".log") - 2
@@ -0,0 +1,126 @@
+import numpy as np
+import pytest
+
+import face_pipeline
+
+FACE = (170, 150, 60, 60)  # x, y, w, h of the bright square standing in for a face
+
+def make_frame():
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 200, size=(400, 400, 3), dtype=np.uint8)
+    x, y, w, h = FACE
+    frame[y:y + h, x:x + w] = 255
+    return frame
+
+def fake_extract_faces(image):
+    """Find the bright square wherever it sits in the image it is given"""
+    ys, xs = np.nonzero((image == 255).all(axis=2))
+    if len(xs) == 0:
+        raise ValueError("Face could not be detected")
+    area = {"x": int(xs.min()), "y": int(ys.min()), "w": int(xs.max() - xs.min() + 1), "h": int(ys.max() - ys.min() + 1)}
+    return [{"face": np.zeros((160, 160, 3)), "facial_area": area}]
+
+def fake_liveness(frame, area):
+    """Scores the 4x context around the box, as Fasnet's second model crops it"""
+    x, y, w, h = (area[k] for k in ("x", "y", "w", "h"))
+    x0, y0 = max(0, x - int(1.5 * w)), max(0, y - int(1.5 * h))
+    context = frame[y0:y + int(2.5 * h), x0:x + int(2.5 * w)]
+    padded = np.zeros((4 * h, 4 * w, 3), dtype=np.float64)
+    padded[:context.shape[0], :context.shape[1]] = context
+    score = float(padded.mean() / 255)
+    return score > 0.5, score
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    monkeypatch.setattr(face_pipeline, "QUICK_REJECT_ENABLED", True)
+    monkeypatch.setattr(face_pipeline, "extract_faces", fake_extract_faces)
+    monkeypatch.setattr(face_pipeline, "check_liveness", fake_liveness)
+    monkeypatch.setattr(
+        face_pipeline, "quick_face_check",
+        lambda image: (face_pipeline.SINGLE_FACE, [(160, 140, 80, 80)])
+    )
+    return face_pipeline
+
+def test_region_path_scores_liveness_on_the_full_frame(pipeline):
+    frame = make_frame()
+    before = pipeline.cascade_stats()["roi_used"]
+    located = pipeline.locate_faces(frame)
+    assert pipeline.cascade_stats()["roi_used"] == before + 1
+    full = pipeline.detect_faces(frame)
+
+    assert located[0]["facial_area"] == full[0]["facial_area"] == dict(zip("xywh", FACE))
+    assert located[0]["antispoof_score"] == full[0]["antispoof_score"]
+    assert located[0]["is_real"] == full[0]["is_real"]
+
+    # Scoring the detection region instead would have lost context
+    crop, _, _ = pipeline.detection_region(frame, (160, 140, 80, 80))
+    _, cropped_score = fake_liveness(crop, fake_extract_faces(crop)[0]["facial_area"])
+    assert cropped_score != located[0]["antispoof_score"]
+
+def test_to_frame_coordinates_undoes_region_scale_and_origin():
+    faces = [{"facial_area": {"x": 20, "y": 10, "w": 80, "h": 60, "left_eye": (40, 30), "right_eye": None}}]
+    pipeline_faces = face_pipeline.to_frame_coordinates(faces, (100, 50), 2.0)
+    area = pipeline_faces[0]["facial_area"]
+    assert (area["x"], area["y"], area["w"], area["h"]) == (110, 55, 40, 30)
+    assert area["left_eye"] == (120, 65)
+    assert area["right_eye"] is None
+
+def test_crop_to_region_clips_to_the_frame():
+    frame = np.zeros((100, 200, 3), dtype=np.uint8)
+    crop, origin = face_pipeline.crop_to_region(frame, (10, 10, 40, 40))
+    assert origin == (0, 0)
+    assert crop.shape == (70, 70, 3)
+
+def test_each_thread_gets_its_own_cascade(monkeypatch):
+    import threading
+    import cv2
+    # Stand-in so the test doesn't depend on which OpenCV build ships the Haar module
+    monkeypatch.setattr(cv2, "CascadeClassifier", lambda path: object(), raising=False)
+    monkeypatch.setattr(face_pipeline, "_cascade_local", threading.local())
+    cascades = []
+    thread = threading.Thread(target=lambda: cascades.append(face_pipeline._face_cascade()))
+    thread.start()
+    thread.join()
+    assert face_pipeline._face_cascade() is face_pipeline._face_cascade()
+    assert cascades[0] is not face_pipeline._face_cascade()
+
+def test_model_channels_flips_rgb_faces_and_crop_batches_to_bgr():
+    face = np.zeros((4, 4, 3))
+    face[..., 0] = 1.0  # Pure red in extract_faces' RGB layout
+    assert face_pipeline.model_channels(face)[0, 0].tolist() == [0.0, 0.0, 1.0]
+    assert (face_pipeline.model_channels(face) * 255 == face_pipeline.aligned_face_to_bgr(face)).all()
+    crops = np.stack([face, face])
+    assert face_pipeline.model_channels(crops)[1, 0, 0].tolist() == [0.0, 0.0, 1.0]
+
+def jpeg_bytes(width, height):
+    import cv2
+    return cv2.imencode(".jpg", np.zeros((height, width, 3), dtype=np.uint8))[1].tobytes()
+
+def test_jpeg_dimensions_reads_the_frame_header():
+    assert face_pipeline.jpeg_dimensions(jpeg_bytes(320, 200)) == (320, 200)
+    # Fill bytes and an unknown segment before the frame header
+    data = jpeg_bytes(64, 48)
+    padded = data[:2] + b"\xff\xff\xe5\x00\x04ab" + data[2:]
+    assert face_pipeline.jpeg_dimensions(padded) == (64, 48)
+
+def test_jpeg_dimensions_ignores_other_data():
+    import cv2
+    png = cv2.imencode(".png", np.zeros((10, 10, 3), dtype=np.uint8))[1].tobytes()
+    assert face_pipeline.jpeg_dimensions(png) is None
+    assert face_pipeline.jpeg_dimensions("photo.jpg") is None
+    assert face_pipeline.jpeg_dimensions(jpeg_bytes(64, 48)[:20]) is None
+
+def test_reduction_for_picks_the_largest_factor_that_still_covers_the_scale():
+    assert face_pipeline.reduction_for(0.1) == 8
+    assert face_pipeline.reduction_for(0.125) == 8
+    assert face_pipeline.reduction_for(0.2) == 4
+    assert face_pipeline.reduction_for(0.5) == 2
+    assert face_pipeline.reduction_for(0.6) == 1
+
+def test_frame_reduction_covers_the_target_in_either_orientation(monkeypatch):
+    monkeypatch.setattr(face_pipeline, "ADAPTIVE_DECODE_ENABLED", True)
+    assert face_pipeline.frame_reduction(jpeg_bytes(4032, 3024), (640, 640)) == 4
+    assert face_pipeline.frame_reduction(jpeg_bytes(3024, 4032), (640, 640)) == 4
+    assert face_pipeline.frame_reduction(jpeg_bytes(800, 600), (640, 640)) == 1
+    monkeypatch.setattr(face_pipeline, "ADAPTIVE_DECODE_ENABLED", False)
+    assert face_pipeline.frame_reduction(jpeg_bytes(4032, 3024), (640, 640)) == 1
@@ -0,0 +1,52 @@
+from face_pool import Supervisor, routing_key, changes_templates
+
+def supervisor(size=4):
+    pool = Supervisor(worker=None, size=size, max_rss_mb=0, max_requests=0, preload=True)
+    for slot in pool.slots:
+        slot.writer = object()  # Stands in for a connected worker
+    return pool
+
+def test_requests_for_one_employee_go_to_one_worker():
+    pool = supervisor()
+    match = pool.pick_slot(routing_key({"action": "match", "employee_id": 12}))
+    register = pool.pick_slot(routing_key({"action": "register", "user_id": "12"}))
+    assert match is register
+
+def test_draining_owner_falls_back_to_least_loaded():
+    pool = supervisor()
+    owner = pool.pick_slot("12")
+    owner.retiring = True
+    idle = pool.slots[(owner.index + 1) % len(pool.slots)]
+    for slot in pool.slots:
+        slot.inflight = {} if slot is idle else {1: None}
+    assert pool.pick_slot("12") is idle
+
+def test_unkeyed_requests_use_least_loaded():
+    pool = supervisor()
+    for slot in pool.slots:
+        slot.inflight = {i: None for i in range(slot.index + 1)}
+    assert routing_key({"action": "identify"}) is None
+    assert pool.pick_slot(None) is pool.slots[0]
+
+def test_only_writes_invalidate_other_workers():
+    assert changes_templates({"action": "register"}, {"success": True})
+    assert not changes_templates({"action": "register"}, {"success": False})
+    assert changes_templates({"action": "match"}, {"matched": True, "stored": True})
+    assert not changes_templates({"action": "match"}, {"matched": True, "stored": False})
+    assert not changes_templates({"action": "identify"}, {"matched": True})
+
+def test_an_invalidate_sent_to_the_pool_reaches_every_worker():
+    import asyncio
+    pool = supervisor(3)
+    pool.slots[2].writer = None  # Being replaced
+    sent = []
+
+    async def forward(request, future, retries=0, slot=None):
+        sent.append((request["employee_id"], slot.index))
+        future.set_result({"ok": True})
+        return slot
+    pool.forward = forward
+
+    response = asyncio.run(pool.dispatch({"action": "invalidate", "employee_id": "12", "id": 4}))
+    assert response == {"ok": True, "workers": 2, "id": 4}
+    assert sent == [("12", 0), ("12", 1)]
@@ -0,0 +1,33 @@
+import numpy as np
+
+from face_templates import plan_insert, select_templates, SKIP, INSERT, REPLACE
+
+def unit(*values):
+    vector = np.array(values, dtype=np.float64)
+    return vector / np.linalg.norm(vector)
+
+def test_first_template_is_inserted():
+    assert plan_insert(np.empty((0, 3)), unit(1, 0, 0)) == (INSERT, None)
+
+def test_near_duplicate_is_skipped():
+    templates = np.stack([unit(1, 0, 0)])
+    assert plan_insert(templates, unit(1, 0.01, 0)) == (SKIP, None)
+
+def test_distinct_encoding_is_inserted_below_the_cap():
+    templates = np.stack([unit(1, 0, 0)])
+    assert plan_insert(templates, unit(0, 1, 0), max_templates=2) == (INSERT, None)
+
+def test_full_set_evicts_the_older_of_the_closest_pair():
+    # Newest first: rows 0 and 2 are the closest pair, row 2 is older
+    templates = np.stack([unit(1, 0.1, 0), unit(0, 1, 0), unit(1, 0.2, 0)])
+    assert plan_insert(templates, unit(0, 0, 1), max_templates=3) == (REPLACE, 2)
+
+def test_full_set_evicts_the_new_encodings_partner():
+    templates = np.stack([unit(1, 0, 0), unit(0, 1, 0), unit(0, 0, 1)])
+    assert plan_insert(templates, unit(1, 0.3, 0), max_templates=3) == (REPLACE, 0)
+
+def test_select_templates_replays_oldest_first():
+    vectors = np.stack([unit(1, 0, 0), unit(1, 0.01, 0), unit(0, 1, 0), unit(1, 0.5, 0)])
+    # The near-duplicate is skipped; at the cap the last one replaces its older look-alike
+    assert select_templates(vectors, max_templates=2) == [2, 3]
+    assert select_templates(vectors, max_templates=5) == [0, 2, 3]
@@ -0,0 +1,44 @@
+import cProfile
+import threading
+
+import face_trace
+
+def test_concurrent_sampled_requests_profile_one_at_a_time(monkeypatch):
+    monkeypatch.setenv("FACE_PROFILE_SAMPLE", "1")
+    monkeypatch.setenv("FACE_TRACE", "off")
+    inside = threading.Barrier(2)
+    profiled = []
+    started = []
+
+    class CountingProfile(cProfile.Profile):
+        def enable(self, *args, **kwargs):
+            started.append(self)
+            super().enable(*args, **kwargs)
+
+    monkeypatch.setattr(face_trace.cProfile, "Profile", CountingProfile)
+
+    def request():
+        with face_trace.trace("match") as t:
+            profiled.append(face_trace._profile_lock.locked())
+            inside.wait()
+        return t
+
+    threads = [threading.Thread(target=request) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert profiled == [True, True]  # Both ran; the second one just wasn't profiled
+    assert len(started) == 1
+    assert not face_trace._profile_lock.locked()
+
+def test_trace_errors_do_not_fail_the_request(monkeypatch):
+    monkeypatch.setenv("FACE_TRACE", "/nonexistent-dir/traces.jsonl")
+    monkeypatch.setattr(face_trace, "_listeners", [lambda t: 1 / 0])
+
+    @face_trace.traced("match")
+    def run():
+        return {"matched": True}, 0
+
+    assert run() == ({"matched": True}, 0)
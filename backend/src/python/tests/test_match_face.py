@@ -0,0 +1,105 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+import match_face
+from face_encoding_format import encode_embedding
+from face_templates import MAX_TEMPLATES_PER_EMPLOYEE
+
+EMPLOYEE = 7
+
+class FakeCursor:
+    def __init__(self, rows=(), rowcount=0, lastrowid=None):
+        self.rows = list(rows)
+        self.rowcount = rowcount
+        self.lastrowid = lastrowid
+
+    def fetchall(self):
+        return self.rows
+
+class FakeDb:
+    """face_data for one employee behind the named statements match_face uses"""
+
+    def __init__(self, vectors):
+        start = datetime(2026, 1, 1)
+        self.rows = [
+            (EMPLOYEE, encode_embedding(v, match_face.MODEL_NAME), start + timedelta(minutes=i), i + 1)
+            for i, v in enumerate(vectors)
+        ]
+        self.calls = []
+        self.rollbacks = 0
+
+    def execute(self, name, params=()):
+        self.calls.append(name)
+        if name == "delete_template":
+            before = len(self.rows)
+            self.rows = [r for r in self.rows if r[3] != params[0]]
+            return FakeCursor(rowcount=before - len(self.rows))
+        if name == "insert_encoding":
+            row_id = max(r[3] for r in self.rows) + 1
+            self.rows.append((EMPLOYEE, params[1], datetime(2026, 2, 1), row_id))
+            return FakeCursor(rowcount=1, lastrowid=row_id)
+        if name == "recent_encodings_for_update":
+            newest = sorted(self.rows, key=lambda r: r[2], reverse=True)[:params[1]]
+            return FakeCursor(rows=newest)
+        raise AssertionError(f"unexpected statement {name}")
+
+    def query(self, name, params=()):
+        return self.execute(name, params).fetchall()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self.rollbacks += 1
+
+@pytest.fixture(autouse=True)
+def no_side_stores(monkeypatch, tmp_path):
+    monkeypatch.delenv("FACE_CROP_DIR", raising=False)
+    monkeypatch.setenv("FACE_INDEX_PATH", str(tmp_path / "face_index.npz"))
+
+def random_vectors(count, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((count, match_face.EMBEDDING_DIM))
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def test_stale_eviction_replans_instead_of_growing_the_set():
+    db = FakeDb(random_vectors(MAX_TEMPLATES_PER_EMPLOYEE))
+    new = random_vectors(1, seed=1)[0]
+
+    stored = match_face.store_face_encoding_to_db(EMPLOYEE, new, db, evicted_row_id=999)
+
+    assert stored is True
+    assert db.calls[0] == "recent_encodings_for_update"
+    assert len(db.rows) == MAX_TEMPLATES_PER_EMPLOYEE
+
+def test_stale_eviction_skips_when_fresh_templates_cover_the_encoding():
+    vectors = random_vectors(MAX_TEMPLATES_PER_EMPLOYEE)
+    db = FakeDb(vectors)
+
+    stored = match_face.store_face_encoding_to_db(EMPLOYEE, vectors[3], db, evicted_row_id=999)
+
+    assert stored is None
+    assert "insert_encoding" not in db.calls
+    assert len(db.rows) == MAX_TEMPLATES_PER_EMPLOYEE
+
+def test_current_eviction_is_written_as_planned():
+    db = FakeDb(random_vectors(MAX_TEMPLATES_PER_EMPLOYEE))
+    new = random_vectors(1, seed=2)[0]
+    _, planned = match_face.replan_insert(EMPLOYEE, new, db)
+    db.calls.clear()
+
+    assert match_face.store_face_encoding_to_db(EMPLOYEE, new, db, evicted_row_id=planned)
+    assert db.calls == ["recent_encodings_for_update", "delete_template", "insert_encoding"]
+    assert planned not in [r[3] for r in db.rows]
+    assert len(db.rows) == MAX_TEMPLATES_PER_EMPLOYEE
+
+def test_stale_insert_plan_evicts_once_the_set_is_full():
+    # The caller read the set while it still had room (snapshot, other worker)
+    db = FakeDb(random_vectors(MAX_TEMPLATES_PER_EMPLOYEE))
+
+    for seed in (3, 4, 5):
+        assert match_face.store_face_encoding_to_db(EMPLOYEE, random_vectors(1, seed=seed)[0], db, evicted_row_id=None)
+    assert "delete_template" in db.calls
+    assert len(db.rows) == MAX_TEMPLATES_PER_EMPLOYEE
@@ -0,0 +1,53 @@
+import result_cache
+from result_cache import ResultCache
+
+MATCHED = {"matched": True, "stored": True}
+REJECTED = {"matched": False, "stored": False, "error": "Please use a real face, not a photo or video"}
+
+def cache_with(response, digest="a" * 64, phash=0b1011):
+    cache = ResultCache(max_entries=8, ttl_seconds=30, phash_bits=4)
+    entry, owner = cache.lookup("12", digest, phash)
+    assert entry is None and owner
+    cache.finish("12", digest, phash, response, 0)
+    return cache
+
+def test_exact_digest_replays_a_match():
+    cache = cache_with(MATCHED)
+    entry, owner = cache.lookup("12", "a" * 64, 0b1011)
+    assert entry["response"] == MATCHED and not owner
+
+def test_perceptual_hash_never_replays_a_match():
+    cache = cache_with(MATCHED)
+    entry, owner = cache.lookup("12", "b" * 64, 0b1010)
+    assert entry is None and owner
+    assert cache.stats()["phash_hits"] == 0
+
+def test_perceptual_hash_replays_a_rejection():
+    cache = cache_with(REJECTED)
+    entry, _ = cache.lookup("12", "b" * 64, 0b1010)
+    assert entry["response"] == REJECTED
+    assert cache.stats()["phash_hits"] == 1
+
+def test_off_by_default_outside_long_lived_processes(monkeypatch):
+    monkeypatch.delenv("FACE_RESULT_CACHE_TTL", raising=False)
+    monkeypatch.setattr(result_cache, "_result_cache", None)
+    assert not result_cache.get_result_cache().enabled
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(result_cache.time, "monotonic", lambda: now[0])
+    cache = cache_with(REJECTED)
+    now[0] += 31
+    entry, owner = cache.lookup("12", "a" * 64, 0b1011)
+    assert entry is None and owner
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResultCache(max_entries=2, ttl_seconds=30)
+    for digest in ("a", "b"):
+        cache.lookup("12", digest)
+        cache.finish("12", digest, response=REJECTED)
+    cache.lookup("12", "a")  # Touch a; b is now the oldest
+    cache.lookup("12", "c")
+    cache.finish("12", "c", response=REJECTED)
+    assert cache.lookup("12", "b") == (None, True)
+    assert cache.lookup("12", "a")[0]["response"] == REJECTED